@@ -5,11 +5,27 @@
 
 # app = Flask(__name__)
 
+import os
+import threading
+
 from flask import Flask, request
-from modules import main
+from modules.metrics import render as render_metrics, timed
+
+# modules.main (and through it requests, yaml, email_validator, smtplib) is imported on the first /webhook call,
+# not at start-up, so cold starts only pay for Flask -- see benchmarks/importtime.py. A background thread then
+# imports it and loads the categorization models, so the first /webhook call doesn't wait for them either
+# (WARM_UP=0 skips it, e.g. when measuring import time).
+WARM_UP = os.environ.get("WARM_UP", "1") != "0"
 
 app = Flask(__name__)
 
+def warm_up():
+    from modules.main import warm_up as warm_up_main
+    warm_up_main()
+
+if WARM_UP:
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
 @app.route('/')
 def hello_world():
 
@@ -20,8 +36,15 @@ def webhook():
     if request.method == 'HEAD': # for setting up webhook with SM API
         return '', 200
     elif request.method in ('POST', 'GET'):
-        data = main()
-        return data, 200
+        from modules.main import main
+        from modules.profiling import requested
+        with timed('main'):
+            body, status = main(profile=requested(request.headers.get('X-Profile')))
+        return body, status
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 if __name__ == '__main__':
     app.run(debug=True)
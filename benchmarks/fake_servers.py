@@ -0,0 +1,193 @@
+import base64
+import json
+import random
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+#### --- Local stand-ins for the SurveyMonkey API, CareerOneStop API and an SMTP server --- ####
+## Each server runs on a background thread bound to 127.0.0.1 and sleeps `latency` (+/- `jitter`) seconds per call.
+
+
+def _sleep(latency:float, jitter:float):
+    if latency or jitter:
+        time.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+
+
+class _Server:
+    """Start/stop helper shared by the fake servers (usable as a context manager)."""
+
+    server = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+
+## ----------------------------------------------------------------------------- ##
+# HTTP APIs #
+
+class _JsonHandler(BaseHTTPRequestHandler):
+    """Routes requests to the owning fake server's `handle_request(method, path, query, body)`."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def _dispatch(self, method):
+        owner = self.server.owner
+        _sleep(owner.latency, owner.jitter)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        parts = urlsplit(self.path)
+        status, payload = owner.handle_request(method, parts.path, parse_qs(parts.query), body)
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeSurveyMonkey(_Server):
+    """Serves `/details`, paginated `/responses/bulk` and `/v3/collectors/{id}` for a single survey."""
+
+    def __init__(self, sm_key:dict, responses:list, latency=0.0, jitter=0.0, port=0):
+        self.sm_key = sm_key
+        self.responses = responses
+        self.latency = latency
+        self.jitter = jitter
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), _JsonHandler)
+        self.server.owner = self
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v3/surveys/{self.sm_key['id']}"
+
+    def handle_request(self, method, path, query, body):
+        if path.endswith("/details"):
+            return 200, self.sm_key
+        if path.endswith("/responses/bulk"):
+            per_page = int(query.get('per_page', ['100'])[0])
+            page = int(query.get('page', ['1'])[0])
+            data = self.responses[(page - 1) * per_page: page * per_page]
+            links = {}
+            if page * per_page < len(self.responses):
+                links['next'] = f"{self.base_url}/responses/bulk?per_page={per_page}&page={page + 1}"
+            return 200, {'data': data, 'per_page': per_page, 'page': page, 'total': len(self.responses), 'links': links}
+        if "/collectors/" in path:
+            collector_id = path.rstrip("/").split("/")[-1]
+            return 200, {'id': collector_id, 'name': f"Collector {collector_id}"}
+        return 404, {'error': path}
+
+
+class FakeCareerOneStop(_Server):
+    """
+    GET returns the skills key (as get_qa_key('cos') expects); POST returns a Skills Matcher result --
+    `cos_response` for every request, or scored per request body if a modules.scoring model is given.
+    """
+
+    def __init__(self, cos_key:dict, cos_response:dict, latency=0.0, jitter=0.0, port=0, model=None):
+        self.cos_key = cos_key
+        self.cos_response = cos_response
+        self.model = model
+        self.latency = latency
+        self.jitter = jitter
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), _JsonHandler)
+        self.server.owner = self
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1/skillsmatcher/user"
+
+    def handle_request(self, method, path, query, body):
+        if method == "GET":
+            return 200, self.cos_key
+        if not body or 'SKAValueList' not in body:
+            return 400, {'error': 'Missing SKAValueList'}
+        if self.model is not None:
+            return 200, self.model.cos_responses([body])[0]
+        return 200, self.cos_response
+
+
+## ----------------------------------------------------------------------------- ##
+# SMTP #
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib: EHLO, AUTH PLAIN/LOGIN, MAIL, RCPT, DATA, RSET, NOOP, QUIT (no STARTTLS)."""
+
+    disable_nagle_algorithm = True
+
+    def reply(self, *lines:str):
+        self.wfile.write(b"".join(line.encode() + b"\r\n" for line in lines))
+
+    def handle(self):
+        owner = self.server.owner
+        self.reply("220 localhost fake SMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip().split(" ", 1)[0].upper()
+            if command in ("EHLO", "HELO"):
+                self.reply("250-localhost", "250 AUTH PLAIN LOGIN")
+            elif command == "AUTH":
+                if line.decode().split()[1].upper() == "LOGIN":
+                    self.reply("334 " + base64.b64encode(b"Username:").decode())
+                    self.rfile.readline()
+                    self.reply("334 " + base64.b64encode(b"Password:").decode())
+                    self.rfile.readline()
+                self.reply("235 Authentication successful")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                    pass
+                _sleep(owner.latency, owner.jitter)
+                owner.messages += 1
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:  # MAIL, RCPT, RSET, NOOP
+                self.reply("250 OK")
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeSMTP(_Server):
+    """Accepts and counts every message. Use with send_email(..., starttls=False)."""
+
+    def __init__(self, latency=0.0, jitter=0.0, port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.messages = 0
+        self.server = _ThreadingTCPServer(("127.0.0.1", port), _SMTPHandler)
+        self.server.owner = self
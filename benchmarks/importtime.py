@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+
+#### --- Cold-start import check for the webhook app (python -X importtime) --- ####
+## python -m benchmarks.importtime
+## Exits non-zero if `import app` pulls in a module that should only load on first use, or exceeds the time budget.
+## tests/test_importtime.py runs the same check for `import app` and `import modules.main` under pytest.
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only needed once a request is actually processed (or never, for the analytics-only packages)
+LAZY_MODULES = ("requests", "yaml", "pytz", "email_validator", "smtplib", "email.mime.multipart",
+                "numpy", "pandas", "matplotlib", "scipy", "statsmodels", "pygris", "modules.main", "modules.funcs")
+
+# What `import modules.main` (loaded by the first /webhook call) must still leave for first use
+MAIN_LAZY_MODULES = tuple(module for module in LAZY_MODULES if not module.startswith("modules."))
+
+# Cumulative import time budget for `import app`, in seconds (override with IMPORT_BUDGET_S)
+IMPORT_BUDGET_S = float(os.environ.get("IMPORT_BUDGET_S", "0.5"))
+
+
+def importtime(statement="import app") -> dict:
+    """Run `statement` in a fresh interpreter under -X importtime. Returns {module: cumulative microseconds}."""
+    # WARM_UP=0: app.py's warm-up thread would import modules.main alongside the statement being measured
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement],
+                            cwd=REPO_DIR, capture_output=True, text=True, check=True, env={**os.environ, 'WARM_UP': "0"})
+    timings = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line.split("|")
+        timings[module.strip()] = int(cumulative)
+    return timings
+
+
+def check(timings:dict, statement="import app", budget_s=IMPORT_BUDGET_S, lazy_modules=LAZY_MODULES) -> list:
+    """Return a list of problems (empty if `statement` imported none of lazy_modules and stayed within budget_s)"""
+    problems = [f"{module} imported eagerly" for module in lazy_modules if module in timings]
+    total_s = timings.get(statement.split()[-1], 0) / 1e6
+    if total_s > budget_s:
+        problems.append(f"`{statement}` took {total_s:.3f}s (budget {budget_s}s)")
+    return problems
+
+
+if __name__ == "__main__":
+    timings = importtime()
+    for module, us in sorted(timings.items(), key=lambda item: -item[1])[:15]:
+        print(f"{us / 1000:9.1f} ms  {module}")
+    problems = check(timings)
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,176 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import yaml
+
+from modules.logger import logger
+from modules.metrics import Histogram, STAGE_LATENCY, timed
+from modules import funcs, utils
+from modules import main as main_module
+from modules.scoring import SkillsMatcherModel
+
+from .synthetic import generate_responses
+from .fake_servers import FakeSurveyMonkey, FakeCareerOneStop, FakeSMTP
+
+#### --- Throughput and p50/p99 per pipeline stage against local fake SM, COS and SMTP servers --- ####
+## python -m benchmarks.run --sizes 10 1000 100000 --latency 0.05
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SM_KEY_FP = os.path.join(REPO_DIR, "data/survey-keys/sm-survey-key.json")
+COS_KEY_FP = os.path.join(REPO_DIR, "data/survey-keys/cos-survey-key.json")
+COS_RESPONSE_FP = os.path.join(REPO_DIR, "data/skills-submit-api/example-response.json")
+EMAIL_TEXT_FP = os.path.join(REPO_DIR, "modules/email_message.txt")
+
+STAGES = ("combine_qa_keys", "translate_sm_response", "post_cos", "send_email", "main")
+
+
+def _load(fp):
+    with open(fp, "r") as file:
+        return json.load(file)
+
+
+def make_sandbox(sm:FakeSurveyMonkey, cos:FakeCareerOneStop, smtp:FakeSMTP) -> str:
+    """Temporary working directory laid out like the repo (creds/, data/, modules/email_message.txt), pointing at the fake servers."""
+    sandbox = tempfile.mkdtemp(prefix="career-onestop-bench-")
+    for sub in ("creds", "data/survey-keys", "modules"):
+        os.makedirs(os.path.join(sandbox, sub))
+    shutil.copy(SM_KEY_FP, os.path.join(sandbox, "data/survey-keys"))
+    shutil.copy(COS_KEY_FP, os.path.join(sandbox, "data/survey-keys"))
+    shutil.copy(EMAIL_TEXT_FP, os.path.join(sandbox, "modules"))
+
+    config = {
+        'sm': {'base_url': sm.base_url,
+               'headers': {'Authorization': 'Bearer benchmark'},
+               'survey-details-fp': "data/survey-keys/sm-survey-key.json"},
+        'cos': {'url': cos.url,
+                'headers': {'Authorization': 'Bearer benchmark'},
+                'survey-details-fp': "data/survey-keys/cos-survey-key.json"},
+        'email': {'shared-dil-account': {'sender-email': 'bench@example.com', 'app-password': 'benchmark'},
+                  'smtp': {'server': '127.0.0.1', 'port': smtp.port, 'starttls': False},
+                  'check-deliverability': False},
+    }
+    with open(os.path.join(sandbox, "creds/api-key.yaml"), "w") as file:
+        yaml.dump(config, file)
+    return sandbox
+
+
+def bench_stages(responses:list, smtp:FakeSMTP, histogram:Histogram) -> None:
+    """Run each stage once per response, timing only the stage itself."""
+    cos_response = _load(COS_RESPONSE_FP)
+    for resp in responses:
+        with timed("combine_qa_keys", histogram):
+            combined_map = funcs.combine_qa_keys(fetch=False)
+
+        with timed("translate_sm_response", histogram):
+            processed_resp = funcs.translate_sm_response(resp, combined_map)
+
+        with timed("post_cos", histogram):
+            utils.post_cos(processed_resp)
+
+        with timed("send_email", histogram):
+            utils.send_email(resp['id'], cos_response, sender='bench@example.com', app_password='benchmark',
+                             recipient='respondent@example.com', server='127.0.0.1', port=smtp.port, starttls=False)
+
+
+def bench_main(histogram:Histogram) -> None:
+    """End-to-end main() against the fake servers; per-stage timings come from main()'s own instrumentation."""
+    STAGE_LATENCY.clear()
+    with timed("main", histogram):
+        main_module.main(test_mode=False)
+    for stage in STAGES[:-1]:
+        histogram.series[(f"main:{stage}",)] = STAGE_LATENCY.series.get((stage,), [0] * (len(histogram.bounds) + 2))
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def report(n:int, histogram:Histogram, elapsed:dict) -> list:
+    """One row per stage -- percentiles are None for stages with no samples (e.g. a main() stage that never ran)"""
+    rows = []
+    for (stage,), series in sorted(histogram.series.items()):
+        count = sum(series[:-1])
+        total = series[-1]
+        seconds = elapsed.get(stage, total)
+        rows.append({
+            'n': n,
+            'stage': stage,
+            'calls': count,
+            'total_s': round(seconds, 4),
+            'throughput_per_s': round(n / seconds, 1) if seconds else None,
+            'p50_ms': _ms(histogram.quantile(0.5, stage=stage)),
+            'p99_ms': _ms(histogram.quantile(0.99, stage=stage)),
+        })
+    return rows
+
+
+def run(sizes=(10, 1000), latency=0.0, jitter=0.0, seed=0, e2e=True, cos_model_fp=None) -> list:
+    """
+    Benchmark each stage and end-to-end main() at every size in `sizes`.
+
+    Args:
+
+    sizes (tuple[int]): Numbers of synthetic responses to process
+
+    latency, jitter (float): Seconds of (uniform +/- jitter) latency added by every fake server call
+
+    seed (int): Seed for the synthetic responses
+
+    e2e (bool): Whether to also run end-to-end main()
+
+    cos_model_fp (str): Local scoring model (modules/scoring.py) for the fake COS server to rank each request with,
+        instead of returning the same example response every time
+
+    Percentiles are the upper bounds of the HDR-style buckets in modules.metrics (within ~19%).
+    """
+    sm_key = _load(SM_KEY_FP)
+    cos_model = SkillsMatcherModel.load(cos_model_fp) if cos_model_fp else None
+    results = []
+    log_level = logger.level
+    logger.setLevel(logging.WARNING)
+    cwd = os.getcwd()
+    try:
+        for n in sizes:
+            responses = generate_responses(sm_key, n, seed=seed)
+            with FakeSurveyMonkey(sm_key, responses, latency, jitter) as sm, \
+                 FakeCareerOneStop(_load(COS_KEY_FP), _load(COS_RESPONSE_FP), latency, jitter, model=cos_model) as cos, \
+                 FakeSMTP(latency, jitter) as smtp:
+                sandbox = make_sandbox(sm, cos, smtp)
+                os.chdir(sandbox)
+                try:
+                    histogram = Histogram("benchmark_seconds", "Benchmark stage latency", labels=("stage",))
+                    elapsed = {}
+                    bench_stages(responses, smtp, histogram)
+                    if e2e:
+                        start_time = time.perf_counter()
+                        bench_main(histogram)
+                        elapsed['main'] = time.perf_counter() - start_time
+                    results.extend(report(n, histogram, elapsed))
+                finally:
+                    os.chdir(cwd)
+                    shutil.rmtree(sandbox, ignore_errors=True)
+    finally:
+        logger.setLevel(log_level)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the survey pipeline against local fake servers")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000])
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-e2e", action="store_true")
+    parser.add_argument("--cos-model", default=None, help="Local scoring model for the fake COS server")
+    args = parser.parse_args()
+
+    rows = run(args.sizes, args.latency, args.jitter, args.seed, e2e=not args.no_e2e, cos_model_fp=args.cos_model)
+    columns = list(rows[0].keys())
+    print("\t".join(columns))
+    for row in rows:
+        print("\t".join(str(row[c]) for c in columns))
@@ -0,0 +1,109 @@
+import datetime as dt
+import random
+
+#### --- Synthetic SurveyMonkey responses generated from the SM `/details` survey key --- ####
+
+WORDS = ("work job skills training pay hours family transportation childcare experience "
+         "computer health manager customer office warehouse nursing teaching driving "
+         "certification college degree interview schedule remote benefits").split()
+
+## Default answer distribution for skills-matcher questions (Beginner ... Expert)
+SKILL_LEVEL_WEIGHTS = (0.25, 0.25, 0.25, 0.15, 0.10)
+
+
+def _free_text(rng:random.Random, min_words=3, max_words=40) -> str:
+    return " ".join(rng.choices(WORDS, k=rng.randint(min_words, max_words))).capitalize() + "."
+
+
+def _answers(q:dict, skills_matcher:bool, rng:random.Random, skill_level_weights, p_other:float) -> list:
+    """Answers to a single question in the raw `/responses/bulk` format"""
+    family = q['family']
+    if family == 'single_choice':
+        choices = q['answers']['choices']
+        if 'other' in q['answers'] and rng.random() < p_other:
+            return [{'other_id': q['answers']['other']['id'], 'tag_data': [], 'text': _free_text(rng, 1, 6)}]
+        if skills_matcher and len(choices) == len(skill_level_weights):
+            return [{'choice_id': rng.choices(choices, weights=skill_level_weights)[0]['id']}]
+        return [{'choice_id': rng.choice(choices)['id']}]
+    elif family == 'multiple_choice':
+        choices = q['answers']['choices']
+        answers = [{'choice_id': c['id']} for c in rng.sample(choices, rng.randint(1, min(4, len(choices))))]
+        if 'other' in q['answers'] and rng.random() < p_other:
+            answers.append({'other_id': q['answers']['other']['id'], 'tag_data': [], 'text': _free_text(rng, 1, 6)})
+        return answers
+    elif family == 'datetime':
+        birth_date = dt.date(1950, 1, 1) + dt.timedelta(days=rng.randint(0, 365 * 55))
+        return [{'row_id': q['answers']['rows'][0]['id'], 'tag_data': [], 'text': birth_date.strftime("%m/%d/%Y")}]
+    elif q['headings'][0]['heading'].lower().startswith('email'):
+        return [{'tag_data': [], 'text': f"respondent{rng.randint(0, 10**9)}@example.com"}]
+    elif 'zip' in q['headings'][0]['heading'].lower():
+        return [{'tag_data': [], 'text': str(rng.randint(19701, 19980))}]
+    return [{'tag_data': [], 'text': _free_text(rng)}]
+
+
+def generate_responses(sm_key:dict, n:int, seed=0,
+                       p_missing=0.05,
+                       p_other=0.05,
+                       p_no_email=0.02,
+                       skill_level_weights=SKILL_LEVEL_WEIGHTS,
+                       collector_ids=("452261040", "428261927")) -> list:
+    """
+    Generate `n` raw SurveyMonkey responses (as returned in the `data` list of /responses/bulk).
+
+    Args:
+
+    sm_key (dict): SM survey details key (e.g. data/survey-keys/sm-survey-key.json)
+
+    n (int): Number of responses
+
+    seed (int): Random seed -- the same seed always yields the same responses
+
+    p_missing (float): Probability that any non skills-matcher question is omitted (SM omits unanswered questions)
+
+    p_other (float): Probability of choosing the 'Other' option where a question has one
+
+    p_no_email (float): Probability that the email question (the last one) is omitted
+
+    skill_level_weights (tuple): Relative weights of the 5 skills-matcher answer levels
+
+    collector_ids (tuple): Collector ids to spread the responses across
+
+    """
+    rng = random.Random(seed)
+    start_time = dt.datetime(2023, 9, 1)
+    last_question_id = [q['id'] for p in sm_key['pages'] for q in p['questions']][-1]
+
+    responses = []
+    for i in range(n):
+        pages = []
+        for p in sm_key['pages']:
+            skills_matcher = "skills matcher" in p['title'].lower()
+            questions = []
+            for q in p['questions']:
+                if q['id'] == last_question_id:
+                    if rng.random() < p_no_email:
+                        continue
+                elif not skills_matcher and rng.random() < p_missing:
+                    continue
+                questions.append({'id': q['id'],
+                                  'answers': _answers(q, skills_matcher, rng, skill_level_weights, p_other)})
+            pages.append({'id': p['id'], 'questions': questions})
+
+        date_created = start_time + dt.timedelta(minutes=7 * i)
+        total_time = rng.randint(300, 1800)
+        responses.append({
+            'id': str(100000000000 + i),
+            'collector_id': rng.choice(collector_ids),
+            'survey_id': sm_key['id'],
+            'response_status': 'completed',
+            'total_time': total_time,
+            'date_created': date_created.strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+            'date_modified': (date_created + dt.timedelta(seconds=total_time)).strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+            'ip_address': f"10.0.{rng.randint(0, 255)}.{rng.randint(0, 255)}",
+            'logic_path': {},
+            'metadata': {'contact': {}},
+            'custom_variables': {},
+            'pages': pages,
+        })
+
+    return responses
@@ -0,0 +1,199 @@
+import argparse
+import hashlib
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from .logger import logger
+from .utils import load_json, est_now, create_cos_request_body, load_collector_names
+from .funcs import combine_qa_keys, translate_sm_response
+from .responses import as_response
+from .categories import categorize_answers
+from .skillmatrix import SkillMatrix, encode, matrix_columns, clear as clear_matrix
+
+#### --- Offline reprocessing (backfill) of stored raw SM responses against a chosen translation map --- ####
+## python -m modules.backfill --source data/survey-responses.json --map data/survey-keys/combined_map.json --workers 4
+##
+## Output goes to {output_dir}/{map_version}/processed.json (JSON rows, like data/survey-responses.json), with the
+## skills-matcher answers in a skill matrix (modules/skillmatrix.py) at {output_dir}/{map_version}/skill-matrix/.
+## checkpoint.json next to it records how many source lines and output bytes are done, so an interrupted run
+## continues where it left off.
+
+SOURCE_FP = "data/survey-responses.json"
+OUTPUT_DIR = "data/backfill"
+
+_worker_map = None  # translation map loaded once per worker process
+_worker_collector_names = None  # collector id -> name (utils.load_collector_names()), likewise
+
+
+def map_version(combined_map:dict) -> str:
+    """Short content hash identifying a translation map"""
+    canonical = json.dumps(combined_map, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()[:12]
+
+
+def load_map(map_fp=None) -> dict:
+    """Load a saved combined map, or build the current one from the cached SM/COS keys if map_fp is None"""
+    if map_fp is None:
+        return combine_qa_keys(fetch=False)
+    combined_map = load_json(map_fp)
+    if combined_map is None:
+        raise Exception(f"ERROR: Failed to load translation map {map_fp}")
+    return combined_map
+
+
+def _init_worker(combined_map:dict, collector_names:dict):
+    global _worker_map, _worker_collector_names
+    _worker_map = combined_map
+    _worker_collector_names = collector_names
+
+
+def reprocess_line(line:str, combined_map:dict, version:str, collector_names=None):
+    """Re-translate one stored row. Returns the output row (dict), or None for rows without a raw response."""
+    rows = reprocess_lines([line], combined_map, version, collector_names)
+    return rows[0] if rows else None
+
+
+def reprocess_lines(lines:list, combined_map:dict, version:str, collector_names=None) -> list:
+    """
+    Re-translate stored rows (skipping those without a raw response), categorizing their free-text answers in one batch.
+
+    collector_names (dict): collector id -> name, as main() would look it up (default: utils.load_collector_names()).
+        Collectors missing from it keep the name stored with the row.
+    """
+    collector_names = load_collector_names() if collector_names is None else collector_names
+    records = [json.loads(line) for line in lines if line.strip()]
+    records = [record for record in records if record.get('raw') is not None]
+    rows = []
+    translated = [] # (row, response) pairs to categorize
+    for record in records:
+        try:
+            resp = as_response(record['raw'])
+            collector_name = collector_names.get(resp.collector_id, (record.get('processed') or {}).get('collector_name'))
+            processed = translate_sm_response(resp, combined_map, collector_name=collector_name)
+            row = {'id': record['id'],
+                   'date_added': est_now(),
+                   'map_version': version,
+                   'processed': processed,
+                   'cos_request_body': create_cos_request_body(processed)}
+            translated.append((row, resp))
+        except Exception as e:
+            row = {'id': record['id'], 'date_added': est_now(), 'map_version': version, 'error': repr(e)}
+        rows.append(row)
+
+    categories = categorize_answers([resp for _, resp in translated], combined_map)
+    for (row, _), response_categories in zip(translated, categories):
+        row['processed']['categories'] = response_categories
+    return rows
+
+
+def _reprocess_chunk(lines:list, version:str) -> tuple:
+    """Worker task: returns (number of source lines, output text, response ids, skill matrix rows)"""
+    rows = reprocess_lines(lines, _worker_map, version, _worker_collector_names)
+    processed = [row['processed'] for row in rows if 'processed' in row]
+    levels = encode(processed, _worker_map, matrix_columns(_worker_map))
+    return len(lines), ''.join(json.dumps(row) + '\n' for row in rows), [resp['response_id'] for resp in processed], levels
+
+
+def _read_chunks(fp:str, skip:int, chunk_size:int):
+    """Yield lists of up to chunk_size lines from fp, after skipping the first `skip` lines"""
+    chunk = []
+    with open(fp, "r") as file:
+        for n, line in enumerate(file):
+            if n < skip:
+                continue
+            chunk.append(line)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def _write_chunk(result:tuple, output_file, matrix:SkillMatrix, checkpoint:dict, checkpoint_fp:str):
+    """Append a finished chunk, then advance the checkpoint past it"""
+    n_lines, text, response_ids, levels = result
+    output_file.write(text)
+    output_file.flush()
+    matrix.append(response_ids, levels) # rows of an interrupted chunk are overwritten when it is redone
+    checkpoint['lines_done'] += n_lines
+    checkpoint['output_bytes'] = output_file.tell()
+    checkpoint['date_modified'] = est_now()
+    _write_checkpoint(checkpoint_fp, checkpoint)
+    logger.info("Backfill %s -- %d lines done", checkpoint['map_version'], checkpoint['lines_done'])
+
+
+def _write_checkpoint(fp:str, checkpoint:dict):
+    tmp_fp = fp + ".tmp"
+    with open(tmp_fp, "w") as file:
+        json.dump(checkpoint, file)
+    os.replace(tmp_fp, fp)
+
+
+def backfill(source_fp=SOURCE_FP, map_fp=None, output_dir=OUTPUT_DIR, workers=None, chunk_size=500) -> str:
+    """
+    Re-run translation and COS request body construction for every stored raw response.
+
+    Args:
+
+    source_fp (str): JSON row file with a 'raw' SM response per row (as written by main())
+
+    map_fp (str): Saved combined map to translate against (default: build from the cached SM/COS keys)
+
+    output_dir (str): Each map version gets its own sub-directory here
+
+    workers (int): Size of the process pool (default: os.cpu_count())
+
+    chunk_size (int): Source lines per task -- also how often the checkpoint is written
+
+    Returns the path of the output file.
+    """
+    combined_map = load_map(map_fp)
+    version = map_version(combined_map)
+
+    version_dir = os.path.join(output_dir, version)
+    os.makedirs(version_dir, exist_ok=True)
+    output_fp = os.path.join(version_dir, "processed.json")
+    checkpoint_fp = os.path.join(version_dir, "checkpoint.json")
+    matrix_dir = os.path.join(version_dir, "skill-matrix")
+
+    checkpoint = load_json(checkpoint_fp) if os.path.isfile(checkpoint_fp) else None
+    if checkpoint is None or checkpoint.get('source') != os.path.abspath(source_fp):
+        checkpoint = {'source': os.path.abspath(source_fp), 'map_version': version, 'lines_done': 0, 'output_bytes': 0}
+        clear_matrix(matrix_dir) # starting from scratch: drop rows from an earlier source, as processed.json is truncated
+    else:
+        logger.info("Backfill %s -- resuming after %d lines", version, checkpoint['lines_done'])
+
+    # Drop anything written after the last checkpoint (an interrupted chunk)
+    with open(output_fp, "a") as output_file:
+        output_file.truncate(checkpoint['output_bytes'])
+    matrix = SkillMatrix(matrix_dir, columns=matrix_columns(combined_map))
+
+    workers = workers or os.cpu_count()
+    pending = deque() # futures in source order, at most 2 per worker so the source is streamed rather than read up front
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(combined_map, load_collector_names())) as pool, \
+         open(output_fp, "a") as output_file:
+        for chunk in _read_chunks(source_fp, checkpoint['lines_done'], chunk_size):
+            pending.append(pool.submit(_reprocess_chunk, chunk, version))
+            if len(pending) >= 2 * workers:
+                _write_chunk(pending.popleft().result(), output_file, matrix, checkpoint, checkpoint_fp)
+        while pending:
+            _write_chunk(pending.popleft().result(), output_file, matrix, checkpoint, checkpoint_fp)
+
+    checkpoint['complete'] = True
+    _write_checkpoint(checkpoint_fp, checkpoint)
+    return output_fp
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reprocess stored SM responses against a translation map")
+    parser.add_argument("--source", default=SOURCE_FP)
+    parser.add_argument("--map", default=None, help="Saved combined map (default: build from cached keys)")
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=500)
+    args = parser.parse_args()
+
+    print(backfill(args.source, args.map, args.output_dir, args.workers, args.chunk_size))
@@ -0,0 +1,195 @@
+import atexit
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from urllib.parse import urlencode
+
+from .logger import logger
+
+#### --- Record/replay of external calls (HTTP via utils.request, SMTP via utils.send_email) --- ####
+## CASSETTE_MODE=record  -- make real calls and append every interaction to the cassette
+## CASSETTE_MODE=replay  -- answer every call from the cassette, never touching the network
+## CASSETTE_DIR (default data/cassettes) holds:
+##   interactions.jsonl  one "<key>\t<json>" line per interaction (append-only)
+##   index.json          key -> [offset, length] into interactions.jsonl, stamped with the offset it covers up to
+## Lookups seek straight to a single line, so replaying never re-parses the whole store. Several processes can record
+## into one cassette: lines are appended with O_APPEND, and the index is saved under a lock after scanning whatever
+## other processes appended past the saved offset. interactions.jsonl is the source of truth: the index is saved at
+## exit, but loading always scans the lines past its offset (so a crashed process loses nothing), and a lookup that
+## misses first scans lines other processes appended since.
+
+CASSETTE_MODE = os.environ.get("CASSETTE_MODE", "off")
+CASSETTE_DIR = os.environ.get("CASSETTE_DIR", "data/cassettes")
+
+_cassette = None
+_cassette_lock = threading.Lock()
+
+
+def request_key(method:str, url:str, params=None, body=None) -> str:
+    """sha256 of the method, URL (with sorted query params) and canonical JSON body"""
+    if params:
+        url += ("&" if "?" in url else "?") + urlencode(sorted(params.items()))
+    canonical_body = json.dumps(body, sort_keys=True, separators=(',', ':')) if body is not None else ""
+    return hashlib.sha256(f"{method.upper()} {url}\n{canonical_body}".encode()).hexdigest()
+
+
+class ReplayedResponse:
+    """Minimal stand-in for requests.Response (what the callers of utils.request use)"""
+
+    def __init__(self, status_code:int, text:str, headers=None, url=""):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+        self.url = url
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class Cassette:
+    """Append-only store of interactions with an in-memory key -> (offset, length) index."""
+
+    def __init__(self, directory=CASSETTE_DIR, mode="replay"):
+        self.directory = directory
+        self.mode = mode
+        self.replaying = mode == "replay"
+        self.data_fp = os.path.join(directory, "interactions.jsonl")
+        self.index_fp = os.path.join(directory, "index.json")
+        self._lock = threading.Lock()
+        self._reader = None
+        self._index_dirty = False
+        os.makedirs(directory, exist_ok=True)
+        self.index = self._load_index()
+
+    def _load_index(self) -> dict:
+        index, offset = {}, 0
+        if os.path.isfile(self.index_fp):
+            with open(self.index_fp, "r") as file:
+                saved = json.load(file)
+            index, offset = saved['index'], saved.get('data_size', 0)
+        end = self._scan(index, offset)
+        if end is None: # the data file is shorter than the index says (replaced) -- rebuild it
+            index = {}
+            end = self._scan(index, 0)
+        self._indexed_to = end
+        self._index_dirty = end != offset
+        return index
+
+    def _scan(self, index:dict, offset:int):
+        """
+        Add the lines from `offset` on to `index`, from the keys at their start (no JSON parsing). Returns the offset
+        indexed up to (a trailing partial line is left for a later scan), or None if the file is shorter than offset.
+        """
+        size = os.path.getsize(self.data_fp) if os.path.isfile(self.data_fp) else 0
+        if size < offset:
+            return None
+        if size > offset:
+            with open(self.data_fp, "rb") as file:
+                file.seek(offset)
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        break
+                    index[line[:64].decode()] = [offset, len(line)]
+                    offset += len(line)
+        return offset
+
+    def _catch_up(self) -> None:
+        """Index the lines appended (e.g. by other processes) since the last scan (caller holds the lock)"""
+        end = self._scan(self.index, self._indexed_to)
+        if end is None:
+            self.index = {}
+            end = self._scan(self.index, 0)
+        if end != self._indexed_to:
+            self._indexed_to = end
+            self._index_dirty = True
+
+    def save_index(self):
+        with self._lock:
+            if not self._index_dirty:
+                return
+            with open(self.index_fp + ".lock", "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._catch_up()
+                tmp_fp = self.index_fp + ".tmp"
+                with open(tmp_fp, "w") as file:
+                    json.dump({'data_size': self._indexed_to, 'index': self.index}, file)
+                os.replace(tmp_fp, self.index_fp)
+            self._index_dirty = False
+
+    def get(self, key:str):
+        """The recorded interaction for `key` (dict), or None"""
+        location = self.index.get(key)
+        if location is None:
+            with self._lock:
+                self._catch_up()
+                location = self.index.get(key)
+            if location is None:
+                return None
+        with self._lock:
+            if self._reader is None:
+                self._reader = open(self.data_fp, "rb")
+            self._reader.seek(location[0])
+            line = self._reader.read(location[1])
+        return json.loads(line[65:])
+
+    def put(self, key:str, interaction:dict):
+        line = (key + "\t" + json.dumps(interaction) + "\n").encode()
+        with self._lock:
+            # O_APPEND: the line lands whole at the end even with other processes recording into the same cassette
+            fd = os.open(self.data_fp, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+                offset = os.lseek(fd, 0, os.SEEK_CUR) - len(line)
+            finally:
+                os.close(fd)
+            self.index[key] = [offset, len(line)]
+            self._index_dirty = True
+
+    ## HTTP
+    def replay_request(self, method:str, url:str, params=None, body=None):
+        interaction = self.get(request_key(method, url, params, body))
+        if interaction is None:
+            logger.warning("Cassette miss: %s %s", method, url)
+            return None
+        return ReplayedResponse(interaction['status_code'], interaction['text'], interaction.get('headers'), url)
+
+    def record_request(self, method:str, url:str, params, body, response):
+        self.put(request_key(method, url, params, body), {
+            'method': method, 'url': url, 'params': params,
+            'status_code': response.status_code,
+            'headers': {k: v for k, v in response.headers.items() if k.lower() == 'content-type'},
+            'text': response.text,
+        })
+
+    ## SMTP
+    @staticmethod
+    def email_key(server:str, recipient:str, message:str) -> str:
+        return request_key("SMTP", f"smtp://{server}/{recipient}", body=hashlib.sha256(message.encode()).hexdigest())
+
+    def replay_email(self, server:str, recipient:str, message:str):
+        """Recorded send result (bool), or None"""
+        interaction = self.get(self.email_key(server, recipient, message))
+        if interaction is None:
+            logger.warning("Cassette miss: SMTP %s -> %s", server, recipient)
+            return None
+        return interaction['sent']
+
+    def record_email(self, server:str, recipient:str, message:str, sent:bool):
+        self.put(self.email_key(server, recipient, message), {'server': server, 'recipient': recipient, 'sent': sent})
+
+
+def get_cassette():
+    """The shared cassette if CASSETTE_MODE is 'record' or 'replay', else None"""
+    global _cassette
+    if CASSETTE_MODE not in ("record", "replay"):
+        return None
+    if _cassette is None:
+        with _cassette_lock: # survey worker threads may all make their first call at once
+            if _cassette is None:
+                cassette = Cassette(CASSETTE_DIR, CASSETTE_MODE)
+                atexit.register(cassette.save_index)
+                logger.info("Cassette %s mode (%s, %d interactions)", CASSETTE_MODE, CASSETTE_DIR, len(cassette.index))
+                _cassette = cassette
+    return _cassette
@@ -0,0 +1,256 @@
+import argparse
+import csv
+import hashlib
+import math
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+
+from .logger import logger
+from .responses import as_response
+
+#### --- Categorization of free-text answers, learned from the manual labels --- ####
+## data/manual_categories/{open,other}/<question>_n=<N>.csv hold hand-assigned categories for open-ended answers
+## ('open') and "Other (please specify)" answers ('other'): columns Respondent ID, <question>_Open|_Other, category.
+## For every labelled question a TF-IDF nearest-centroid model is fitted once and cached in MODEL_FP (refitted when
+## the label files change). A batch of answers is classified with one sparse (CSR) x dense product -- numpy only,
+## so the runtime doesn't need scipy. numpy is imported on first use, keeping it off main()'s (and app.py's) import path.
+##
+## python -m modules.categories  -- (re)fit and save the models
+
+LABELS_DIR = "data/manual_categories"
+MODEL_FP = "data/models/categories.npz"
+KINDS = ('open', 'other')
+MIN_SCORE = 0.1  # cosine similarity below which an answer is left uncategorized
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:['&][a-z0-9]+)*")
+STOPWORDS = frozenset("""a an and are as at be but by for from have i i'm in is it its just me my of on or so that
+the their them then there they this to was we what when which who will with would you your""".split())
+
+_models = None
+_models_lock = threading.Lock()
+
+
+def question_key(question_text:str) -> str:
+    """Match key for a question's text (file names can't hold every character of the SM heading)"""
+    return " ".join(TOKEN_PATTERN.findall(question_text.lower()))
+
+
+def tokenize(text:str) -> list:
+    """Lowercase word unigrams and bigrams, without stopwords"""
+    words = [w for w in TOKEN_PATTERN.findall(text.lower()) if w not in STOPWORDS]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class TextCategorizer:
+    """
+    TF-IDF nearest-centroid classifier for one question's answers.
+
+    terms (list[str]): Vocabulary (column order)
+    idf (np.ndarray): Inverse document frequency per term
+    centroids (np.ndarray): len(terms) x len(categories), unit-length columns
+    """
+
+    def __init__(self, terms, idf, centroids, categories):
+        import numpy as np
+        self.terms = list(terms)
+        self.idf = np.asarray(idf, dtype=np.float32)
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.categories = list(categories)
+        self.columns = {term: n for n, term in enumerate(self.terms)}
+
+    @classmethod
+    def fit(cls, texts:list, labels:list):
+        import numpy as np
+        document_frequency = Counter(term for text in texts for term in set(tokenize(text)))
+        terms = sorted(document_frequency)
+        idf = [math.log((1 + len(texts)) / (1 + document_frequency[term])) + 1 for term in terms]
+        categories = sorted(set(labels))
+        model = cls(terms, idf, np.zeros((len(terms), len(categories))), categories)
+
+        # Centroid per category: mean of its answers' unit TF-IDF vectors, scaled to unit length
+        indptr, indices, data = model.transform(texts)
+        rows = np.repeat(np.arange(len(texts)), np.diff(indptr))
+        category_of_row = np.array([categories.index(label) for label in labels])
+        centroids = np.zeros((len(terms), len(categories)))
+        np.add.at(centroids, (indices, category_of_row[rows]), data)
+        norms = np.linalg.norm(centroids, axis=0)
+        model.centroids = (centroids / np.where(norms > 0, norms, 1)).astype(np.float32)
+        return model
+
+    def transform(self, texts:list) -> tuple:
+        """Unit-length TF-IDF rows as CSR arrays (indptr, indices, data); unknown terms are dropped"""
+        import numpy as np
+        indptr, indices, data = [0], [], []
+        for text in texts:
+            counts = Counter(self.columns[t] for t in tokenize(text) if t in self.columns)
+            indices.extend(counts)
+            data.extend(1 + math.log(count) for count in counts.values())
+            indptr.append(len(indices))
+        indptr = np.asarray(indptr, dtype=np.int64)
+        indices = np.asarray(indices, dtype=np.int64)
+        data = np.asarray(data, dtype=np.float32) * self.idf[indices]
+        if len(data):
+            rows = np.repeat(np.arange(len(texts)), np.diff(indptr))
+            norms = np.sqrt(np.bincount(rows, weights=data ** 2, minlength=len(texts)))
+            data /= norms[rows]
+        return indptr, indices, data
+
+    def scores(self, texts:list) -> "np.ndarray":
+        """Cosine similarity of every text to every category centroid (len(texts) x len(categories))"""
+        import numpy as np
+        indptr, indices, data = self.transform(texts)
+        scores = np.zeros((len(texts), len(self.categories)), dtype=np.float32)
+        nonempty = np.diff(indptr) > 0
+        if nonempty.any():
+            # CSR x dense: scale each non-zero's centroid row by its weight, then sum each text's run of non-zeros
+            scores[nonempty] = np.add.reduceat(data[:, None] * self.centroids[indices], indptr[:-1][nonempty], axis=0)
+        return scores
+
+    def predict(self, texts:list, min_score=MIN_SCORE) -> list:
+        """(category, score) per text -- category is None if no centroid is at least min_score similar"""
+        import numpy as np
+        if not texts:
+            return []
+        scores = self.scores(texts)
+        best = scores.argmax(axis=1)
+        best_scores = scores[np.arange(len(texts)), best]
+        return [(self.categories[b] if s >= min_score else None, round(float(s), 4)) for b, s in zip(best, best_scores)]
+
+
+## ----------------------------------------------------------------------------- ##
+# Manual labels and the cached models #
+
+def _label_files(labels_dir=LABELS_DIR) -> list:
+    """(kind, question, path) for every label file"""
+    files = []
+    for kind in KINDS:
+        directory = os.path.join(labels_dir, kind)
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(".csv"):
+                    files.append((kind, name.rsplit('_n=', 1)[0].rsplit('.csv', 1)[0], os.path.join(directory, name)))
+    return files
+
+
+def labels_version(labels_dir=LABELS_DIR) -> str:
+    """Hash of the label files' names, sizes and modification times"""
+    stamp = "|".join(f"{path}:{os.path.getsize(path)}:{os.path.getmtime(path)}" for _, _, path in _label_files(labels_dir))
+    return hashlib.sha256(stamp.encode()).hexdigest()[:12]
+
+
+def load_labels(labels_dir=LABELS_DIR) -> dict:
+    """'kind:question key' -> (texts, categories) from the manual label CSVs"""
+    labels = {}
+    for kind, question, path in _label_files(labels_dir):
+        texts, categories = [], []
+        with open(path, "r", newline="", encoding="utf-8") as file:
+            reader = csv.DictReader(file)
+            text_column = next((c for c in reader.fieldnames or [] if c.endswith(("_Open", "_Other"))), None)
+            if text_column is None or 'category' not in reader.fieldnames:
+                logger.warning(f"{path} has no answer text/category columns -- skipping")
+                continue
+            for row in reader:
+                if row[text_column] and row['category'] and row['category'].strip():
+                    texts.append(row[text_column])
+                    categories.append(row['category'].strip())
+        if texts:
+            labels[f"{kind}:{question_key(question)}"] = (texts, categories)
+    return labels
+
+
+def fit_models(labels_dir=LABELS_DIR, model_fp=MODEL_FP) -> dict:
+    """Fit a model per labelled question and save them all to model_fp (atomically: workers may be loading it)"""
+    import numpy as np
+    models = {key: TextCategorizer.fit(texts, categories) for key, (texts, categories) in load_labels(labels_dir).items()}
+    arrays = {'keys': np.asarray(list(models)), 'labels_version': np.asarray(labels_version(labels_dir))}
+    for n, model in enumerate(models.values()):
+        arrays.update({f"terms_{n}": np.asarray(model.terms), f"idf_{n}": model.idf,
+                       f"centroids_{n}": model.centroids, f"categories_{n}": np.asarray(model.categories)})
+    os.makedirs(os.path.dirname(model_fp) or ".", exist_ok=True)
+    tmp_fp = f"{model_fp}.{os.getpid()}.tmp"
+    with open(tmp_fp, "wb") as file: # a file object, so savez doesn't append ".npz" to the name
+        np.savez(file, **arrays)
+    os.replace(tmp_fp, model_fp)
+    logger.info("Fitted %d answer categorization models from %s -> %s", len(models), labels_dir, model_fp)
+    return models
+
+
+def load_models(model_fp=MODEL_FP) -> tuple:
+    """(models, labels version) from model_fp"""
+    import numpy as np
+    with np.load(model_fp) as data:
+        models = {str(key): TextCategorizer(data[f"terms_{n}"].tolist(), data[f"idf_{n}"],
+                                            data[f"centroids_{n}"], data[f"categories_{n}"].tolist())
+                  for n, key in enumerate(data['keys'])}
+        return models, str(data['labels_version'])
+
+
+def get_models(labels_dir=LABELS_DIR, model_fp=MODEL_FP) -> dict:
+    """Shared models: loaded from model_fp, or (re)fitted if the labels changed since. {} if there are no labels."""
+    global _models
+    with _models_lock: # app.py's warm-up thread and the first /webhook call may both get here
+        if _models is None:
+            _models = _load_or_fit(labels_dir, model_fp)
+    return _models
+
+
+def _load_or_fit(labels_dir:str, model_fp:str) -> dict:
+    has_labels = bool(_label_files(labels_dir))
+    version = labels_version(labels_dir) if has_labels else None
+    if os.path.isfile(model_fp):
+        models, saved_version = load_models(model_fp)
+        if has_labels and saved_version != version:
+            models = fit_models(labels_dir, model_fp)
+        return models
+    if has_labels:
+        return fit_models(labels_dir, model_fp)
+    logger.warning("No manual categories in %s -- free-text answers won't be categorized", labels_dir)
+    return {}
+
+
+## ----------------------------------------------------------------------------- ##
+# Batch categorization #
+
+def categorize_answers(responses:list, combined_map:dict, models=None) -> list:
+    """
+    Categorize the free-text answers of a batch of SM responses -- one predict() call per labelled question.
+
+    Returns, per response, {question id: {'kind': 'open'|'other', 'category': str|None, 'score': float}}
+    """
+    models = get_models() if models is None else models
+    results = [{} for _ in responses]
+    if not models:
+        return results
+
+    question_models = {}
+    for q_map in list(combined_map['non-skills-matcher'].values()) + list(combined_map['skills-matcher'].values()):
+        key = question_key(q_map['question_text']['sm'])
+        question_models[q_map['question_id']['sm']] = {kind: f"{kind}:{key}" for kind in KINDS if f"{kind}:{key}" in models}
+
+    batches = defaultdict(list)  # model key -> [(response index, question id, kind, text)]
+    for n, resp in enumerate(responses):
+        for question_id, answers in as_response(resp).answers:
+            model_keys = question_models.get(question_id)
+            if not model_keys:
+                continue
+            for choice_id, other_id, row_id, text in answers:
+                kind = 'other' if other_id is not None else 'open' if choice_id is None and row_id is None else None
+                if kind in model_keys and text:
+                    batches[model_keys[kind]].append((n, question_id, kind, text))
+
+    for model_key, items in batches.items():
+        predictions = models[model_key].predict([text for _, _, _, text in items])
+        for (n, question_id, kind, _), (category, score) in zip(items, predictions):
+            results[n][question_id] = {'kind': kind, 'category': category, 'score': score}
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit the free-text answer categorization models from the manual labels")
+    parser.add_argument("--labels", default=LABELS_DIR)
+    parser.add_argument("--output", default=MODEL_FP)
+    args = parser.parse_args()
+
+    fit_models(args.labels, args.output)
@@ -0,0 +1,250 @@
+import fcntl
+import json
+import os
+import random
+import threading
+import time
+
+from .logger import logger
+from .utils import est_now
+
+#### --- Dead-letter store for responses that failed a pipeline stage, with a background retry scheduler --- ####
+## main() parks a response here when a stage fails, together with everything needed to resume *at that stage*:
+##   translate   raw SM response (unexpected question ids) -- retried from the start with a freshly fetched map
+##   post_cos    processed response + email address       -- COS is POSTed again, then the email is sent
+##   send_email  processed response + email address + COS response -- only the send is retried (no second COS POST)
+## Retries back off exponentially (RETRY_BASE_S * 2**(attempts-1), capped at RETRY_MAX_S, with jitter). After
+## MAX_ATTEMPTS an entry is kept but marked exhausted, for a manual look.
+##
+## The store is a single JSON object (response id -> entry) at data/dead-letters.json, rewritten atomically. Several
+## processes can share it: each save merges this process's changes into the file under a lock (and picks up the
+## others'), and a handler returns SKIPPED for a retry another worker has claimed (see modules/leases.py).
+
+DEAD_LETTER_FP = "data/dead-letters.json"
+STAGES = ('translate', 'post_cos', 'send_email')
+MAX_ATTEMPTS = 6
+RETRY_BASE_S = 60
+RETRY_MAX_S = 6 * 60 * 60
+POLL_INTERVAL_S = 30
+DRAIN_TIMEOUT_S = 5 * 60  # how long drain() waits for the background thread's retry in progress
+SKIPPED = 'skipped'  # handler result: another worker owns this retry
+
+_store = None
+_scheduler = None
+
+
+def backoff(attempts:int) -> float:
+    """Seconds to wait before retry number `attempts` + 1"""
+    delay = min(RETRY_BASE_S * 2 ** max(attempts - 1, 0), RETRY_MAX_S)
+    return delay * random.uniform(0.8, 1.2)
+
+
+class DeadLetterStore:
+    """Response id -> {'id', 'survey_id', 'stage', 'attempts', 'next_attempt', 'exhausted', 'errors', 'state'}"""
+
+    def __init__(self, fp=DEAD_LETTER_FP):
+        self.fp = fp
+        self.entries = {}
+        self._changed = {}  # response id -> entry (None if resolved) not yet merged into the file
+        self._lock = threading.Lock()
+        if os.path.isfile(fp):
+            with open(fp, "r") as file:
+                self.entries = json.load(file)
+
+    def add(self, response_id:str, survey_id:str, stage:str, state:dict, error:str) -> dict:
+        """
+        Park a response that failed `stage` (first retry after backoff(1)). If the id is already parked (e.g. the
+        response was fetched again and failed again), its entry keeps its attempts, schedule and errors -- only the
+        stage and state are refreshed, and the error is added -- so it still reaches MAX_ATTEMPTS.
+        """
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage {stage} -- expected one of {STAGES}")
+        error_entry = {'date': est_now(), 'stage': stage, 'error': error}
+        with self._lock:
+            entry = self.entries.get(response_id)
+            if entry is None:
+                entry = {'id': response_id,
+                         'survey_id': survey_id,
+                         'stage': stage,
+                         'attempts': 1,
+                         'next_attempt': time.time() + backoff(1),
+                         'exhausted': False,
+                         'errors': [error_entry],
+                         'state': state}
+            else:
+                entry = {**entry, 'stage': stage, 'state': state, 'errors': entry['errors'] + [error_entry]}
+            self.entries[response_id] = self._changed[response_id] = entry
+            self._save()
+        logger.warning("SM: %s -- %s failed (%s) -- dead-lettered (attempt %d)", response_id, stage, error, entry['attempts'],
+                       extra={'response_id': response_id, 'stage': stage})
+        return entry
+
+    def due(self, now=None) -> list:
+        """Entries whose next attempt is due, oldest first"""
+        now = time.time() if now is None else now
+        with self._lock:
+            return sorted((entry for entry in self.entries.values() if not entry['exhausted'] and entry['next_attempt'] <= now),
+                          key=lambda entry: entry['next_attempt'])
+
+    def next_due(self):
+        """Epoch seconds of the earliest pending retry, or None"""
+        with self._lock:
+            pending = [entry['next_attempt'] for entry in self.entries.values() if not entry['exhausted']]
+        return min(pending) if pending else None
+
+    def resolve(self, response_id:str) -> None:
+        """Retry succeeded -- drop the entry"""
+        with self._lock:
+            if self.entries.pop(response_id, None) is not None:
+                self._changed[response_id] = None
+                self._save()
+
+    def forget(self, response_id:str) -> None:
+        """Drop an entry from this process only (another worker owns it; the next save brings back whatever it leaves)"""
+        with self._lock:
+            self.entries.pop(response_id, None)
+
+    def fail(self, response_id:str, stage:str, error:str, state=None) -> dict:
+        """
+        Retry failed (at `stage`, which may be later than the entry's stage if earlier stages now succeeded).
+        Schedules the next attempt or marks the entry exhausted after MAX_ATTEMPTS.
+        """
+        with self._lock:
+            entry = self.entries.get(response_id)
+            if entry is None:  # resolved by another worker meanwhile
+                return None
+            entry['stage'] = stage
+            entry['attempts'] += 1
+            entry['errors'].append({'date': est_now(), 'stage': stage, 'error': error})
+            if state is not None:
+                entry['state'] = state
+            if entry['attempts'] >= MAX_ATTEMPTS:
+                entry['exhausted'] = True
+            else:
+                entry['next_attempt'] = time.time() + backoff(entry['attempts'])
+            self._changed[response_id] = entry
+            self._save()
+        if entry['exhausted']:
+            logger.error("SM: %s -- %s failed %d times -- giving up", response_id, stage, entry['attempts'],
+                         extra={'response_id': response_id, 'stage': stage})
+        return entry
+
+    def _save(self) -> None:
+        """Merge this process's changes into the file and rewrite it atomically (caller holds the lock)"""
+        os.makedirs(os.path.dirname(self.fp) or ".", exist_ok=True)
+        with open(self.fp + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = {}
+            if os.path.isfile(self.fp):
+                with open(self.fp, "r") as file:
+                    entries = json.load(file)
+            for response_id, entry in self._changed.items():
+                if entry is None:
+                    entries.pop(response_id, None)
+                else:
+                    entries[response_id] = entry
+            tmp_fp = self.fp + ".tmp"
+            with open(tmp_fp, "w") as file:
+                json.dump(entries, file)
+            os.replace(tmp_fp, self.fp)
+        self.entries = entries
+        self._changed = {}
+
+
+class RetryScheduler:
+    """
+    Daemon thread that hands due dead letters to `handler(entry)` -- so retries never block the live pipeline.
+
+    handler must return None on success, (stage, error, state) for the stage that failed this time, or SKIPPED.
+    """
+
+    def __init__(self, store:DeadLetterStore, handler=None, poll_interval=POLL_INTERVAL_S):
+        self.store = store
+        self.handler = handler
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="dead-letter-retry", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None) -> None:
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def drain(self, timeout=DRAIN_TIMEOUT_S) -> int:
+        """
+        Stop the background thread (letting its retry in progress finish), then retry every due entry in the calling
+        thread -- for short-lived processes (e.g. `python -m modules.main` from cron), which would otherwise exit with
+        retries unrun or cut off mid-retry. Returns the number retried here.
+        """
+        self.stop(timeout)
+        if self._thread is not None and self._thread.is_alive():
+            logger.error("Dead-letter retry still running after %ss -- not draining", timeout)
+            return 0
+        self._stopped.clear()
+        try:
+            return self.run_once()
+        finally:
+            self._stopped.set()
+
+    def wake(self) -> None:
+        """Re-check the store now (e.g. after adding an entry)"""
+        self._wake.set()
+
+    def run_once(self, now=None) -> int:
+        """Retry every due entry. Returns the number retried."""
+        if self.handler is None:
+            return 0
+        entries = self.store.due(now)
+        for entry in entries:
+            if self._stopped.is_set():
+                break
+            try:
+                result = self.handler(entry)
+            except Exception as e:
+                result = (entry['stage'], str(e), None)
+            if result == SKIPPED:
+                self.store.forget(entry['id'])
+            elif result is None:
+                logger.info("SM: %s -- %s retry succeeded (attempt %d)", entry['id'], entry['stage'], entry['attempts'] + 1,
+                            extra={'response_id': entry['id'], 'stage': entry['stage']})
+                self.store.resolve(entry['id'])
+            else:
+                self.store.fail(entry['id'], *result)
+        return len(entries)
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error("Dead-letter retry pass failed -- %s", e)
+            next_due = self.store.next_due()
+            timeout = self.poll_interval if next_due is None else min(self.poll_interval, max(next_due - time.time(), 0))
+            self._wake.wait(timeout)
+            self._wake.clear()
+
+
+def get_store(fp=DEAD_LETTER_FP) -> DeadLetterStore:
+    """Shared store, loaded on first use"""
+    global _store
+    if _store is None:
+        _store = DeadLetterStore(fp)
+    return _store
+
+
+def get_scheduler(handler=None) -> RetryScheduler:
+    """Shared scheduler over the shared store. Passing a handler replaces the current one (e.g. with fresh settings)."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = RetryScheduler(get_store())
+    if handler is not None:
+        _scheduler.handler = handler
+    return _scheduler
@@ -1,14 +1,21 @@
 import json
 import datetime as dt
 
-from .logger import logger
+from .logger import logger, get_logger
 from .utils import load_config, load_json, request, clean_field_text
 from .utils import load_processed_response_ids
+from .normalize import clean_answers
+from .geography import enrich_geography
+from .responses import decode_response, as_response, answer_dict
 
 ## --- For larger/core functions in the app  --- ##
 
+# Per-stage loggers: their DEBUG lines can be sampled with LOG_SAMPLE (see logger.py)
+fetch_logger = get_logger('fetch')
+translate_logger = get_logger('translate')
+
 ## GET/Load question-answer keys for SurveyMonkey Survey and CareerOneStop Skills Matcher
-def get_qa_key(api=None, fetch=False) -> dict:
+def get_qa_key(api=None, fetch=False, survey=None) -> dict:
     """
     Load list of questions/answers from either the Survey Monkey API `/details` endpoint or from CareerOneStop SkillsMatcher.
 
@@ -27,10 +34,12 @@ def get_qa_key(api=None, fetch=False) -> dict:
 
         Note 500 requests/month limit to SM -- if going to use fetch option, may want to only do so periodically.
 
+    survey (dict): SM settings of the survey (see surveys.get_surveys()) -- defaults to the `sm` section of the config
+
     """
     data = load_config()
 
-    SM_DATA = data['sm']
+    SM_DATA = survey if survey is not None else data['sm']
     COS_DATA = data['cos']
 
     # Set SM vs. COS variables
@@ -78,7 +87,7 @@ def get_qa_key(api=None, fetch=False) -> dict:
         return fetched_key
 
 ## Using keys from get_qa_key(), create translation map from Survey Monkey key to COS key
-def combine_qa_keys(fetch=False) -> dict:
+def combine_qa_keys(fetch=False, survey=None) -> dict:
     """
     Creates translation map from SM to COS using the question/answer keys of each.
 
@@ -87,12 +96,19 @@ def combine_qa_keys(fetch=False) -> dict:
     fetch (bool): Setting for get_qa_key() -- whether to only load local cache of question/answer keys or to fetch new copies.
         Used if when a new SurveyMonkey response is retrieved there are unexpected question ids.
 
+    survey (dict): SM settings of the survey to build the map for (default: the `sm` section of the config)
+
     """
     
     # GET/Load answer keys
-    sm_key = get_qa_key("sm", fetch=fetch)
+    sm_key = get_qa_key("sm", fetch=fetch, survey=survey)
     cos_key = get_qa_key("cos", fetch=fetch)
 
+    return build_qa_map(sm_key, cos_key)
+
+def build_qa_map(sm_key:dict, cos_key:dict) -> dict:
+    """Translation map from an SM `/details` key and a COS skills key (see combine_qa_keys(); keydiff.patch_map() updates an existing one)"""
+
     ## Prepare translation map between answer keys
     combined_map = {
         'non-skills-matcher':[], # not to send to COS (background questions)
@@ -103,33 +119,8 @@ def combine_qa_keys(fetch=False) -> dict:
     sm_question_number = 1
     for p in sm_key['pages']:
         for q in p['questions']:
-
-            question_type = 'skills-matcher' if "skills matcher" in p['title'].lower()  else "non-skills-matcher"
-
-            answers = [] # previously answers = None messed with searching arrays
-            if 'choice' in q['family']: # single_choice, multiple_choice
-                # Main answer choices
-                answers = [{'id':{'sm':a['id']}, 'text':{'sm':clean_field_text(a['text'])}} for a in q['answers']['choices']]
-                # 'Other' option
-                if 'other' in q['answers'].keys():
-                    answers.append({
-                        'id':{'sm':q['answers']['other']['id']},
-                        'text':{'sm':clean_field_text(q['answers']['other']['text'])}
-                        })
-            elif q['family'] == 'datetime':
-                answers = [{'id':{'sm':q['answers']['rows'][0]['id']},
-                            'text':{'sm':clean_field_text(q['answers']['rows'][0]['text'])}}]
-
-            combined_map[question_type].append({
-                'question_id':{'sm':q['id']},
-                'page_number': p['position'],
-                'question_number':{'sm':sm_question_number}, # q['position'] gives the question's position on the current page, not its absolute number
-                'question_family':q['family'],
-                'question_text':{'sm':clean_field_text([h['heading'] for h in q['headings']][0])},
-                'question_type':question_type,
-                'answers':answers
-            })
-
+            entry = sm_map_entry(p, q, sm_question_number)
+            combined_map[entry['question_type']].append(entry)
             sm_question_number += 1
 
     if len(combined_map['skills-matcher']) != len(cos_key['Skills']):
@@ -139,25 +130,7 @@ def combine_qa_keys(fetch=False) -> dict:
 
     ## Add COS information
     for n in range(len(combined_map['skills-matcher'])):
-        cos_q = cos_key['Skills'][n]
-        cos_answer_ids = [{'id':cos_q["DataPoint20"], 'text':cos_q['AnchorFirst']},
-                          {'id':cos_q["DataPoint35"], 'text':cos_q['AnchorSecond']},
-                          {'id':cos_q["DataPoint50"], 'text':cos_q['AnchorThrid']},
-                          {'id':cos_q["DataPoint65"], 'text':cos_q['AnchorFourth']},
-                          {'id':cos_q["DataPoint80"], 'text':cos_q['AnchorLast']}]
-
-        combined_map['skills-matcher'][n]['question_id']['cos'] = cos_q['ElementId']
-        combined_map['skills-matcher'][n]['question_number']['cos'] = n + 1 # correcting for 0 index in loop
-        combined_map['skills-matcher'][n]['question_text']['cos'] = cos_q['Question']
-
-        # Add cos answer ids and text
-        if len(combined_map['skills-matcher'][n]['answers']) != len(cos_answer_ids):
-            error_text = f"Number of answer options in SM question #{combined_map['skills-matcher'][n]['question_number']['sm']} != number of COS answer levels."
-            logger.error(error_text)
-            # raise Exception(error_text)
-        for m in range(len(combined_map['skills-matcher'][n]['answers'])):
-            combined_map['skills-matcher'][n]['answers'][m]['id']['cos'] = cos_answer_ids[m]['id']
-            combined_map['skills-matcher'][n]['answers'][m]['text']['cos'] = cos_answer_ids[m]['text']
+        add_cos_fields(combined_map['skills-matcher'][n], cos_key['Skills'][n], n)
 
     ## Casting question lists to dictionary, with keys being the survey monkey question ids, for easier lookup in translation
     # Making these lists to start with made the previous iterate/insertion step easier
@@ -167,6 +140,56 @@ def combine_qa_keys(fetch=False) -> dict:
 
     return combined_map
 
+def sm_map_entry(p:dict, q:dict, sm_question_number:int) -> dict:
+    """Translation map entry (SM fields only) for question `q` on page `p` of the SM key"""
+
+    question_type = 'skills-matcher' if "skills matcher" in p['title'].lower()  else "non-skills-matcher"
+
+    answers = [] # previously answers = None messed with searching arrays
+    if 'choice' in q['family']: # single_choice, multiple_choice
+        # Main answer choices
+        answers = [{'id':{'sm':a['id']}, 'text':{'sm':clean_field_text(a['text'])}} for a in q['answers']['choices']]
+        # 'Other' option
+        if 'other' in q['answers'].keys():
+            answers.append({
+                'id':{'sm':q['answers']['other']['id']},
+                'text':{'sm':clean_field_text(q['answers']['other']['text'])}
+                })
+    elif q['family'] == 'datetime':
+        answers = [{'id':{'sm':q['answers']['rows'][0]['id']},
+                    'text':{'sm':clean_field_text(q['answers']['rows'][0]['text'])}}]
+
+    return {
+        'question_id':{'sm':q['id']},
+        'page_number': p['position'],
+        'question_number':{'sm':sm_question_number}, # q['position'] gives the question's position on the current page, not its absolute number
+        'question_family':q['family'],
+        'question_text':{'sm':clean_field_text([h['heading'] for h in q['headings']][0])},
+        'question_type':question_type,
+        'answers':answers
+    }
+
+def add_cos_fields(entry:dict, cos_q:dict, n:int) -> None:
+    """Pair the n-th skills-matcher map entry with the n-th COS skill `cos_q` (adds the COS ids/text in place)"""
+    cos_answer_ids = [{'id':cos_q["DataPoint20"], 'text':cos_q['AnchorFirst']},
+                      {'id':cos_q["DataPoint35"], 'text':cos_q['AnchorSecond']},
+                      {'id':cos_q["DataPoint50"], 'text':cos_q['AnchorThrid']},
+                      {'id':cos_q["DataPoint65"], 'text':cos_q['AnchorFourth']},
+                      {'id':cos_q["DataPoint80"], 'text':cos_q['AnchorLast']}]
+
+    entry['question_id']['cos'] = cos_q['ElementId']
+    entry['question_number']['cos'] = n + 1 # correcting for 0 index in loop
+    entry['question_text']['cos'] = cos_q['Question']
+
+    # Add cos answer ids and text
+    if len(entry['answers']) != len(cos_answer_ids):
+        error_text = f"Number of answer options in SM question #{entry['question_number']['sm']} != number of COS answer levels."
+        logger.error(error_text)
+        # raise Exception(error_text)
+    for m in range(len(entry['answers'])):
+        entry['answers'][m]['id']['cos'] = cos_answer_ids[m]['id']
+        entry['answers'][m]['text']['cos'] = cos_answer_ids[m]['text']
+
 ## GET all survey responses from Survey monkey API
 def get_sm_survey_responses(per_page=100,
                             start_created_at=None,
@@ -174,7 +197,8 @@ def get_sm_survey_responses(per_page=100,
                             sort_by='date_modified',
                             sort_order='DESC',
                             minimum_minutes=5,
-                            test_mode=False) -> list:
+                            test_mode=False,
+                            survey=None) -> list:
     """
     GET new survey responses from /surveys/{id}/responses/bulk
 
@@ -197,6 +221,10 @@ def get_sm_survey_responses(per_page=100,
 
     test_mode (bool): Whether to load a cached copy of its typical output for testing purposes and to reduce the number of calls to the SM API.
 
+    survey (dict): SM settings of the survey to GET responses for (default: the `sm` section of the config)
+
+    Returns compact responses.SMResponse records; outside test mode each keeps its full item for responses.archive_pending().
+
     """
 
     survey_responses = []
@@ -204,11 +232,10 @@ def get_sm_survey_responses(per_page=100,
 
     if test_mode:
         fp = "data/test_mode_sm_survey_responses.json"
-        logger.debug(f"Loading cached {fp}")
-        survey_responses = load_json(fp)
+        fetch_logger.debug("Loading cached %s", fp)
+        survey_responses = [decode_response(item) for item in load_json(fp)]
     else:
-        data = load_config()
-        SM_DATA = data['sm']
+        SM_DATA = survey if survey is not None else load_config()['sm']
         url = SM_DATA['base_url'] + "/responses/bulk"
 
         params = {"per_page":str(per_page),
@@ -217,8 +244,8 @@ def get_sm_survey_responses(per_page=100,
                   "total_time_units":"minute",
                   "sort_by":sort_by,
                   "sort_order":sort_order}
-        
-        print(params)
+
+        fetch_logger.debug("GET %s -- %s", url, params)
 
         if isinstance(start_created_at, dt.datetime): # i.e. if not None and a valid datetime object
             try:
@@ -244,7 +271,8 @@ def get_sm_survey_responses(per_page=100,
                 raise Exception(error_message + f" (Status: {response.status_code})")
             else:
                 current_response_page = response.json()
-                survey_responses.extend(current_response_page['data'])
+                survey_responses.extend(decode_response(item, keep_raw=True) for item in current_response_page['data'])
+                fetch_logger.debug("GET %s -- %d responses", url, len(current_response_page['data']))
 
             # Checks for any additional pages listed in the current SM response page
             if 'links' in current_response_page.keys() and 'next' in current_response_page['links'].keys():
@@ -261,23 +289,27 @@ def get_sm_survey_responses(per_page=100,
     return survey_responses
 
 ## Add information from combined answer key to these responses
-def translate_sm_response(resp:dict, combined_map:dict) -> dict:
+def translate_sm_response(resp, combined_map:dict, collector_name=None) -> dict:
     """
-    "Translate" a raw SM survey response from get_sm_survey_responses() to a combined response format
+    "Translate" a SM survey response from get_sm_survey_responses() (responses.SMResponse, or a raw/compact dict) to a combined response format
         - Adds combined question/answer information from both the SurveyMonkey and COS answer keys
+        - collector_name: from utils.get_collector_name() (looked up by the caller, so translation never makes requests)
     """
+    resp = as_response(resp)
 
     resp_dict = {
-    'response_id':resp['id'],
-    'collector_id':resp['collector_id'], # TO-DO: write function to include collector name
+    'response_id':resp.id,
+    'collector_id':resp.collector_id,
+    'collector_name':collector_name,
     'questions':[]
     }
 
     # Get question_answer key from current response
-    resp_question_answers = {q['id']:q['answers'] for p in resp['pages'] for q in p['questions']}
+    resp_question_answers = resp.answer_map()
 
     ## Add matching questions information from combined qa key
     for q_map in list(combined_map['non-skills-matcher'].values()) + list(combined_map['skills-matcher'].values()):
+        q_map = dict(q_map) # shallow copy, so the same combined_map can be reused across responses
 
         # If current question is omitted from the response, auto-fill from question answer key
         if q_map['question_id']['sm'] not in resp_question_answers.keys():
@@ -290,25 +322,27 @@ def translate_sm_response(resp:dict, combined_map:dict) -> dict:
             q_map_answer_key = {a['id']['sm']:a for a in q_map['answers']}
             answers = []
 
-            for a in resp_question_answers[q_map['question_id']['sm']]:
-                if 'choice_id' in a.keys():
-                    answers.append(q_map_answer_key[a['choice_id']])
-                elif 'other_id' or 'row_id' in a.keys():
+            for choice_id, other_id, row_id, text in resp_question_answers[q_map['question_id']['sm']]:
+                if choice_id is not None:
+                    answers.append(q_map_answer_key[choice_id])
+                elif other_id is not None or row_id is not None:
                     # These questions have text in them which we need to clean, so treated differently from 'choice_id'
-                    alt_id = 'other_id' if 'other_id' in a.keys() else 'row_id'
-                    answers.append({'id':{'sm':a[alt_id]}, 'text':{'sm':clean_field_text(a['text'])}})
+                    alt_id = other_id if other_id is not None else row_id
+                    answers.append({'id':{'sm':alt_id}, 'text':{'sm':clean_field_text(text)}})
                 else:
-                    logger.warning(f"New kind of question and answer was added ({a})-- survey must have been changed")
-                    answers.append(a)
+                    logger.warning(f"New kind of question and answer was added ({text})-- survey must have been changed")
+                    answers.append(answer_dict((choice_id, other_id, row_id, text)))
 
             q_map['answers'] = answers
 
         else:
-            q_map['answers'] = resp_question_answers[q_map['question_id']['sm']]
-            for a in q_map['answers']:
-                if 'text' in a.keys():
-                    a['text'] = clean_field_text(a['text'])
+            q_map['answers'] = clean_answers([answer_dict(a) for a in resp_question_answers[q_map['question_id']['sm']]])
 
         resp_dict['questions'].append(q_map)
 
+    # Attach county/tract codes for the respondent's ZIP code (offline index lookup)
+    enrich_geography(resp_dict)
+    translate_logger.debug("SM: %s -- translated %d questions (%d auto-filled)", resp.id, len(resp_dict['questions']),
+                           sum(1 for q in resp_dict['questions'] if q.get('auto_filled')))
+
     return resp_dict
@@ -0,0 +1,147 @@
+import argparse
+import array
+import bisect
+import csv
+import mmap
+import os
+import sys
+
+from .logger import logger
+
+#### --- Offline ZIP code (ZCTA) -> county / census tract lookup --- ####
+## Build once from the Census 2020 ZCTA relationship files, e.g.
+##   https://www2.census.gov/geo/docs/maps-data/data/rel2020/zcta520/tab20_zcta520_county20_natl.txt
+##   https://www2.census.gov/geo/docs/maps-data/data/rel2020/zcta520/tab20_zcta520_tract20_natl.txt
+## python -m modules.geography --county tab20_zcta520_county20_natl.txt --tract tab20_zcta520_tract20_natl.txt
+##
+## Index layout (native byte order): 16-byte header, then three parallel arrays sorted by ZCTA:
+##   uint32 zcta[n] | uint32 county_geoid[n] | uint64 tract_geoid[n]
+## At runtime the file is memory-mapped and searched with bisect -- no parsing, no network.
+
+INDEX_FP = "data/geography/zcta-index.bin"
+MAGIC = b"ZCTA"
+FORMAT_VERSION = 1
+HEADER_SIZE = 16
+
+_index = None  # loaded on first lookup
+
+
+def _primary_parts(fp:str, geoid_prefix:str) -> dict:
+    """
+    Read a ZCTA relationship file into {zcta: geoid} keeping, for each ZCTA,
+    the county/tract that holds the largest share of its land area.
+    """
+    best = {}
+    with open(fp, "r", encoding="utf-8-sig", newline="") as file:
+        reader = csv.DictReader(file, delimiter="|")
+        zcta_column = next(c for c in reader.fieldnames if c.startswith("GEOID_ZCTA5"))
+        geoid_column = next(c for c in reader.fieldnames if c.startswith(geoid_prefix))
+        for row in reader:
+            zcta, geoid = row[zcta_column], row[geoid_column]
+            if not zcta or not geoid:
+                continue
+            area = int(row.get("AREALAND_PART") or 0)
+            if int(zcta) not in best or area > best[int(zcta)][0]:
+                best[int(zcta)] = (area, int(geoid))
+    return {zcta: geoid for zcta, (_, geoid) in best.items()}
+
+
+def build_index(county_fp:str, tract_fp=None, output_fp=INDEX_FP) -> int:
+    """
+    Build the lookup index from Census ZCTA relationship files.
+
+    Args:
+
+    county_fp (str): ZCTA-to-county relationship file (pipe-delimited)
+
+    tract_fp (str): ZCTA-to-tract relationship file (optional -- tracts are 0/None without it)
+
+    output_fp (str): Where to write the index
+
+    Returns the number of ZCTAs indexed.
+    """
+    counties = _primary_parts(county_fp, "GEOID_COUNTY")
+    tracts = _primary_parts(tract_fp, "GEOID_TRACT") if tract_fp else {}
+    zctas = sorted(set(counties) | set(tracts))
+
+    header = MAGIC + bytes([FORMAT_VERSION, sys.byteorder == "little", 0, 0]) + len(zctas).to_bytes(8, sys.byteorder)
+    os.makedirs(os.path.dirname(output_fp) or ".", exist_ok=True)
+    with open(output_fp, "wb") as file:
+        file.write(header)
+        array.array("I", zctas).tofile(file)
+        array.array("I", (counties.get(z, 0) for z in zctas)).tofile(file)
+        array.array("Q", (tracts.get(z, 0) for z in zctas)).tofile(file)
+
+    logger.info("Wrote %s (%d ZCTAs)", output_fp, len(zctas))
+    return len(zctas)
+
+
+class ZctaIndex:
+    """Memory-mapped view over an index written by build_index()"""
+
+    def __init__(self, fp=INDEX_FP):
+        with open(fp, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = self._mmap[:HEADER_SIZE]
+        if header[:4] != MAGIC or header[4] != FORMAT_VERSION or bool(header[5]) != (sys.byteorder == "little"):
+            raise ValueError(f"{fp} is not a compatible ZCTA index -- rebuild it with build_index()")
+        n = int.from_bytes(header[8:16], sys.byteorder)
+        view = memoryview(self._mmap)
+        self.zctas = view[HEADER_SIZE:HEADER_SIZE + 4 * n].cast("I")
+        self.counties = view[HEADER_SIZE + 4 * n:HEADER_SIZE + 8 * n].cast("I")
+        self.tracts = view[HEADER_SIZE + 8 * n:HEADER_SIZE + 16 * n].cast("Q")
+
+    def __len__(self):
+        return len(self.zctas)
+
+    def lookup(self, zip_code):
+        """{'zcta', 'county', 'tract'} GEOID strings for a ZIP code, or None if it isn't a known ZCTA"""
+        try:
+            zcta = int(str(zip_code).strip()[:5])
+        except ValueError:
+            return None
+        i = bisect.bisect_left(self.zctas, zcta)
+        if i == len(self.zctas) or self.zctas[i] != zcta:
+            return None
+        return {'zcta': f"{zcta:05d}",
+                'county': f"{self.counties[i]:05d}" if self.counties[i] else None,
+                'tract': f"{self.tracts[i]:011d}" if self.tracts[i] else None}
+
+
+def get_index(fp=INDEX_FP):
+    """Shared index, opened on first use. None if the index hasn't been built."""
+    global _index
+    if _index is None:
+        if not os.path.isfile(fp):
+            fp = os.path.join(os.path.abspath(os.path.pardir), fp)
+        if not os.path.isfile(fp):
+            logger.debug("No ZCTA index at %s -- skipping geography enrichment", INDEX_FP)
+            _index = False
+        else:
+            _index = ZctaIndex(fp)
+    return _index or None
+
+
+## Enrichment stage for translate_sm_response() output
+def enrich_geography(processed_resp:dict) -> dict:
+    """Attach {'zcta', 'county', 'tract'} (or None) for the respondent's ZIP code answer. Returns processed_resp."""
+    geography = None
+    index = get_index()
+    if index is not None:
+        for q in processed_resp['questions']:
+            if 'zip code' in q['question_text']['sm'].lower():
+                if q.get('answers'):
+                    geography = index.lookup(q['answers'][0].get('text', ''))
+                break
+    processed_resp['geography'] = geography
+    return processed_resp
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the ZIP code -> county/tract index from Census relationship files")
+    parser.add_argument("--county", required=True, help="tab20_zcta520_county20_natl.txt")
+    parser.add_argument("--tract", default=None, help="tab20_zcta520_tract20_natl.txt")
+    parser.add_argument("--output", default=INDEX_FP)
+    args = parser.parse_args()
+
+    build_index(args.county, args.tract, args.output)
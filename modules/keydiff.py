@@ -0,0 +1,154 @@
+import argparse
+import json
+
+from .logger import logger
+from .funcs import sm_map_entry, add_cos_fields
+
+#### --- Structural diff of SM/COS question keys, and incremental patching of the translation map --- ####
+## Questions are matched by id (SM question id, COS ElementId) and compared on the fields the translation map is
+## built from, so cosmetic changes to a key (hrefs, layout options) are not changes. patch_map() then rebuilds only
+## the entries that changed -- unchanged entries are reused as-is, renumbered if questions were added/removed
+## before them, and skills-matcher entries are re-paired with COS only where the positional pairing moved.
+##
+## python -m modules.keydiff --sm old-sm-key.json new-sm-key.json  -- print the diff
+
+COS_FIELDS = ('Question', 'AnchorFirst', 'AnchorSecond', 'AnchorThrid', 'AnchorFourth', 'AnchorLast',
+              'DataPoint20', 'DataPoint35', 'DataPoint50', 'DataPoint65', 'DataPoint80')
+SM_FIELDS = ('question_type', 'page_number', 'question_family', 'question_text')
+
+
+def _sm_questions(sm_key:dict) -> dict:
+    """SM question id -> (page, question), in survey order"""
+    return {q['id']: (p, q) for p in sm_key['pages'] for q in p['questions']}
+
+
+def _diff_answers(old_answers:list, new_answers:list) -> dict:
+    old = {a['id']['sm']: a['text']['sm'] for a in old_answers}
+    new = {a['id']['sm']: a['text']['sm'] for a in new_answers}
+    return {'added': [a for a in new if a not in old],
+            'removed': [a for a in old if a not in new],
+            'changed': [a for a in new if a in old and old[a] != new[a]],
+            'reordered': [a for a in old if a in new] != [a for a in new if a in old]}
+
+
+def _reordered(old_ids, new_ids) -> bool:
+    new_ids = list(new_ids)
+    common = set(old_ids) & set(new_ids)
+    return [i for i in old_ids if i in common] != [i for i in new_ids if i in common]
+
+
+def diff_sm_keys(old_key:dict, new_key:dict) -> dict:
+    """
+    {'added': [question ids], 'removed': [...], 'reordered': bool,
+     'changed': {question id: {'fields': [map fields], 'answers': {'added', 'removed', 'changed', 'reordered'}}}}
+    """
+    old_questions, new_questions = _sm_questions(old_key), _sm_questions(new_key)
+    changed = {}
+    for question_id, (p, q) in new_questions.items():
+        if question_id not in old_questions:
+            continue
+        old_p, old_q = old_questions[question_id]
+        if q == old_q and p['title'] == old_p['title'] and p['position'] == old_p['position']:
+            continue
+        old_entry, new_entry = sm_map_entry(old_p, old_q, 0), sm_map_entry(p, q, 0)
+        fields = [field for field in SM_FIELDS if old_entry[field] != new_entry[field]]
+        answers = _diff_answers(old_entry['answers'], new_entry['answers'])
+        if fields or any(answers.values()):
+            changed[question_id] = {'fields': fields, 'answers': answers}
+
+    return {'added': [i for i in new_questions if i not in old_questions],
+            'removed': [i for i in old_questions if i not in new_questions],
+            'changed': changed,
+            'reordered': _reordered(old_questions, new_questions)}
+
+
+def diff_cos_keys(old_key:dict, new_key:dict) -> dict:
+    """{'added': [ElementIds], 'removed': [...], 'changed': {ElementId: [COS fields]}, 'reordered': bool}"""
+    old_skills = {skill['ElementId']: skill for skill in old_key['Skills']}
+    new_skills = {skill['ElementId']: skill for skill in new_key['Skills']}
+    changed = {}
+    for element_id, skill in new_skills.items():
+        if element_id in old_skills:
+            fields = [field for field in COS_FIELDS if old_skills[element_id].get(field) != skill.get(field)]
+            if fields:
+                changed[element_id] = fields
+    return {'added': [i for i in new_skills if i not in old_skills],
+            'removed': [i for i in old_skills if i not in new_skills],
+            'changed': changed,
+            'reordered': _reordered(old_skills, new_skills)}
+
+
+def is_empty(diff:dict) -> bool:
+    return not (diff['added'] or diff['removed'] or diff['changed'] or diff['reordered'])
+
+
+def summarize(diff:dict) -> str:
+    """One-line description of a diff from diff_sm_keys() or diff_cos_keys()"""
+    if is_empty(diff):
+        return "no changes"
+    parts = [f"{len(diff[k])} {k} ({', '.join(map(str, diff[k]))})" for k in ('added', 'removed', 'changed') if diff[k]]
+    if diff['reordered']:
+        parts.append("reordered")
+    return "; ".join(parts)
+
+
+def patch_map(combined_map:dict, old_sm_key:dict, new_sm_key:dict, old_cos_key:dict, new_cos_key:dict) -> tuple:
+    """
+    Update a translation map built (by funcs.build_qa_map()) from the old keys to match the new keys.
+
+    Returns (new map, {'sm': sm diff, 'cos': cos diff, 'rebuilt': number of entries rebuilt}). `combined_map` is
+    not modified, and is returned unchanged if neither key changed.
+    """
+    sm_diff, cos_diff = diff_sm_keys(old_sm_key, new_sm_key), diff_cos_keys(old_cos_key, new_cos_key)
+    result = {'sm': sm_diff, 'cos': cos_diff, 'rebuilt': 0}
+    if is_empty(sm_diff) and is_empty(cos_diff):
+        return combined_map, result
+
+    stale = set(sm_diff['added']) | set(sm_diff['changed'])
+    cos_stale = set(cos_diff['added']) | set(cos_diff['changed'])
+    cos_skills = new_cos_key['Skills']
+
+    new_map = {'non-skills-matcher': {}, 'skills-matcher': {}}
+    sm_question_number = 1
+    skills_n = 0
+    for p in new_sm_key['pages']:
+        for q in p['questions']:
+            entry = combined_map['skills-matcher'].get(q['id']) or combined_map['non-skills-matcher'].get(q['id'])
+            rebuilt = entry is None or q['id'] in stale
+            if rebuilt:
+                entry = sm_map_entry(p, q, sm_question_number)
+            elif entry['question_number']['sm'] != sm_question_number: # questions added/removed before this one
+                entry = {**entry, 'question_number': {**entry['question_number'], 'sm': sm_question_number}}
+
+            if entry['question_type'] == 'skills-matcher' and skills_n < len(cos_skills):
+                cos_q = cos_skills[skills_n]
+                if rebuilt or cos_q['ElementId'] in cos_stale or entry['question_id'].get('cos') != cos_q['ElementId'] \
+                        or entry['question_number'].get('cos') != skills_n + 1:
+                    if not rebuilt: # fresh SM fields, so the COS fields of the old pairing don't linger
+                        entry = sm_map_entry(p, q, sm_question_number)
+                        rebuilt = True
+                    add_cos_fields(entry, cos_q, skills_n)
+            if entry['question_type'] == 'skills-matcher':
+                skills_n += 1
+
+            result['rebuilt'] += rebuilt
+            new_map[entry['question_type']][q['id']] = entry
+            sm_question_number += 1
+
+    if skills_n != len(cos_skills):
+        logger.error(f"ERROR: No. of skills-matcher questions retrieved from SM {skills_n} doesn't match number in COS {len(cos_skills)}")
+
+    return new_map, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Diff two versions of a SurveyMonkey or CareerOneStop question key")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--sm", nargs=2, metavar=("OLD", "NEW"), help="SM /details keys")
+    group.add_argument("--cos", nargs=2, metavar=("OLD", "NEW"), help="COS skills keys")
+    args = parser.parse_args()
+
+    differ = diff_sm_keys if args.sm else diff_cos_keys
+    old_fp, new_fp = args.sm or args.cos
+    with open(old_fp, "r") as old_file, open(new_fp, "r") as new_file:
+        print(json.dumps(differ(json.load(old_file), json.load(new_file)), indent=2))
@@ -0,0 +1,149 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from .logger import logger
+
+#### --- Expiring leases on SM response ids, so several main() processes can share the work --- ####
+## Before processing, a worker claims a batch of response ids. A claim succeeds for ids nobody holds, or whose
+## lease has expired (the worker holding it died); ids marked done are never claimed again. Each claim is one
+## SQLite write transaction, so two workers can never both hold an id -- and a respondent is POSTed to COS and
+## emailed once, however many app.py/main() processes run on the box.
+##
+## data/leases.sqlite3:  leases(key PRIMARY KEY, worker, expires, done)
+##
+## While a worker processes its batch, a Heartbeat renews the batch's leases every LEASE_S / 3, so a slow COS POST
+## or SMTP send (both time out -- see utils.REQUEST_TIMEOUT_S) never lets another worker claim the same id.
+
+LEASE_FP = "data/leases.sqlite3"
+LEASE_S = 300  # a claimed id is freed for other workers this long after its last renewal
+CLAIM_BATCH = 20
+
+HOSTNAME = socket.gethostname()
+
+_store = None
+
+
+def worker_id() -> str:
+    """
+    Lease holder: this process *and thread* (concurrent /webhook calls in one process mustn't share leases).
+    The pid is read on every call, so forked workers never inherit their parent's id.
+    """
+    return f"{HOSTNAME}:{os.getpid()}:{threading.get_ident()}"
+
+
+class LeaseStore:
+    """
+    Leases on string keys (response ids), shared by every process using the same SQLite file.
+
+    A connection is opened per call, so one store can be used from any thread.
+    """
+
+    def __init__(self, fp=LEASE_FP, lease_s=LEASE_S):
+        self.fp = fp
+        self.lease_s = lease_s
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.fp) or ".", exist_ok=True)
+        db = sqlite3.connect(self.fp, timeout=30, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, worker TEXT, expires REAL, done INTEGER NOT NULL DEFAULT 0)")
+        return db
+
+    def claim(self, keys:list, worker=None, limit=CLAIM_BATCH) -> list:
+        """Claim up to `limit` of `keys` (in order) that are free or expired. Returns the claimed keys."""
+        worker = worker or worker_id()
+        claimed = []
+        now = time.time()
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")  # one writer at a time: claims never interleave
+            for key in keys:
+                if len(claimed) >= limit:
+                    break
+                cursor = db.execute("""INSERT INTO leases (key, worker, expires) VALUES (?, ?, ?)
+                                       ON CONFLICT(key) DO UPDATE SET worker = excluded.worker, expires = excluded.expires
+                                       WHERE leases.done = 0 AND (leases.expires < ? OR leases.worker = excluded.worker)""",
+                                    (key, worker, now + self.lease_s, now))
+                if cursor.rowcount:
+                    claimed.append(key)
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+        return claimed
+
+    def renew(self, keys:list, worker=None) -> None:
+        """Push back the expiry of leases `worker` holds"""
+        worker = worker or worker_id()
+        self._execute_many("UPDATE leases SET expires = ? WHERE key = ? AND worker = ? AND done = 0",
+                           [(time.time() + self.lease_s, key, worker) for key in keys])
+
+    def complete(self, keys:list, worker=None) -> None:
+        """Mark keys `worker` holds as done -- no worker will claim them again"""
+        worker = worker or worker_id()
+        self._execute_many("UPDATE leases SET done = 1 WHERE key = ? AND worker = ?", [(key, worker) for key in keys])
+
+    def release(self, keys:list, worker=None) -> None:
+        """Give up leases without completing them (free for any worker to claim straight away)"""
+        worker = worker or worker_id()
+        self._execute_many("DELETE FROM leases WHERE key = ? AND worker = ? AND done = 0", [(key, worker) for key in keys])
+
+    def _execute_many(self, sql:str, params:list) -> None:
+        if not params:
+            return
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany(sql, params)
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+
+class Heartbeat:
+    """
+    Context manager that renews `keys` every `interval` seconds (default lease_s / 3) from a background thread
+    while the block runs. Leases are renewed as the worker that entered the block (the thread's own id differs).
+    """
+
+    def __init__(self, store:LeaseStore, keys:list, worker=None, interval=None):
+        self.store = store
+        self.keys = list(keys)
+        self.worker = worker or worker_id()
+        self.interval = interval or store.lease_s / 3
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name="lease-heartbeat", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:  # done keys are left alone by renew()
+                self.store.renew(self.keys, worker=self.worker)
+            except Exception as e:
+                logger.error("Renewing %d leases failed -- %s", len(self.keys), e)
+
+
+def get_store(fp=LEASE_FP) -> LeaseStore:
+    """Shared store, created on first use"""
+    global _store
+    if _store is None:
+        _store = LeaseStore(fp)
+        logger.debug("Leases at %s", fp)
+    return _store
@@ -1,25 +1,156 @@
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import random
 
-LOG_FILE = "logs/log_file.txt"
+LOG_FILE = os.environ.get("LOG_FILE", "logs/log_file.txt")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "DEBUG")
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+## Fraction of DEBUG lines kept per stage, e.g. LOG_SAMPLE="request=0.1,translate=0.01"
+# Stages are the get_logger() children: fetch, surveys, translate, request, cos, email. Stages without an entry
+# (and the app logger itself) keep every line. INFO and above are never sampled.
+DEBUG_SAMPLE_RATES = {}
+for item in filter(None, os.environ.get("LOG_SAMPLE", "").split(",")):
+    stage, _, rate = item.partition("=")
+    DEBUG_SAMPLE_RATES[stage.strip()] = float(rate)
+
+
+## Formatters
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line. Any `extra={...}` fields passed to the logger are included."""
+
+    RESERVED = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'raw'}
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in self.RESERVED})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable console lines. Records logged through log_format() are written as-is."""
+
+    def format(self, record):
+        if getattr(record, 'raw', False):
+            return record.getMessage()
+        return super().format(record)
+
+
+## Filters
+class StageSampler(logging.Filter):
+    """Keep only a fraction of DEBUG records per stage (the last component of the logger name)."""
+
+    def __init__(self, rates:dict):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or not self.rates:
+            return True
+        rate = self.rates.get(record.name.rsplit('.', 1)[-1])
+        return rate is None or random.random() < rate
+
+
+class DropRaw(logging.Filter):
+    """Keep log_format() dividers out of the JSON sink."""
+
+    def filter(self, record):
+        return not getattr(record, 'raw', False)
+
+
+## Queue handler -- the calling thread only enqueues the record; formatting and I/O happen on the listener thread
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that skips the eager format in prepare(), so timestamps/JSON/tracebacks are only rendered by the
+    listener. The message itself (msg % args) is still merged here, before the caller can mutate the args.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class InlineQueue:
+    """Stand-in for the log queue in forked child processes: records go straight to the sinks, on the caller's thread"""
+
+    def __init__(self, listener):
+        self.listener = listener
+
+    def put_nowait(self, record):
+        self.listener.handle(record)
+
+    def qsize(self):
+        return 0
+
+
+def _file_handler(fp:str):
+    """Rotating JSON-lines file sink (None if the log directory can't be created)"""
+    try:
+        os.makedirs(os.path.dirname(fp) or ".", exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(fp, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    except OSError:
+        return None
+    handler.setFormatter(JsonFormatter())
+    handler.addFilter(DropRaw())
+    return handler
 
 
 ## Actual Logger
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
 
 stream_handler = logging.StreamHandler()
-stream_handler.setFormatter(formatter)
-logger.addHandler(stream_handler)
-
-# file_handler = logging.FileHandler(LOG_FILE)
-# file_handler.setFormatter(formatter)
-# logger.addHandler(file_handler)
-
-## For writing formatting text to the logfile for enhanced human readability
-# def log_format(text:str):
-#     """Writes any string to the log file and console without additional logger formatting."""
-#     with open(LOG_FILE, "a") as file:
-#         file.write(str(text) + "\n")
-#     print(str(text) + "\n")
\ No newline at end of file
+stream_handler.setFormatter(TextFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+sinks = [stream_handler]
+
+file_handler = _file_handler(LOG_FILE)
+if file_handler is not None:
+    sinks.append(file_handler)
+
+log_queue = queue.SimpleQueue()
+queue_handler = LazyQueueHandler(log_queue)
+queue_handler.addFilter(StageSampler(DEBUG_SAMPLE_RATES))
+logger.addHandler(queue_handler)
+
+listener = logging.handlers.QueueListener(log_queue, *sinks, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
+
+
+def _log_inline_in_child():
+    """
+    A forked child (e.g. a backfill worker) inherits the queue but not the listener thread, and may exit through
+    os._exit() without running atexit -- so it writes its records directly instead
+    """
+    global log_queue
+    log_queue = InlineQueue(listener)
+    queue_handler.queue = log_queue
+
+os.register_at_fork(after_in_child=_log_inline_in_child)
+
+
+def get_logger(stage:str) -> logging.Logger:
+    """Child logger for a pipeline stage (e.g. 'request', 'translate'). Its DEBUG lines are sampled per LOG_SAMPLE."""
+    return logger.getChild(stage)
+
+
+## For writing formatting text to the console for enhanced human readability
+def log_format(text:str):
+    """Writes any string to the console without additional logger formatting (dropped from the JSON log file)."""
+    logger.info(str(text), extra={'raw': True})
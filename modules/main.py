@@ -1,113 +1,306 @@
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 
 from .logger import logger, log_format
-from .utils import load_config, est_now
+from .metrics import timed, RESPONSES
+from .utils import load_config, est_now, get_collector_name
 from .utils import check_unexpected_question_ids, get_email_address, check_email_address, post_cos, send_email
-from .funcs import get_sm_survey_responses, combine_qa_keys, translate_sm_response
+from .funcs import get_sm_survey_responses, translate_sm_response
+from .occupations import get_store, compact_jobs
+from .surveys import get_surveys, get_translation_map
+from .responses import as_response, archive_pending, discard_pending
+from .categories import categorize_answers, get_models
+from .skillmatrix import get_matrix
+from . import deadletter, leases, profiling
+
+DIVIDER = "\n" + '--------' * 15 + "\n"
+OUTPUT_FP = "data/survey-responses.json"
+
+_output_lock = threading.Lock()
+
+def store_record(record:dict) -> None:
+    """Append a response record to the db file. A later row for the same id (e.g. after a retry) supersedes earlier ones."""
+    row = json.dumps(record) + '\n'
+    with timed('store'), _output_lock:
+        with open(OUTPUT_FP, "a") as output_file:
+            output_file.write(row)
+
+def process_response(resp:dict, survey:dict, settings:dict, categories=None):
+    """
+    Translate one SM response, POST it to COS, email the respondent and store the record.
+
+    resp (responses.SMResponse): from get_sm_survey_responses()
+
+    categories (dict): The response's categorize_answers() result, computed with its batch (see process_survey()) --
+        categorized here if not given, or if the translation map had to be refreshed
+
+    Returns None, or (stage, error, state) for the stage that failed -- state is what deadletter needs to resume there.
+    """
+    TEST_MODE = settings['test_mode']
+
+    logger.info("Processing SM Response #%s (%s)", resp['id'], survey['name'], extra={'response_id': resp['id'], 'survey': survey['name']})
+    # Load translation map (cached per survey)
+    with timed('combine_qa_keys'):
+        combined_map = get_translation_map(survey)
+
+    # Check response versus translation map for unexpected question ids in sm_survey_responses
+    unexpected_question_ids = check_unexpected_question_ids(resp, combined_map)
+    retries = 0
+    while len(unexpected_question_ids) > 0 and retries <= 2:
+        logger.warning("SM: %s -- %d unexpected question ids: %s -- Refreshing question/answer key map.", resp['id'], len(unexpected_question_ids), unexpected_question_ids)
+        # Update current version of translation map
+        with timed('combine_qa_keys'):
+            combined_map = get_translation_map(survey, fetch=True)
+        # Check for unexpected ids again
+        unexpected_question_ids = check_unexpected_question_ids(resp, combined_map)
+        retries += 1
+        categories = None # questions may have changed
+
+    # If there are still unexpected ids after retrying
+    if len(unexpected_question_ids) > 0:
+        logger.warning("Unable to reconcile questions from SM response %s with COS key. Skipping.", resp['id'])
+        RESPONSES.inc(outcome='unexpected_question_ids')
+        return 'translate', f"unexpected question ids: {sorted(unexpected_question_ids)}", {'raw': resp.to_dict()}
+
+    # Process survey response
+    collector_name = get_collector_name(resp['collector_id'], survey=survey, test_mode=TEST_MODE)
+    with timed('translate_sm_response'):
+        processed_resp = translate_sm_response(resp, combined_map, collector_name=collector_name)
+    if categories is None:
+        with timed('categorize'):
+            categories = categorize_answers([resp], combined_map, models=settings['category_models'])[0]
+    processed_resp['categories'] = categories
+    with timed('skill_matrix'):
+        try:
+            get_matrix(combined_map).add_responses([processed_resp], combined_map)
+        except Exception: # derived data (rebuildable with `python -m modules.skillmatrix --build`) -- carry on
+            logger.exception("SM: %s -- adding to the skill matrix failed", resp['id'])
+    with timed('check_email_address'):
+        email_address = get_email_address(resp)
+        has_valid_email, error_message = check_email_address(email_address, check_deliverability=settings['check_deliverability'])
+
+    if not has_valid_email:
+        logger.warning("SM: %s has invalid email address (%s) -- %s. Skipping send.", processed_resp['response_id'], email_address, error_message)
+
+    state = {'raw': resp.to_dict(), 'processed_resp': processed_resp, 'email_address': email_address,
+             'has_valid_email': has_valid_email, 'valid_status': error_message}
+    return contact_respondent(survey['id'], state, settings)
+
+def contact_respondent(survey_id:str, state:dict, settings:dict, cos_response=None):
+    """
+    POST to COS and email recommended jobs (only the send if `cos_response` is given), then store the record.
+
+    Returns None, or (stage, error, state) if the COS POST or the send failed.
+    """
+    TEST_MODE = settings['test_mode']
+    resp, processed_resp, email_address = state['raw'], state['processed_resp'], state['email_address']
+
+    contact_result = False
+    failure = None
+    rec_jobs = []
+    ranked_jobs = []
+    engine = None
+    if state['has_valid_email']:
+        valid_status = "y"
+        if cos_response is None:
+            with timed('post_cos'):
+                cos_response = post_cos(processed_resp, test_mode=TEST_MODE, fallback=settings['local_scoring_fallback'])
+
+        # Email if POST successful
+        if cos_response != {}:
+
+            rec_jobs = [job['OccupationTitle'] for job in cos_response['SKARankList']]
+            ranked_jobs = compact_jobs(cos_response)
+            engine = cos_response.get('ScoringEngine', 'cos') # 'local' if ranked by the scoring fallback
+            settings['occupations'].update(cos_response['SKARankList'])
+            logger.info("SM: %s -- %d recommended jobs.", processed_resp['response_id'], len(rec_jobs))
+
+            with timed('send_email'):
+                contact_result = send_email(test_mode=TEST_MODE,
+                            response_id=processed_resp['response_id'],
+                            cos_response=cos_response,
+                            sender=settings['sender_email'],
+                            app_password=settings['app_password'],
+                            recipient=email_address,
+                            **settings['smtp'])
+            if not contact_result:
+                failure = 'send_email', "send failed", {**state, 'cos_response': cos_response}
+        else:
+            failure = 'post_cos', "no COS response", state
+    else:
+        valid_status = state['valid_status']
+
+    ## Create and append response record to db file
+    update_dict = {
+        "id": resp['id'],
+        "survey_id": survey_id,
+        "date_added": est_now(),
+        "raw": resp, # compact (responses.SMResponse.to_dict()) -- full item via responses.load_raw(resp['raw_ref'])
+        "processed":processed_resp,
+        "jobs":{"n":len(rec_jobs),"top":[],"ranked":ranked_jobs, # ranked: (OnetCode, Rank, Score) -- details in data/occupations.json
+                "engine":engine}, # 'cos', or 'local' for modules/scoring.py's fallback
+        "email": {"address": email_address,
+                  "valid_status":valid_status,
+                  "contacted":contact_result},
+    }
+    if len(rec_jobs) > 0:
+        update_dict['jobs']['top'] = rec_jobs[:min(len(rec_jobs),10)]
+
+    logger.info("SM: %s -- stored (%d jobs, email %s)", resp['id'], update_dict['jobs']['n'], valid_status,
+                extra={'response_id': resp['id'], 'top_jobs': update_dict['jobs']['top'], 'email': update_dict['email']})
+    store_record(update_dict)
+    RESPONSES.inc(outcome='contacted' if contact_result else 'not_contacted')
 
-def main():
+    log_format(DIVIDER)
+    return failure
+
+def retry_dead_letter(entry:dict, settings:dict):
+    """deadletter.RetryScheduler handler: resume a parked response at the stage it failed"""
+    # Each attempt is leased, so with several worker processes only one of them makes it
+    lease_store = leases.get_store() if not settings['test_mode'] else None
+    lease_key = f"retry:{entry['id']}:{entry['attempts']}"
+    if lease_store is not None and not lease_store.claim([lease_key]):
+        return deadletter.SKIPPED
+    try:
+        with leases.Heartbeat(lease_store, [lease_key]) if lease_store is not None else nullcontext():
+            state = entry['state']
+            if entry['stage'] == 'translate':
+                survey = next((survey for survey in get_surveys(load_config()) if survey['id'] == entry['survey_id']), None)
+                if survey is None:
+                    return 'translate', f"survey {entry['survey_id']} is no longer configured", None
+                return process_response(as_response(state['raw']), survey, settings)
+            # post_cos: POST again, then send; send_email: reuse the stored COS response so COS isn't POSTed twice
+            return contact_respondent(entry['survey_id'], state, settings, cos_response=state.get('cos_response'))
+    finally:
+        if lease_store is not None:
+            lease_store.complete([lease_key])
+
+def process_survey(survey:dict, settings:dict) -> tuple:
+    """GET and process new responses for one survey (up to its `max-responses` quota). Returns (successes, failures)."""
+
+    ## GET new survey responses from SurveyMonkey
+    with timed('get_sm_survey_responses'):
+        sm_survey_responses = get_sm_survey_responses(test_mode=settings['test_mode'], survey=survey)
 
-    TEST_MODE = True # For purposes of testing without making any API calls
+    # Claim responses in batches so several worker processes can share them (none in test mode: cached responses
+    # are reprocessed on every run)
+    lease_store = leases.get_store() if not settings['test_mode'] else None
+    responses = {resp['id']: resp for resp in sm_survey_responses}
+    pending = list(responses)
+    quota = survey['max-responses']
+
+    dead_letters = deadletter.get_store() if not settings['test_mode'] else None
+    successes = []
+    failures = [] # for responses which the app fails to process -- parked in data/dead-letters.json and retried (not in test mode)
+    while pending:
+        limit = leases.CLAIM_BATCH if quota is None else min(leases.CLAIM_BATCH, quota - len(successes) - len(failures))
+        if limit <= 0:
+            logger.info("Survey %s -- reached max-responses (%d); %d responses left for the next run", survey['name'], quota, len(pending))
+            break
+        batch = pending[:limit] if lease_store is None else lease_store.claim(pending, limit=limit)
+        if not batch: # the rest are held or done by other workers
+            break
+        # Ids the claim went through but didn't get are held or done by other workers: they are left for the next
+        # run, and their raw items dropped now rather than held until this survey is done
+        examined = pending if len(batch) < limit else pending[:pending.index(batch[-1]) + 1]
+        claimed = set(batch)
+        discard_pending([responses[response_id] for response_id in examined if response_id not in claimed])
+        pending = pending[len(examined):]
+        archive_pending([responses[response_id] for response_id in batch]) # full items of the responses this worker processes
+        # Categorize the batch's free-text answers together: one vectorized predict() per question, not per response
+        with timed('categorize'):
+            categories = categorize_answers([responses[response_id] for response_id in batch], get_translation_map(survey),
+                                            models=settings['category_models'])
+
+        # Keep the batch's leases alive however long each response takes (no heartbeat without leases)
+        with leases.Heartbeat(lease_store, batch) if lease_store is not None else nullcontext():
+            for response_id, response_categories in zip(batch, categories):
+                resp = responses[response_id]
+                try:
+                    with profiling.span(response_id=resp['id']):
+                        failure = process_response(resp, survey, settings, categories=response_categories)
+                except Exception as e:
+                    logger.exception("SM: %s -- processing failed", resp['id'])
+                    failure = 'translate', str(e), {'raw': resp.to_dict()}
+                if failure is None:
+                    successes.append(resp['id'])
+                else:
+                    stage, error, state = failure
+                    if dead_letters is not None:
+                        dead_letters.add(resp['id'], survey['id'], stage, state, error)
+                    failures.append({'id':resp['id'],
+                                     'survey_id':survey['id'],
+                                     'date_added':est_now(),
+                                     'error_type':stage,
+                                     'error':error})
+                if lease_store is not None: # done either way -- failures are now the retry scheduler's
+                    lease_store.complete([response_id])
+    return successes, failures
+
+def warm_up():
+    """Load what the first run would otherwise load while handling a request: the categorization models"""
+    try:
+        with timed('warm_up'):
+            get_models()
+    except Exception:
+        logger.exception("Warm-up failed -- models are loaded by the first run instead")
+
+def main(test_mode=True, profile=None, wait_for_retries=False):
+    """
+    profile (bool): Profile this run (see modules/profiling.py) -- default: the PROFILE environment variable
+
+    wait_for_retries (bool): Stop the retry scheduler and run the due retries before returning -- for one-off runs
+        (`python -m modules.main`), whose process exits straight after. The Flask app leaves the scheduler running.
+    """
+    with profiling.profile_run("main", enabled=profile):
+        return _main(test_mode, wait_for_retries)
+
+def _main(test_mode, wait_for_retries=False):
+
+    TEST_MODE = test_mode # For purposes of testing without making any API calls
     CONFIG = load_config()
-    SENDER_EMAIL = CONFIG['email']['shared-dil-account']['sender-email']
-    APP_PASSWORD = CONFIG['email']['shared-dil-account']['app-password']
+    settings = {
+        'test_mode': TEST_MODE,
+        'sender_email': CONFIG['email']['shared-dil-account']['sender-email'],
+        'app_password': CONFIG['email']['shared-dil-account']['app-password'],
+        # Optional overrides (e.g. for local benchmarks): {'server':..., 'port':..., 'starttls':...}
+        'smtp': CONFIG['email'].get('smtp', {}),
+        'check_deliverability': CONFIG['email'].get('check-deliverability', True),
+        # Rank locally (modules/scoring.py) when COS fails, rather than retrying later -- off unless configured
+        'local_scoring_fallback': CONFIG['cos'].get('local-scoring-fallback', False),
+        'occupations': get_store(),
+        'category_models': get_models(), # loaded (or refitted) once per process -- app.py warms it up at start-up
+    }
 
-    DIVIDER = "\n" + '--------' * 15 + "\n"
     if TEST_MODE:
         log_format(DIVIDER)
         logger.debug("Running main.py in Test Mode")
     log_format(DIVIDER)
 
-    ## GET new survey responses from SurveyMonkey
-    sm_survey_responses = get_sm_survey_responses(test_mode=TEST_MODE)
+    ## Retry earlier failures in the background, with this run's settings (test mode reprocesses everything anyway)
+    scheduler = None
+    if not TEST_MODE:
+        scheduler = deadletter.get_scheduler(handler=partial(retry_dead_letter, settings=settings))
+        scheduler.start()
 
-    ## Process and store these survey responses
-    failures = [] # for responses which the app fails to process
+    ## One worker per survey, so one survey's backlog doesn't hold up the others
+    surveys = get_surveys(CONFIG)
+    failures = []
     successes = []
-    with open("data/survey-responses.json", "a") as output_file:
-
-        for resp in sm_survey_responses:
-
-            logger.info(f"Processing SM Response #{resp['id']}")
-            # Load translation map
-            combined_map = combine_qa_keys(fetch=False)
-
-            # Check response versus translation map for unexpected question ids in sm_survey_responses
-            unexpected_question_ids = check_unexpected_question_ids(resp, combined_map)
-            retries = 0
-            while len(unexpected_question_ids) > 0 and retries <= 2:
-                logger.warning(f"SM: {resp['id']} -- {len(unexpected_question_ids)} unexpected question ids: {unexpected_question_ids} -- Refreshing question/answer key map.")
-                # Update current version of translation map
-                combined_map = combine_qa_keys(fetch=True)
-                # Check for unexpected ids again
-                unexpected_question_ids = check_unexpected_question_ids(resp, combined_map)
-                retries += 1
-
-            # If there are still unexpected ids after retrying
-            if len(unexpected_question_ids) > 0:
-                (f"WARNING: Unable to reconcile questions from SM response {resp['id']} with COS key. Skipping.")
-                ## TO-DO: load response to "problem" table in database
-                # For now, save response to a separate .json row file
-
-                fail_dict = {'id':resp['id'],
-                             'date_added':est_now(),
-                             'error_type':'unexpected_question_ids',
-                             'data':{
-                                 'raw':resp,
-                                 'unexpected_questions':[unexpected_question_ids]
-                                 }
-                            }
-
-                # Append to the problem responses file
-                failures.append(fail_dict)
-
-            # Process survey response
-            else:
-                processed_resp = translate_sm_response(resp, combined_map)
-                email_address = get_email_address(resp)
-                has_valid_email, error_message = check_email_address(email_address)
-
-                # POST to COS and email recommended jobs
-                contact_result = False
-                rec_jobs = []
-                if has_valid_email:
-                    valid_status = "y"
-                    cos_response = post_cos(processed_resp, test_mode=TEST_MODE)
-
-                    # Email if POST successful
-                    if cos_response != {}:
-
-                        rec_jobs = [job['OccupationTitle'] for job in cos_response['SKARankList']]
-                        logger.info(f"SM: {processed_resp['response_id']} -- {len(rec_jobs)} recommended jobs.")
-
-                        contact_result = send_email(test_mode=TEST_MODE,
-                                    response_id=processed_resp['response_id'],
-                                    cos_response=cos_response,
-                                    sender=SENDER_EMAIL,
-                                    app_password=APP_PASSWORD,
-                                    recipient=email_address)
-                else:
-                    valid_status = error_message
-                    logger.warning(f"SM: {processed_resp['response_id']} has invalid email address ({email_address}) -- {error_message}. Skipping send.")
-
-                ## Create and append response record to db file
-                update_dict = {
-                    "id": resp['id'],
-                    "date_added": est_now(),
-                    "raw": resp,
-                    "processed":processed_resp,
-                    "jobs":{"n":len(rec_jobs),"top":[]},
-                    "email": {"address": email_address,
-                              "valid_status":valid_status,
-                              "contacted":contact_result},
-                }
-                if len(rec_jobs) > 0:
-                    update_dict['jobs']['top'] = rec_jobs[:min(len(rec_jobs),10)]
-
-                logger.info([{k:v} for k,v in update_dict.items() if k not in ('raw','processed')])
-                output_file.write(json.dumps(update_dict) + '\n')
-
-                log_format(DIVIDER)
+    with ThreadPoolExecutor(max_workers=len(surveys), thread_name_prefix="survey") as pool:
+        for survey_successes, survey_failures in pool.map(lambda survey: process_survey(survey, settings), surveys):
+            successes.extend(survey_successes)
+            failures.extend(survey_failures)
+
+    settings['occupations'].save()
+    if scheduler is not None:
+        if wait_for_retries:
+            scheduler.drain()
+        elif failures:
+            scheduler.wake()
 
     # Returning results for testing
     data = json.dumps({"successes":successes,"failures":failures})
@@ -115,13 +308,4 @@ def main():
     return data, 200
 
 if __name__ == "__main__":
-    main()
-
-
-
-
-
-
-
-
-
+    main(wait_for_retries=True)
@@ -0,0 +1,199 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from . import profiling
+
+#### --- Lightweight in-process metrics: counters, latency histograms and gauges --- ####
+## Rendered in Prometheus text format by app.py at /metrics.
+
+## Histogram bucket upper bounds (seconds): log-linear, 4 sub-buckets per power of two from ~61us to ~7min,
+# so any recorded latency lands in a bucket within ~19% of its true value (HDR-style)
+LATENCY_BOUNDS = tuple(2.0 ** (exp + sub / 4) for exp in range(-14, 9) for sub in range(4))
+
+
+class Counter:
+    """Monotonically increasing count, optionally split by label values."""
+
+    def __init__(self, name:str, description:str, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(label, '') for label in self.labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def clear(self):
+        with self._lock:
+            self.values.clear()
+
+    def samples(self):
+        with self._lock:
+            items = list(self.values.items())
+        return [(self.name, dict(zip(self.labels, key)), value) for key, value in items]
+
+
+class Gauge:
+    """Point-in-time value. Either set() directly or computed from `func` when scraped."""
+
+    def __init__(self, name:str, description:str, func=None):
+        self.name = name
+        self.description = description
+        self.func = func
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        value = self.func() if self.func is not None else self.value
+        return [(self.name, {}, value)]
+
+
+class Histogram:
+    """Latency distribution per label set with fixed log-linear buckets (see LATENCY_BOUNDS)."""
+
+    def __init__(self, name:str, description:str, labels=(), bounds=LATENCY_BOUNDS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.bounds = bounds
+        self.series = {}  # label values -> [bucket counts..., overflow count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value:float, **labels):
+        key = tuple(labels.get(label, '') for label in self.labels)
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.bounds) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def quantile(self, q:float, **labels) -> float:
+        """Upper bound of the bucket holding the q-th quantile (0 < q <= 1) -- None if nothing was recorded."""
+        key = tuple(labels.get(label, '') for label in self.labels)
+        with self._lock:
+            counts = list(self.series.get(key, [])[:-1])
+        total = sum(counts)
+        if total == 0:
+            return None
+        rank, seen = q * total, 0
+        for index, count in enumerate(counts):
+            seen += count
+            if seen >= rank:
+                return self.bounds[index] if index < len(self.bounds) else float('inf')
+
+    def count(self, **labels) -> int:
+        key = tuple(labels.get(label, '') for label in self.labels)
+        with self._lock:
+            return sum(self.series.get(key, [0, 0])[:-1])
+
+    def clear(self):
+        with self._lock:
+            self.series.clear()
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(series)) for key, series in self.series.items()]
+        samples = []
+        for key, series in items:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.bounds, series):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", {**labels, 'le': f"{bound:.6g}"}, cumulative))
+            cumulative += series[-2]
+            samples.append((f"{self.name}_bucket", {**labels, 'le': '+Inf'}, cumulative))
+            samples.append((f"{self.name}_count", labels, cumulative))
+            samples.append((f"{self.name}_sum", labels, series[-1]))
+        return samples
+
+
+## Registry
+class Registry:
+    """Holds metrics by name and renders them in the Prometheus text exposition format."""
+
+    TYPES = {Counter: 'counter', Gauge: 'gauge', Histogram: 'histogram'}
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, description, labels=()) -> Counter:
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name, description, func=None) -> Gauge:
+        return self.register(Gauge(name, description, func))
+
+    def histogram(self, name, description, labels=()) -> Histogram:
+        return self.register(Histogram(name, description, labels))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {self.TYPES[type(metric)]}")
+            for name, labels, value in metric.samples():
+                label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+## ----------------------------------------------------------------------------- ##
+# Default registry and the pipeline's metrics #
+
+REGISTRY = Registry()
+
+STAGE_LATENCY = REGISTRY.histogram("pipeline_stage_seconds", "Time spent in each stage of main()", labels=("stage",))
+STAGE_ERRORS = REGISTRY.counter("pipeline_stage_errors_total", "Exceptions raised per stage", labels=("stage",))
+REQUEST_LATENCY = REGISTRY.histogram("http_request_seconds", "Latency of outgoing API requests", labels=("method", "host", "status"))
+RESPONSES = REGISTRY.counter("survey_responses_total", "SM survey responses processed, by outcome", labels=("outcome",))
+EMAILS = REGISTRY.counter("emails_total", "Emails sent, by result", labels=("result",))
+
+
+def _log_queue_depth():
+    from .logger import log_queue
+    return log_queue.qsize()
+
+
+def _text_cache_hit_rate():
+    from .normalize import cache_info
+    info = cache_info()
+    lookups = info.hits + info.misses
+    return info.hits / lookups if lookups else 0.0
+
+
+REGISTRY.gauge("log_queue_depth", "Log records waiting for the background listener", func=_log_queue_depth)
+REGISTRY.gauge("text_cache_hit_rate", "Hit rate of the text normalization memo cache", func=_text_cache_hit_rate)
+
+
+@contextmanager
+def timed(stage:str, histogram=STAGE_LATENCY):
+    """Time the enclosed block into `histogram` under label `stage` (exceptions are counted, then re-raised)."""
+    start_time = time.perf_counter()
+    try:
+        with profiling.span(stage=stage):
+            yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        histogram.observe(time.perf_counter() - start_time, stage=stage)
+
+
+def render() -> str:
+    """Prometheus text format of the default registry"""
+    return REGISTRY.render()
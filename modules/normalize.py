@@ -0,0 +1,117 @@
+import html
+import re
+import sys
+import time
+from functools import lru_cache
+
+#### --- Text normalization for SurveyMonkey headings, answer choices and free-text answers --- ####
+## The same headings and choice texts are cleaned over and over (once per answer choice while
+## building the map in combine_qa_keys, once per free-text answer in translate_sm_response),
+## so patterns are compiled once and results are memoized.
+
+TAG_PATTERN = re.compile(r'<.*?>')
+NBSP_PATTERN = re.compile(r'\xa0|\\xa0')
+
+# Upper bound on the number of distinct strings kept in the memo cache
+CACHE_SIZE = 4096
+
+# Free-text answers longer than this are cleaned but not memoized (unlikely to repeat)
+MAX_CACHED_LENGTH = 512
+
+
+def _normalize(text:str) -> str:
+    """Uncached normalization: unescape HTML entities, strip tags and non-breaking spaces."""
+    if '&' in text:
+        text = html.unescape(text)
+    if '<' in text:
+        text = TAG_PATTERN.sub('', text)
+    if 'xa0' in text or '\xa0' in text:
+        text = NBSP_PATTERN.sub(' ', text)
+    return text.strip()
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _normalize_cached(text:str) -> str:
+    """Memoized normalization. Outputs are interned so repeated texts share one object."""
+    return sys.intern(_normalize(text))
+
+
+## Remove HTML tags, escape characters from text
+def clean_text(text:str) -> str:
+    """Clean a single field of text (same output as the original utils.clean_field_text)."""
+    if len(text) > MAX_CACHED_LENGTH:
+        return _normalize(text)
+    return _normalize_cached(text)
+
+
+def clean_answers(answers:list) -> list:
+    """Clean the 'text' field of every answer in a raw SM answer list, in place. Returns the list."""
+    for a in answers:
+        if 'text' in a:
+            a['text'] = clean_text(a['text'])
+    return answers
+
+
+def cache_info():
+    """Hit/miss statistics of the memo cache (functools.lru_cache CacheInfo)"""
+    return _normalize_cached.cache_info()
+
+
+def cache_clear() -> None:
+    """Empty the memo cache"""
+    _normalize_cached.cache_clear()
+
+
+## ----------------------------------------------------------------------------- ##
+# Microbenchmark #
+
+def key_texts(sm_key:dict) -> list:
+    """Collect every heading and answer choice text in a SM `/details` key, in the order combine_qa_keys() cleans them."""
+    texts = []
+    for p in sm_key['pages']:
+        for q in p['questions']:
+            answers = q.get('answers', {})
+            texts.extend(a['text'] for a in answers.get('choices', []))
+            if 'other' in answers:
+                texts.append(answers['other']['text'])
+            if q['family'] == 'datetime':
+                texts.append(answers['rows'][0]['text'])
+            texts.append(q['headings'][0]['heading'])
+    return texts
+
+
+def benchmark(fp="data/survey-keys/sm-survey-key.json", rounds=200) -> dict:
+    """
+    Time the uncached vs. memoized normalization over every text in the SM survey key.
+
+    Args:
+
+    fp (str): Path to the SM survey key
+
+    rounds (int): Number of times to clean the full set of texts (~ number of map builds / responses)
+
+    """
+    import json
+    with open(fp, "r") as file:
+        texts = key_texts(json.load(file))
+
+    def legacy(text):
+        clean = re.sub(r'<.*?>', '', html.unescape(text))
+        return re.sub(r'\xa0|\\xa0', ' ', clean).strip()
+
+    results = {'n_texts': len(texts), 'rounds': rounds}
+    for name, func in (('legacy', legacy), ('uncached', _normalize), ('cached', clean_text)):
+        cache_clear()
+        start_time = time.perf_counter()
+        for _ in range(rounds):
+            for text in texts:
+                func(text)
+        results[f'{name}_s'] = round(time.perf_counter() - start_time, 4)
+
+    assert [legacy(t) for t in texts] == [clean_text(t) for t in texts]
+    results['cache'] = cache_info()._asdict()
+    return results
+
+
+if __name__ == "__main__":
+    print(benchmark())
@@ -0,0 +1,99 @@
+import json
+import os
+import threading
+
+from .logger import logger
+from .utils import create_job_url
+
+#### --- Occupation dimension table built up from COS Skills Matcher responses --- ####
+## Every COS response repeats the same occupation metadata for ~150 jobs. It is stored once per O*NET code
+## (with the profile URL, formatted wages and email table row precomputed), so a respondent's results
+## only need (OnetCode, Rank, Score) tuples and composing an email is a series of lookups.
+
+STORE_FP = "data/occupations.json"
+
+# COS fields kept per occupation
+FIELDS = ('OccupationTitle', 'AnnualWages', 'TypicalEducation', 'Outlook', 'EduCode')
+
+CELL_STYLE = "font-weight: normal; font-size: 16px;"
+
+_store = None
+
+
+def format_wages(annual_wages) -> str:
+    return f"${annual_wages:,.0f}" if annual_wages is not None else "N/A"
+
+
+def compact_jobs(cos_response:dict) -> list:
+    """(OnetCode, Rank, Score) for every job in a COS response, in rank order"""
+    return [(rec['OnetCode'], rec['Rank'], rec['Score']) for rec in cos_response.get('SKARankList', [])]
+
+
+class OccupationStore:
+    """O*NET code -> occupation metadata, persisted as JSON at `fp`."""
+
+    def __init__(self, fp=STORE_FP):
+        self.fp = fp
+        self.occupations = {}
+        self.changed = False
+        self._lock = threading.Lock()
+        if os.path.isfile(fp):
+            with open(fp, "r") as file:
+                for onet_code, occupation in json.load(file).items():
+                    self.occupations[onet_code] = self._derive(onet_code, occupation)
+
+    @staticmethod
+    def _derive(onet_code:str, occupation:dict) -> dict:
+        """Add the precomputed fields (url, wages text, email table cells) to an occupation's COS fields"""
+        occupation = {field: occupation.get(field) for field in FIELDS}
+        occupation['url'] = create_job_url(job_title=occupation['OccupationTitle'], onet_code=onet_code)
+        occupation['wages_text'] = format_wages(occupation['AnnualWages'])
+        occupation['row_html'] = "".join(f"<td style='{CELL_STYLE}'>{value}</td>" for value in (
+            occupation['OccupationTitle'], occupation['wages_text'], occupation['TypicalEducation'], occupation['url']))
+        return occupation
+
+    def update(self, records:list, refresh=True) -> int:
+        """
+        Add occupations from COS `SKARankList` records. Returns the number of new/changed entries.
+
+        refresh (bool): Also re-check known occupations for changed metadata (otherwise only unknown codes are added)
+        """
+        n_changed = 0
+        with self._lock:
+            for rec in records:
+                current = self.occupations.get(rec['OnetCode'])
+                if current is None or (refresh and any(current[field] != rec.get(field) for field in FIELDS)):
+                    self.occupations[rec['OnetCode']] = self._derive(rec['OnetCode'], rec)
+                    n_changed += 1
+            self.changed = self.changed or n_changed > 0
+        return n_changed
+
+    def get(self, onet_code:str) -> dict:
+        return self.occupations.get(onet_code)
+
+    def table_row(self, onet_code:str, rank:int) -> str:
+        """<tr> for the recommendations table in compose_email()"""
+        return f"<tr><td style='{CELL_STYLE}'>{rank}</td>{self.occupations[onet_code]['row_html']}</tr>"
+
+    def save(self) -> None:
+        """Write the COS fields of every occupation to `fp` (only if something changed)"""
+        with self._lock:
+            if not self.changed:
+                return
+            data = {onet_code: {field: occupation[field] for field in FIELDS}
+                    for onet_code, occupation in self.occupations.items()}
+            self.changed = False
+        os.makedirs(os.path.dirname(self.fp) or ".", exist_ok=True)
+        tmp_fp = self.fp + ".tmp"
+        with open(tmp_fp, "w") as file:
+            json.dump(data, file)
+        os.replace(tmp_fp, self.fp)
+        logger.debug("Saved %d occupations to %s", len(data), self.fp)
+
+
+def get_store(fp=STORE_FP) -> OccupationStore:
+    """Shared store, loaded on first use"""
+    global _store
+    if _store is None:
+        _store = OccupationStore(fp)
+    return _store
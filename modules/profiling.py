@@ -0,0 +1,183 @@
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+#### --- Opt-in profiling of a main() run: sampled CPU stacks, per-span samples and tracemalloc reports --- ####
+## Enable with PROFILE=1 (every run), or per /webhook call with an `X-Profile: <PROFILE_TOKEN>` header (ignored
+## unless PROFILE_TOKEN is set). Each profiled run writes to PROFILE_DIR/<timestamp>-<label>/:
+##   cpu.collapsed  "frame;frame;... count" stacks, prefixed with the stage span (flamegraph.pl, speedscope)
+##   spans.tsv      samples per (response id, stage) span
+##   memory.txt     tracemalloc top allocations at the end of the run, and the growth since its start
+##   summary.json   wall time, samples, peak traced memory
+## Stages are the metrics.timed() blocks; main() adds a span per response id. While no run is being profiled,
+## span() returns a shared no-op context and the sampler thread does not exist. (metrics imports this module, so
+## it stays import-light for app.py: logging and tracemalloc are imported when a run is profiled.)
+
+PROFILE = os.environ.get("PROFILE", "") not in ("", "0")
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "logs/profiles")
+PROFILE_INTERVAL_S = float(os.environ.get("PROFILE_INTERVAL_S", "0.005"))
+# tracemalloc slows allocation-heavy code several times over, more so with deeper tracebacks; 0 = no memory report
+TRACEMALLOC_FRAMES = int(os.environ.get("PROFILE_TRACEMALLOC_FRAMES", "1"))
+TOP_ALLOCATIONS = 30
+
+_NOOP = nullcontext()
+_run_lock = threading.Lock()
+_active = None  # the Profiler of the run in progress
+
+
+def requested(header_value=None) -> bool:
+    """Whether to profile: PROFILE is set, or a request carried the right X-Profile token"""
+    if PROFILE:
+        return True
+    # Constant-time comparison, so response timing doesn't leak the token
+    return bool(PROFILE_TOKEN) and header_value is not None and hmac.compare_digest(header_value.encode(), PROFILE_TOKEN.encode())
+
+
+def span(**tags):
+    """Tag samples taken inside the block (e.g. stage='post_cos', response_id='123'). No-op unless profiling."""
+    profiler = _active
+    if profiler is None:
+        return _NOOP
+    return profiler.span(tags)
+
+
+class Profiler:
+    """Samples every thread's Python stack each `interval` seconds, tagged with that thread's open spans."""
+
+    def __init__(self, interval=PROFILE_INTERVAL_S):
+        self.interval = interval
+        self.stacks = Counter()       # collapsed stack -> samples
+        self.span_samples = Counter() # (response id, stage) -> samples
+        self.samples = 0
+        self._spans = {}              # thread id -> [tags, ...] (innermost last)
+        self._labels = {}             # code object -> "file:function"
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @contextmanager
+    def span(self, tags:dict):
+        stack = self._spans.setdefault(threading.get_ident(), [])
+        stack.append(tags)
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+        return label
+
+    def _sample(self):
+        own_ident = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(self._label(frame.f_code))
+                frame = frame.f_back
+            frames.reverse()
+
+            tags = {}
+            for span_tags in tuple(self._spans.get(ident, ())):
+                tags.update(span_tags)
+            stage = tags.get('stage')
+            prefix = [f"stage:{stage}"] if stage else []
+            self.stacks[";".join(prefix + frames)] += 1
+            if tags:
+                self.span_samples[(tags.get('response_id', ''), stage or '')] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+
+@contextmanager
+def profile_run(label="main", enabled=None, output_dir=None):
+    """
+    Profile the enclosed block if `enabled` (default: PROFILE). Yields the run's output directory, or None when not
+    profiling -- including when another run is already being profiled (one at a time).
+    """
+    global _active
+    enabled = PROFILE if enabled is None else enabled
+    if not enabled or not _run_lock.acquire(blocking=False):
+        yield None
+        return
+    import tracemalloc
+    from .logger import logger
+
+    output_dir = os.path.join(output_dir or PROFILE_DIR, time.strftime("%Y%m%d-%H%M%S") + f"-{label}")
+    started_tracemalloc = TRACEMALLOC_FRAMES > 0 and not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    start_snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+    profiler = Profiler()
+    _active = profiler
+    profiler.start()
+    start_time = time.perf_counter()
+    try:
+        yield output_dir
+    finally:
+        wall_s = time.perf_counter() - start_time
+        _active = None
+        profiler.stop()
+        end_snapshot = tracemalloc.take_snapshot() if start_snapshot else None
+        peak_bytes = tracemalloc.get_traced_memory()[1] if start_snapshot else 0
+        if started_tracemalloc:
+            tracemalloc.stop()
+        _run_lock.release()
+        try:
+            _write_reports(output_dir, profiler, start_snapshot, end_snapshot, wall_s, peak_bytes)
+            logger.info("Profile of %s (%.2fs, %d samples) written to %s", label, wall_s, profiler.samples, output_dir)
+        except Exception as e:
+            logger.error("Writing profile to %s failed -- %s", output_dir, e)
+
+
+def _write_reports(output_dir:str, profiler:Profiler, start_snapshot, end_snapshot, wall_s:float, peak_bytes:int):
+    import tracemalloc
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "cpu.collapsed"), "w") as file:
+        for stack, count in profiler.stacks.most_common():
+            file.write(f"{stack} {count}\n")
+
+    with open(os.path.join(output_dir, "spans.tsv"), "w") as file:
+        file.write("response_id\tstage\tsamples\tapprox_s\n")
+        for (response_id, stage), count in profiler.span_samples.most_common():
+            file.write(f"{response_id}\t{stage}\t{count}\t{count * profiler.interval:.3f}\n")
+
+    if end_snapshot is None:
+        return _write_summary(output_dir, profiler, wall_s, peak_bytes)
+    # Skip tracemalloc's and this module's own allocations
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    end_snapshot = end_snapshot.filter_traces(filters)
+    with open(os.path.join(output_dir, "memory.txt"), "w") as file:
+        file.write(f"Peak traced memory: {peak_bytes / 2**20:.1f} MiB\n\nTop allocations at end of run:\n")
+        for stat in end_snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+            file.write(f"  {stat}\n")
+        file.write("\nGrowth during run:\n")
+        for stat in end_snapshot.compare_to(start_snapshot.filter_traces(filters), "lineno")[:TOP_ALLOCATIONS]:
+            file.write(f"  {stat}\n")
+    _write_summary(output_dir, profiler, wall_s, peak_bytes)
+
+
+def _write_summary(output_dir:str, profiler:Profiler, wall_s:float, peak_bytes:int):
+    with open(os.path.join(output_dir, "summary.json"), "w") as file:
+        json.dump({'wall_s': round(wall_s, 4), 'samples': profiler.samples, 'interval_s': profiler.interval,
+                   'peak_traced_bytes': peak_bytes, 'stacks': len(profiler.stacks), 'spans': len(profiler.span_samples)}, file)
@@ -0,0 +1,150 @@
+import json
+import os
+import sys
+import threading
+
+from .logger import logger
+
+#### --- Compact, field-projected SurveyMonkey responses --- ####
+## A `/responses/bulk` item is ~6 KB of nested dicts, most of it never read (edit_url, analyze_url, ip_address,
+## logic_path, metadata, custom_variables, page ids, tag_data, ...). decode_response() keeps only what the pipeline
+## uses, in an SMResponse: a few scalar fields plus (question id, answers) tuples, where each answer is a
+## (choice_id, other_id, row_id, text) tuple and the ids are interned (shared by every response that picks them).
+##
+## The full item can be spilled to an append-only archive (RAW_ARCHIVE_FP, "" to disable) and read back with
+## load_raw(response.raw_ref). get_sm_survey_responses() only keeps the serialized item on the response (keep_raw);
+## main() archives it once the response is claimed for processing (archive_pending()), so responses fetched again
+## but not processed -- e.g. held by another worker -- never add to the archive; their items are dropped as soon as a
+## claim passes them over (discard_pending()). Stored records keep the compact form (SMResponse.to_dict()), which
+## decode_response() also accepts, as it does raw items from older records.
+
+RAW_ARCHIVE_FP = os.environ.get("RAW_ARCHIVE_FP", "data/raw-responses.jsonl")
+
+FIELDS = ('id', 'collector_id', 'survey_id', 'response_status', 'total_time', 'date_created', 'date_modified')
+ANSWER_FIELDS = ('choice_id', 'other_id', 'row_id', 'text')
+
+_archive_lock = threading.Lock()
+
+
+class SMResponse:
+    """
+    One SM response, projected to FIELDS plus `answers`: ((question id, ((choice_id, other_id, row_id, text), ...)), ...)
+    in survey order. Item access (resp['id']) works for FIELDS, as it did for the raw dicts.
+    """
+
+    __slots__ = FIELDS + ('answers', 'raw_ref', 'pending_raw')
+
+    def __init__(self, answers:tuple, raw_ref=None, pending_raw=None, **fields):
+        for field in FIELDS:
+            setattr(self, field, fields.get(field))
+        self.answers = answers
+        self.raw_ref = raw_ref
+        self.pending_raw = pending_raw  # serialized full item (bytes) waiting for archive_pending()
+
+    def __getitem__(self, field:str):
+        if field not in FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __repr__(self) -> str:
+        return f"SMResponse(id={self.id!r}, collector_id={self.collector_id!r}, questions={len(self.answers)})"
+
+    def question_ids(self) -> list:
+        return [question_id for question_id, _ in self.answers]
+
+    def answer_map(self) -> dict:
+        """question id -> answer tuples"""
+        return dict(self.answers)
+
+    def to_dict(self) -> dict:
+        """JSON-able compact form (what main() stores as a record's 'raw')"""
+        return {**{field: getattr(self, field) for field in FIELDS},
+                'answers': [[question_id, [list(a) for a in answers]] for question_id, answers in self.answers],
+                'raw_ref': self.raw_ref}
+
+
+def answer_dict(answer:tuple) -> dict:
+    """An answer tuple in the raw SM format (only the fields it has)"""
+    return {field: value for field, value in zip(ANSWER_FIELDS, answer) if value is not None}
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def decode_response(item:dict, archive_fp=None, keep_raw=False) -> SMResponse:
+    """
+    Project a raw `/responses/bulk` item -- or the compact dict from SMResponse.to_dict() -- into an SMResponse.
+
+    archive_fp (str): Also append the raw item to this archive (ignored for compact dicts)
+
+    keep_raw (bool): Keep the raw item, serialized, for a later archive_pending() (ignored for compact dicts)
+    """
+    if 'answers' in item and 'pages' not in item: # compact form
+        answers = tuple((_intern(question_id), tuple(tuple(a) for a in question_answers))
+                        for question_id, question_answers in item['answers'])
+        return SMResponse(answers, raw_ref=item.get('raw_ref'), **{field: item.get(field) for field in FIELDS})
+
+    answers = tuple((sys.intern(q['id']),
+                     tuple((_intern(a.get('choice_id')), _intern(a.get('other_id')), _intern(a.get('row_id')), a.get('text'))
+                           for a in q['answers']))
+                    for p in item['pages'] for q in p['questions'])
+    raw_ref = archive_raw(item, archive_fp) if archive_fp else None
+    pending_raw = _raw_line(item) if keep_raw and raw_ref is None else None
+    return SMResponse(answers, raw_ref=raw_ref, pending_raw=pending_raw, **{field: _intern(item.get(field)) for field in FIELDS})
+
+
+def as_response(resp) -> SMResponse:
+    """`resp` as an SMResponse (decoding raw/compact dicts, e.g. from notebooks or stored records)"""
+    return resp if isinstance(resp, SMResponse) else decode_response(resp)
+
+
+## ----------------------------------------------------------------------------- ##
+# Cold storage for the full raw items #
+
+def _raw_line(item:dict) -> bytes:
+    return (json.dumps(item) + "\n").encode()
+
+
+def archive_raw(item, fp=RAW_ARCHIVE_FP) -> list:
+    """Append a raw item (dict, or a line from _raw_line()) to the archive as one JSON line. Returns its [offset, length]."""
+    line = item if isinstance(item, bytes) else _raw_line(item)
+    os.makedirs(os.path.dirname(fp) or ".", exist_ok=True)
+    with _archive_lock:
+        # O_APPEND: each line lands whole at the end, even with several worker processes appending
+        fd = os.open(fp, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+            end = os.lseek(fd, 0, os.SEEK_CUR)
+        finally:
+            os.close(fd)
+    return [end - len(line), len(line)]
+
+
+def archive_pending(responses:list, fp=RAW_ARCHIVE_FP) -> None:
+    """Archive the raw items kept by decode_response(keep_raw=True), setting each response's raw_ref"""
+    for resp in responses:
+        if resp.pending_raw is not None:
+            if fp:
+                resp.raw_ref = archive_raw(resp.pending_raw, fp)
+            resp.pending_raw = None
+
+
+def discard_pending(responses:list) -> None:
+    """Drop the raw items kept by decode_response(keep_raw=True) for responses this worker won't process"""
+    for resp in responses:
+        resp.pending_raw = None
+
+
+def load_raw(raw_ref:list, fp=RAW_ARCHIVE_FP) -> dict:
+    """The full raw item archived at `raw_ref` (None if there is none)"""
+    if raw_ref is None:
+        return None
+    offset, length = raw_ref
+    try:
+        with open(fp, "rb") as file:
+            file.seek(offset)
+            return json.loads(file.read(length))
+    except (OSError, ValueError) as e:
+        logger.error(f"Reading raw response at {raw_ref} from {fp} failed -- {e}")
+        return None
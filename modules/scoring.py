@@ -0,0 +1,184 @@
+import argparse
+import os
+
+import numpy as np
+
+from .logger import logger
+from .utils import load_json, create_cos_request_body
+
+#### --- Local, vectorized stand-in for the COS Skills Matcher --- ####
+## A ridge regression from the 40 skill DataValues to every occupation's COS Score, fitted on stored
+## (request, COS response) pairs. Scoring a batch of answer vectors is one matrix product plus a top-k
+## partition, so it serves both as an opt-in degraded-mode fallback when the COS API fails (post_cos, with
+## `cos: local-scoring-fallback: true`) and as a fast deterministic backend for load tests (benchmarks/fake_servers.py).
+##
+## python -m modules.scoring  -- fit from data/temp_cos_response_objects.json + data/survey-responses.json
+
+MODEL_FP = "data/models/skills-matcher.npz"
+COS_KEY_FP = "data/survey-keys/cos-survey-key.json"
+COS_RESPONSES_FP = "data/temp_cos_response_objects.json"
+SURVEY_RESPONSES_FP = "data/survey-responses.json"
+
+_model = None
+
+
+class SkillsMatcherModel:
+    """
+    Linear scoring model: scores = [X, 1] @ weights
+
+    element_ids (list[str]): COS skill ElementIds, i.e. the columns of an answer matrix X
+    onet_codes (list[str]): Occupations, i.e. the columns of the score matrix
+    weights (np.ndarray): (len(element_ids) + 1) x len(onet_codes), last row is the intercept
+    """
+
+    def __init__(self, element_ids, onet_codes, weights):
+        self.element_ids = list(element_ids)
+        self.onet_codes = np.asarray(onet_codes)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.columns = {element_id: n for n, element_id in enumerate(self.element_ids)}
+
+    @classmethod
+    def fit(cls, pairs:list, element_ids:list, ridge=1.0):
+        """
+        Fit from (cos_request_body, cos_response) pairs.
+
+        Occupations missing from a response (COS only lists its top matches) are given that response's
+        lowest listed score, so they rank below every listed occupation.
+        """
+        onet_codes = sorted({rec['OnetCode'] for _, cos_response in pairs for rec in cos_response['SKARankList']})
+        occupation_columns = {code: n for n, code in enumerate(onet_codes)}
+        model = cls(element_ids, onet_codes, np.zeros((len(element_ids) + 1, len(onet_codes))))
+
+        X = model.answer_matrix([body for body, _ in pairs])
+        Y = np.empty((len(pairs), len(onet_codes)))
+        for i, (_, cos_response) in enumerate(pairs):
+            scores = {rec['OnetCode']: rec['Score'] for rec in cos_response['SKARankList']}
+            Y[i] = min(scores.values())
+            Y[i, [occupation_columns[code] for code in scores]] = list(scores.values())
+
+        X1 = np.hstack([X, np.ones((len(X), 1))])
+        model.weights = np.linalg.solve(X1.T @ X1 + ridge * np.eye(X1.shape[1]), X1.T @ Y)
+        return model
+
+    def answer_matrix(self, cos_request_bodies:list) -> np.ndarray:
+        """One row per COS request body ({'SKAValueList': [{'ElementId', 'DataValue'}, ...]})"""
+        X = np.zeros((len(cos_request_bodies), len(self.element_ids)))
+        for i, body in enumerate(cos_request_bodies):
+            for value in body['SKAValueList']:
+                column = self.columns.get(value['ElementId'])
+                if column is not None:
+                    X[i, column] = value['DataValue']
+        return X
+
+    def score(self, X:np.ndarray) -> np.ndarray:
+        """Scores for every occupation, one row per answer vector"""
+        return X @ self.weights[:-1] + self.weights[-1]
+
+    def rank(self, X:np.ndarray, top=150) -> tuple:
+        """(occupation indices, scores) of the `top` best matches per row, best first"""
+        scores = self.score(X)
+        top = min(top, scores.shape[1])
+        best = np.argpartition(-scores, top - 1, axis=1)[:, :top]
+        best_scores = np.take_along_axis(scores, best, axis=1)
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        return np.take_along_axis(best, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+    def cos_responses(self, cos_request_bodies:list, top=150) -> list:
+        """
+        COS-shaped responses ({'SKARankList': [...]}) for a batch of request bodies. Occupations missing from the
+        occupation store (no title to show) are left out.
+        """
+        from .occupations import get_store, FIELDS
+        store = get_store()
+        indices, scores = self.rank(self.answer_matrix(cos_request_bodies), top)
+        responses = []
+        for row_indices, row_scores in zip(indices, scores):
+            rank_list = []
+            for index, score in zip(row_indices, row_scores):
+                onet_code = str(self.onet_codes[index])
+                occupation = store.get(onet_code)
+                if not occupation or not occupation.get('OccupationTitle'):
+                    continue
+                rank_list.append({'OnetCode': onet_code, 'Score': float(score), 'Rank': len(rank_list) + 1,
+                                  **{field: occupation.get(field) for field in FIELDS}})
+            responses.append({'SKARankList': rank_list, 'RecordCount': len(rank_list), 'ScoringEngine': 'local'})
+        return responses
+
+    def save(self, fp=MODEL_FP):
+        os.makedirs(os.path.dirname(fp) or ".", exist_ok=True)
+        np.savez(fp, element_ids=np.asarray(self.element_ids), onet_codes=self.onet_codes, weights=self.weights)
+
+    @classmethod
+    def load(cls, fp=MODEL_FP):
+        with np.load(fp) as data:
+            return cls(data['element_ids'].tolist(), data['onet_codes'], data['weights'])
+
+
+## ----------------------------------------------------------------------------- ##
+# Training data and the shared model #
+
+def load_training_pairs(cos_responses_fp=COS_RESPONSES_FP, survey_responses_fp=SURVEY_RESPONSES_FP) -> list:
+    """
+    Join stored COS responses ({response_id: cos_response}) with the processed SM responses written by main()
+    into (cos_request_body, cos_response) pairs
+    """
+    import json
+    cos_responses = load_json(cos_responses_fp) or {}
+    pairs = []
+    if os.path.isfile(survey_responses_fp):
+        with open(survey_responses_fp, "r") as file:
+            for line in file:
+                record = json.loads(line)
+                cos_response = cos_responses.get(record['id'])
+                if cos_response and cos_response.get('SKARankList') and 'processed' in record:
+                    pairs.append((create_cos_request_body(record['processed']), cos_response))
+    return pairs
+
+
+def fit_model(pairs=None, cos_key_fp=COS_KEY_FP, model_fp=MODEL_FP, ridge=1.0) -> SkillsMatcherModel:
+    """Fit on stored pairs, record their occupations in the occupation store, and save the model"""
+    from .occupations import get_store
+    pairs = load_training_pairs() if pairs is None else pairs
+    if not pairs:
+        raise Exception("ERROR: No stored (COS request, COS response) pairs to fit the local scoring model on")
+    element_ids = [skill['ElementId'] for skill in load_json(cos_key_fp)['Skills']]
+
+    model = SkillsMatcherModel.fit(pairs, element_ids, ridge=ridge)
+    store = get_store()
+    for _, cos_response in pairs:
+        store.update(cos_response['SKARankList'])
+    store.save()
+    model.save(model_fp)
+    logger.info("Fitted local scoring model on %d responses (%d occupations) -> %s", len(pairs), len(model.onet_codes), model_fp)
+    return model
+
+
+def get_model(fp=MODEL_FP):
+    """Shared model, loaded on first use. None if no model has been fitted."""
+    global _model
+    if _model is None:
+        if not os.path.isfile(fp):
+            fp = os.path.join(os.path.abspath(os.path.pardir), fp)
+        _model = SkillsMatcherModel.load(fp) if os.path.isfile(fp) else False
+        if _model is False:
+            logger.warning("No local scoring model at %s -- run `python -m modules.scoring` to fit one", MODEL_FP)
+    return _model or None
+
+
+def local_cos_response(processed_resp:dict) -> dict:
+    """Score a processed SM response locally. Returns {} if no model is available."""
+    model = get_model()
+    if model is None:
+        return {}
+    return model.cos_responses([create_cos_request_body(processed_resp)])[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit the local Skills Matcher scoring model")
+    parser.add_argument("--cos-responses", default=COS_RESPONSES_FP)
+    parser.add_argument("--survey-responses", default=SURVEY_RESPONSES_FP)
+    parser.add_argument("--output", default=MODEL_FP)
+    parser.add_argument("--ridge", type=float, default=1.0)
+    args = parser.parse_args()
+
+    fit_model(load_training_pairs(args.cos_responses, args.survey_responses), model_fp=args.output, ridge=args.ridge)
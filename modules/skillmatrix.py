@@ -0,0 +1,343 @@
+import argparse
+import fcntl
+import json
+import os
+import re
+import sys
+
+from .logger import logger
+
+#### --- Memory-mapped matrix of skills-matcher answers, for cohort filters and similarity queries --- ####
+## One fixed-width row per response: a uint8 level code per skills-matcher question (column = COS ElementId), the
+## COS DataPoint the answer stands for -- 20, 35, 50, 65 or 80 -- or 0 if the respondent skipped the question.
+## Rows are appended as main() processes responses (a reprocessed id overwrites its row in place), so questions
+## like "how many rated 2.C.1.a at 65 or more" or "who answered most like response X" are vectorized numpy
+## operations over the mapped file instead of a parse of every stored JSON line. numpy is imported on first use,
+## keeping it off main()'s import path.
+##
+## {directory}/levels.u8     16-byte header (magic, version, byte order, width), then uint8 levels[n][width]
+## {directory}/ids.u64       uint64 SM response id per row (native byte order)
+## {directory}/columns.json  ElementId per column, fixed when the matrix is created
+##
+## python -m modules.skillmatrix --build                -- (re)build from data/survey-responses.json
+## python -m modules.skillmatrix --where "2.C.1.a>=65"  -- count/list matching respondents
+## python -m modules.skillmatrix --similar <response id>
+
+MATRIX_DIR = os.environ.get("SKILL_MATRIX_DIR", "data/skill-matrix")
+SOURCE_FP = "data/survey-responses.json"
+MAGIC = b"SKLM"
+FORMAT_VERSION = 1
+HEADER_SIZE = 16
+LEVELS = (20, 35, 50, 65, 80)  # COS DataPoint20 ... DataPoint80, in the order of a skills-matcher entry's answers
+MISSING = 0
+
+CONDITION_PATTERN = re.compile(r"^\s*([\w.]+)\s*(>=|<=|==|>|<)\s*(\d+)\s*$")
+
+_matrix = None
+
+
+def matrix_columns(combined_map:dict) -> list:
+    """Matrix columns for a translation map: its skills-matcher COS ElementIds, in COS order"""
+    return [entry['question_id'].get('cos') for entry in combined_map['skills-matcher'].values()]
+
+
+def clear(directory=MATRIX_DIR) -> None:
+    """Delete the matrix in `directory` (if any)"""
+    for name in ("levels.u8", "ids.u64", "columns.json"):
+        if os.path.isfile(os.path.join(directory, name)):
+            os.remove(os.path.join(directory, name))
+
+
+def level_codes(combined_map:dict) -> dict:
+    """SM question id -> (ElementId, {SM answer id: level}) for the skills-matcher questions of a translation map"""
+    return {question_id: (entry['question_id'].get('cos'),
+                          {a['id']['sm']: level for a, level in zip(entry['answers'], LEVELS)})
+            for question_id, entry in combined_map['skills-matcher'].items()}
+
+
+def encode(processed_resps:list, combined_map:dict, columns:list) -> "np.ndarray":
+    """Level rows (len(processed_resps) x len(columns), uint8) for responses from translate_sm_response()"""
+    import numpy as np
+    codes = level_codes(combined_map)
+    column_of = {element_id: n for n, element_id in enumerate(columns)}
+    rows = np.zeros((len(processed_resps), len(columns)), dtype=np.uint8)
+    for i, processed_resp in enumerate(processed_resps):
+        for q in processed_resp['questions']:
+            if q['question_type'] != 'skills-matcher' or q.get('auto_filled') or not q.get('answers'):
+                continue
+            element_id, levels = codes.get(q['question_id']['sm'], (None, {}))
+            column = column_of.get(element_id)
+            if column is not None:
+                rows[i, column] = levels.get(q['answers'][0]['id']['sm'], MISSING)
+    return rows
+
+
+class SkillMatrix:
+    """
+    The answer matrix in `directory`, memory-mapped for queries. Rows written by other processes are picked up on
+    the next query (the mapping is refreshed when the files have grown).
+
+    columns (list[str]): COS ElementIds, i.e. the matrix columns
+    """
+
+    def __init__(self, directory=MATRIX_DIR, columns=None):
+        import numpy as np
+        self.directory = directory
+        self.levels_fp = os.path.join(directory, "levels.u8")
+        self.ids_fp = os.path.join(directory, "ids.u64")
+        self.columns_fp = os.path.join(directory, "columns.json")
+        if os.path.isfile(self.columns_fp):
+            with open(self.columns_fp, "r") as file:
+                self.columns = json.load(file)
+        elif columns:
+            self._create(list(columns))
+        else:
+            raise FileNotFoundError(f"No skill matrix in {directory} -- pass `columns` to create one")
+        self.width = len(self.columns)
+        self.column_of = {element_id: n for n, element_id in enumerate(self.columns)}
+        self._levels = np.zeros((0, self.width), dtype=np.uint8)
+        self._ids = np.zeros(0, dtype=np.uint64)
+        self._row_of = {}  # response id (int) -> row
+        self._size = None
+
+    def _create(self, columns:list):
+        os.makedirs(self.directory, exist_ok=True)
+        with self._locked():
+            if not os.path.isfile(self.columns_fp): # another process may have just created it
+                header = MAGIC + bytes([FORMAT_VERSION, sys.byteorder == "little", 0, 0]) + len(columns).to_bytes(8, sys.byteorder)
+                with open(self.levels_fp, "wb") as file:
+                    file.write(header)
+                open(self.ids_fp, "wb").close()
+                tmp_fp = self.columns_fp + ".tmp"
+                with open(tmp_fp, "w") as file:
+                    json.dump(columns, file)
+                os.replace(tmp_fp, self.columns_fp)
+        with open(self.columns_fp, "r") as file:
+            self.columns = json.load(file)
+
+    def _locked(self):
+        """Exclusive lock on the matrix files (across processes) -- released when the returned file is closed"""
+        lock_file = open(os.path.join(self.directory, ".lock"), "w")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def refresh(self) -> int:
+        """Re-map the files if rows were added since the last call. Returns the number of rows."""
+        import numpy as np
+        size = os.path.getsize(self.ids_fp)
+        if size == self._size:
+            return len(self._ids)
+        with open(self.levels_fp, "rb") as file:
+            header = file.read(HEADER_SIZE)
+        if header[:4] != MAGIC or header[4] != FORMAT_VERSION or bool(header[5]) != (sys.byteorder == "little") \
+                or int.from_bytes(header[8:16], sys.byteorder) != self.width:
+            raise ValueError(f"{self.levels_fp} is not a compatible skill matrix -- rebuild it with build()")
+
+        # A writer may have died between its two writes: only rows present in both files count
+        n = min(size // 8, (os.path.getsize(self.levels_fp) - HEADER_SIZE) // max(self.width, 1))
+        if n:
+            self._ids = np.memmap(self.ids_fp, dtype=np.uint64, mode="r", shape=(n,))
+            self._levels = np.memmap(self.levels_fp, dtype=np.uint8, mode="r", offset=HEADER_SIZE, shape=(n, self.width))
+        first_new = len(self._row_of)
+        self._row_of.update(zip(self._ids[first_new:n].tolist(), range(first_new, n)))
+        self._size = size
+        return n
+
+    def __len__(self):
+        return self.refresh()
+
+    @property
+    def levels(self) -> "np.ndarray":
+        """rows x columns uint8 level codes (read-only view of the file)"""
+        self.refresh()
+        return self._levels
+
+    @property
+    def ids(self) -> "np.ndarray":
+        """uint64 response id per row"""
+        self.refresh()
+        return self._ids
+
+    ## ----------------------------------------------------------------------------- ##
+    # Writing #
+
+    def append(self, response_ids:list, rows:"np.ndarray") -> None:
+        """Add rows (from encode()) for response ids -- ids already in the matrix have their row overwritten"""
+        import numpy as np
+        rows = np.ascontiguousarray(rows, dtype=np.uint8).reshape(len(response_ids), self.width)
+        with self._locked():
+            n = self.refresh()
+            # Drop a half-written row from a writer that died, so new rows line up in both files
+            if os.path.getsize(self.ids_fp) != 8 * n or os.path.getsize(self.levels_fp) != HEADER_SIZE + n * self.width:
+                os.truncate(self.ids_fp, 8 * n)
+                os.truncate(self.levels_fp, HEADER_SIZE + n * self.width)
+
+            new = {} # response id -> index in rows (the last one wins)
+            with open(self.levels_fp, "r+b") as levels_file:
+                for i, response_id in enumerate(map(int, response_ids)):
+                    existing = self._row_of.get(response_id)
+                    if existing is not None:
+                        os.pwrite(levels_file.fileno(), rows[i].tobytes(), HEADER_SIZE + existing * self.width)
+                    else:
+                        new[response_id] = i
+                if new:
+                    levels_file.seek(0, os.SEEK_END)
+                    levels_file.write(rows[list(new.values())].tobytes())
+            if new: # ids last: a row counts once its id is written
+                with open(self.ids_fp, "ab") as ids_file:
+                    ids_file.write(np.asarray(list(new), dtype=np.uint64).tobytes())
+            self.refresh()
+
+    def add_responses(self, processed_resps:list, combined_map:dict) -> None:
+        """encode() and append() responses from translate_sm_response()"""
+        if processed_resps:
+            self.append([resp['response_id'] for resp in processed_resps], encode(processed_resps, combined_map, self.columns))
+
+    ## ----------------------------------------------------------------------------- ##
+    # Queries #
+
+    def row(self, response_id) -> "np.ndarray":
+        """The level codes of one response, or None if it isn't in the matrix"""
+        import numpy as np
+        self.refresh()
+        n = self._row_of.get(int(response_id))
+        return None if n is None else np.array(self._levels[n])
+
+    def select(self, at_least=None, at_most=None, answered=None) -> "np.ndarray":
+        """
+        Boolean row mask for respondents matching every condition, e.g. select(at_least={'2.C.1.a': 65}).
+
+        at_least / at_most (dict): ElementId -> level (skipped questions never match at_least)
+        answered (list): ElementIds that must not have been skipped
+        """
+        import numpy as np
+        levels = self.levels
+        mask = np.ones(len(levels), dtype=bool)
+        for element_id, level in (at_least or {}).items():
+            mask &= levels[:, self.column_of[element_id]] >= level
+        for element_id, level in (at_most or {}).items():
+            mask &= levels[:, self.column_of[element_id]] <= level
+        for element_id in answered or ():
+            mask &= levels[:, self.column_of[element_id]] != MISSING
+        return mask
+
+    def response_ids(self, mask:"np.ndarray") -> list:
+        """SM response ids (str) of the rows selected by a mask"""
+        return [str(response_id) for response_id in self.ids[mask].tolist()]
+
+    def level_counts(self, mask=None) -> "np.ndarray":
+        """columns x (MISSING, *LEVELS) counts of each level per question, over the masked rows"""
+        import numpy as np
+        levels = self.levels if mask is None else self.levels[mask]
+        return np.stack([np.count_nonzero(levels == code, axis=0) for code in (MISSING,) + LEVELS], axis=1)
+
+    def nearest(self, target, k=10, mask=None) -> list:
+        """
+        The k respondents whose answers are closest to `target` (a response id, or a row of level codes), as
+        (response id, distance) pairs, nearest first. Distance is L1 over the levels, skipped questions counting as
+        the lowest level (as COS scores them); a response id target is left out of its own results.
+
+        mask (np.ndarray): Only consider these rows (e.g. from select())
+        """
+        import numpy as np
+        levels = self.levels
+        exclude = None
+        if not isinstance(target, np.ndarray):
+            exclude = self._row_of.get(int(target))
+            if exclude is None:
+                raise KeyError(f"Response {target} is not in the skill matrix")
+            target = levels[exclude]
+        candidates = np.arange(len(levels)) if mask is None else np.flatnonzero(mask)
+        if exclude is not None:
+            candidates = candidates[candidates != exclude]
+        if not len(candidates):
+            return []
+
+        lowest = np.uint8(LEVELS[0])
+        target = np.maximum(np.asarray(target, dtype=np.uint8), lowest)
+        block = np.maximum(levels if mask is None else levels[candidates], lowest)
+        # |a - b| in uint8, without widening the whole block: max(a, b) - min(a, b)
+        distances = (np.maximum(block, target) - np.minimum(block, target)).sum(axis=1, dtype=np.int32)
+        if exclude is not None and mask is None:
+            distances = np.delete(distances, exclude)
+
+        k = min(k, len(candidates))
+        best = np.argpartition(distances, k - 1)[:k]
+        best = best[np.argsort(distances[best], kind="stable")]
+        ids = self._ids[candidates[best]].tolist()
+        return [(str(response_id), int(distance)) for response_id, distance in zip(ids, distances[best].tolist())]
+
+
+## ----------------------------------------------------------------------------- ##
+# The shared matrix #
+
+def get_matrix(combined_map=None, directory=MATRIX_DIR):
+    """
+    Shared matrix, opened on first use -- or created with the ElementIds of `combined_map`'s skills-matcher
+    questions. None if there is no matrix yet and no map to create one from.
+    """
+    global _matrix
+    if _matrix is None:
+        columns = matrix_columns(combined_map) if combined_map else None
+        if not os.path.isfile(os.path.join(directory, "columns.json")) and not columns:
+            return None
+        _matrix = SkillMatrix(directory, columns=columns)
+        missing = [c for c in columns or () if c not in _matrix.column_of]
+        if missing:
+            logger.error("Skill matrix %s has no columns for COS skills %s -- rebuild it (python -m modules.skillmatrix --build)", directory, missing)
+    return _matrix
+
+
+def build(source_fp=SOURCE_FP, combined_map=None, directory=MATRIX_DIR) -> SkillMatrix:
+    """(Re)build a matrix from stored records (rows with 'processed'), with columns from `combined_map`"""
+    from .funcs import combine_qa_keys
+    combined_map = combine_qa_keys(fetch=False) if combined_map is None else combined_map
+    clear(directory)
+    matrix = SkillMatrix(directory, columns=matrix_columns(combined_map))
+
+    batch = []
+    with open(source_fp, "r") as file:
+        for line in file:
+            record = json.loads(line) if line.strip() else {}
+            if record.get('processed'):
+                batch.append(record['processed'])
+            if len(batch) == 1000:
+                matrix.add_responses(batch, combined_map)
+                batch = []
+    matrix.add_responses(batch, combined_map)
+    logger.info("Built skill matrix %s from %s (%d respondents x %d skills)", directory, source_fp, len(matrix), matrix.width)
+    return matrix
+
+
+def parse_conditions(conditions:list) -> dict:
+    """["2.C.1.a>=65", ...] -> select() keyword arguments"""
+    at_least, at_most = {}, {}
+    for condition in conditions:
+        match = CONDITION_PATTERN.match(condition)
+        if match is None:
+            raise ValueError(f"Can't parse condition {condition!r} -- expected e.g. 2.C.1.a>=65")
+        element_id, op, level = match.group(1), match.group(2), int(match.group(3))
+        if op in (">=", ">", "=="):
+            at_least[element_id] = level + (op == ">")
+        if op in ("<=", "<", "=="):
+            at_most[element_id] = level - (op == "<")
+    return {'at_least': at_least, 'at_most': at_most}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query the skills-matcher answer matrix")
+    parser.add_argument("--dir", default=MATRIX_DIR)
+    parser.add_argument("--build", action="store_true", help="(Re)build from stored records")
+    parser.add_argument("--source", default=SOURCE_FP)
+    parser.add_argument("--where", nargs="*", default=[], help='Conditions such as "2.C.1.a>=65"')
+    parser.add_argument("--similar", default=None, help="Response id to find the nearest respondents to")
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    matrix = build(args.source, directory=args.dir) if args.build else SkillMatrix(args.dir)
+    mask = matrix.select(**parse_conditions(args.where))
+    if args.similar:
+        print(json.dumps(matrix.nearest(args.similar, k=args.k, mask=mask if args.where else None)))
+    else:
+        print(json.dumps({'respondents': len(matrix), 'matching': int(mask.sum()),
+                          'response_ids': matrix.response_ids(mask)[:args.k]}))
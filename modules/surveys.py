@@ -0,0 +1,79 @@
+import os
+import threading
+
+from .logger import logger, get_logger
+from .utils import load_config
+from .funcs import get_qa_key, build_qa_map
+from .keydiff import patch_map, summarize
+
+#### --- Multiple surveys: per-survey settings and cached translation maps --- ####
+## A single survey is configured as before (the `sm` section of creds/api-key.yaml). To run several, list them under
+## `sm: surveys:` -- each entry overrides `base_url` and `survey-details-fp` (and optionally `headers`) and may set:
+##   name           label used in logs and stored records
+##   max-responses  quota: most responses processed for this survey per run (the rest wait for the next run)
+##
+## sm:
+##   headers: {...}
+##   surveys:
+##     - {name: online, base_url: https://api.surveymonkey.com/v3/surveys/513506444, survey-details-fp: data/survey-keys/sm-survey-key.json}
+##     - {name: in-person, base_url: ..., survey-details-fp: ..., max-responses: 200}
+
+surveys_logger = get_logger('surveys')
+
+_maps = {}  # survey id -> ((SM, COS key file mtimes), combined map, sm key, cos key, COS key file)
+_maps_lock = threading.Lock()
+
+
+def get_surveys(config:dict) -> list:
+    """Settings for every configured survey (same keys as the `sm` config section, plus 'id', 'name', 'max-responses')"""
+    sm_config = config['sm']
+    entries = sm_config.get('surveys') or [{}]
+    surveys = []
+    for entry in entries:
+        survey = {k: v for k, v in sm_config.items() if k != 'surveys'}
+        survey.update(entry)
+        survey['id'] = survey['base_url'].rstrip('/').split('/')[-1]
+        survey.setdefault('name', survey['id'])
+        survey.setdefault('max-responses', None)
+        surveys.append(survey)
+    return surveys
+
+
+def get_translation_map(survey:dict, fetch=False) -> dict:
+    """
+    The survey's combined SM -> COS map, built once and reused until its cached SM or COS key file changes.
+
+    When the keys change (e.g. a survey edited mid-campaign), the cached map is patched rather than rebuilt
+    (see keydiff.patch_map()) -- and kept as the same object if nothing in it changed.
+
+    fetch (bool): Use freshly fetched keys (see get_qa_key())
+    """
+    sm_fp = survey['survey-details-fp']
+    with _maps_lock:
+        cached = _maps.get(survey['id'])
+        if cached is not None and cached[0] == (_mtime(sm_fp), _mtime(cached[4])) and not fetch:
+            return cached[1]
+
+    cos_fp = cached[4] if cached is not None else load_config()['cos']['survey-details-fp']
+    mtimes = (_mtime(sm_fp), _mtime(cos_fp))
+    sm_key = get_qa_key("sm", fetch=fetch, survey=survey)
+    cos_key = get_qa_key("cos", fetch=fetch)
+    if cached is None:
+        combined_map = build_qa_map(sm_key, cos_key)
+        surveys_logger.debug("Built translation map for survey %s", survey['name'])
+    else:
+        combined_map, changes = patch_map(cached[1], cached[2], sm_key, cached[3], cos_key)
+        if combined_map is not cached[1]:
+            logger.warning("Survey %s keys changed -- SM: %s -- COS: %s -- patched translation map (%d entries rebuilt)",
+                           survey['name'], summarize(changes['sm']), summarize(changes['cos']), changes['rebuilt'],
+                           extra={'survey': survey['name'], 'sm_changes': changes['sm'], 'cos_changes': changes['cos']})
+
+    if fetch: # get_qa_key() may have rewritten the cached key files
+        mtimes = (_mtime(sm_fp), _mtime(cos_fp))
+    with _maps_lock:
+        _maps[survey['id']] = (mtimes, combined_map, sm_key, cos_key, cos_fp)
+    return combined_map
+
+
+def _mtime(fp:str):
+    return os.path.getmtime(fp) if os.path.isfile(fp) else None
@@ -1,57 +1,67 @@
-import requests
-import yaml
 import json
 import datetime as dt
 import time
 import os
 import random
+import threading
 import urllib
-import html
-import re
-import pytz
-from email_validator import validate_email, EmailNotValidError
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from .logger import logger
+from functools import lru_cache
+from .logger import logger, get_logger
+from .responses import as_response
+from .normalize import clean_text
+from .metrics import REQUEST_LATENCY, EMAILS
+from .cassettes import get_cassette
+
+# Per-stage loggers: their DEBUG lines can be sampled with LOG_SAMPLE (see logger.py)
+request_logger = get_logger('request')
+cos_logger = get_logger('cos')
+email_logger = get_logger('email')
+
+## Third-party (requests, yaml, pytz, email_validator) and smtplib/MIME modules are imported inside the functions
+# that use them, so importing this module (e.g. at app start-up) stays cheap -- see benchmarks/importtime.py
 
 #### --- For smaller or more general functions than those in funcs.py --- ####
 ## ----------------------------------------------------------------------------- ##
 # Generic Utils/Wrappers #
 
+## Every HTTP call and SMTP socket operation gives up after this long, so a stalled API can't hold a response past
+# its lease (leases.LEASE_S) -- see also leases.Heartbeat
+REQUEST_TIMEOUT_S = float(os.environ.get("REQUEST_TIMEOUT_S", "30"))
+SMTP_TIMEOUT_S = float(os.environ.get("SMTP_TIMEOUT_S", "30"))
+
 ## GET/POST request wrapper
-def request(method:str, url:str, headers:dict, data=None, json=None, params=None, max_retries=2) -> requests.Response:
+def request(method:str, url:str, headers:dict, data=None, json=None, params=None, max_retries=2) -> "requests.Response":
     """Generic wrapper for request with logging and retries."""
+    import requests
+
+    cassette = get_cassette()
+    if cassette is not None and cassette.replaying:
+        return cassette.replay_request(method, url, params, json if json is not None else data)
 
-    format_string = "%Y-%m-%dT%H:%M:%S+00:00"
     attempts = 0
 
     while attempts <= max_retries:
+        request_logger.debug("%s %s -- params %s -- attempt %d", method, url, params, attempts + 1)
         try:
-            start_time = time.time()
+            start_time = time.perf_counter()
             if method == "GET":
-                response = requests.get(url, headers=headers, params=params)
+                response = requests.get(url, headers=headers, params=params, timeout=REQUEST_TIMEOUT_S)
             elif method == "POST":
-                response = requests.post(url, json=json, headers=headers, params=params, data=data)
-            end_time = time.time()
+                response = requests.post(url, json=json, headers=headers, params=params, data=data, timeout=REQUEST_TIMEOUT_S)
+            time_taken = time.perf_counter() - start_time
+            REQUEST_LATENCY.observe(time_taken, method=method, host=urllib.parse.urlsplit(url).netloc, status=str(response.status_code))
 
-            log_data = {
-                "url":{url},
-                "response_code":{response.status_code},
-                "time_taken":f"{end_time - start_time:.2f}"
-            }
-            logger.info(f"{method} {log_data['url']} -- ({log_data['response_code']}) -- {log_data['time_taken']}s")
+            request_logger.info("%s %s -- (%s) -- %.2fs", method, url, response.status_code, time_taken,
+                                extra={"method": method, "url": url, "response_code": response.status_code, "time_taken": time_taken})
+            if cassette is not None:
+                cassette.record_request(method, url, params, json if json is not None else data, response)
 
             return response
 
         except Exception as e:
-            error_data = {
-                "url": url,
-                "time": dt.datetime.now().strftime(format_string),
-                "message": str(e)
-            }
             wait_time = random.randint(1,4)
-            logger.error(f"{method} {error_data['url']} -- ({error_data['message']}) -- Re-try in {wait_time}s")
+            request_logger.error("%s %s -- (%s) -- Re-try in %ss", method, url, e, wait_time,
+                                 extra={"method": method, "url": url, "attempt": attempts})
 
             response = None
             time.sleep(wait_time)
@@ -66,12 +76,8 @@ def request(method:str, url:str, headers:dict, data=None, json=None, params=None
 
 ## Remove HTML tags, escape characters from text
 def clean_field_text(text):
-
-    unescaped_text = html.unescape(text)
-    clean_text = re.sub(r'<.*?>', '', unescaped_text)
-    clean_text = re.sub(r'\xa0|\\xa0', ' ', clean_text)
-
-    return clean_text.strip()
+    """Remove HTML tags, escape characters from text (memoized -- see normalize.py)"""
+    return clean_text(text)
 
 ## Load JSON -- handles/logs any errors gracefully and returns None:
 def load_json(fp:str):
@@ -91,6 +97,7 @@ def load_json(fp:str):
 
 ## Get current timestamp (in str ) in est
 def est_now() -> str:
+    import pytz
     est_tz = pytz.timezone('US/Eastern')
     utc_now = dt.datetime.utcnow()
     return utc_now.astimezone(est_tz).strftime("%Y-%m-%dT%H:%M:%S+00:00")
@@ -114,12 +121,13 @@ def load_config(fp='creds/api-key.yaml'):
     if not os.path.isfile(fp):
         fp = os.path.join(os.path.abspath(os.path.pardir), fp)
 
+    import yaml
     with open(fp, "r") as file:
         data = yaml.full_load(file)
     return data
 
-def get_email_address(resp:dict) -> str:
-    """Get email address from a raw SurveyMonkey survey response (get_sm_survey_respones()).
+def get_email_address(resp) -> str:
+    """Get email address from a SurveyMonkey survey response (get_sm_survey_respones() -- or a raw/compact dict).
     Assumes the email address question is the last one in the survey.
     Note that if the respondent ommitted an answer to a question, the SM API omits it from the data it sends you.
     In such cases, the last question included in raw_resp will *not* be the be the email question, but the last question which they answered.
@@ -130,13 +138,14 @@ def get_email_address(resp:dict) -> str:
         #                  if int(q['question_number']['sm']) == 82][0]
 
     try:
-        last_question_answer = [q for p in resp['pages'] for q in p['questions']][-1]['answers'][0]
-        return last_question_answer['text']
+        last_question_answer = as_response(resp).answers[-1][1][0]
+        return last_question_answer[3] # (choice_id, other_id, row_id, text)
     except Exception:
         return None
 
 def check_email_address(email_address=None, check_deliverability=True) -> tuple:
     """Wrapper to validate email address"""
+    from email_validator import validate_email, EmailNotValidError
     if email_address is not None:
         contacted_addresses = load_contacted_email_addresses()
         if email_address in contacted_addresses:
@@ -182,13 +191,63 @@ def load_contacted_email_addresses():
 ## ----------------------------------------------------------------------------- ##
 # Functions for processing responses #
 
-def get_collector_name(str):
-    """Get name of the collector based on the collector ID"""
+COLLECTOR_NAMES_FP = "data/collector-names.json"
+COLLECTOR_RETRY_S = 3600 # after a failed lookup, the collector's name is None (without a request) for this long
+_collector_names = None # collector id -> name, loaded from COLLECTOR_NAMES_FP on first use
+_collector_failures = {} # collector id -> time.monotonic() of its last failed lookup
+_collector_names_lock = threading.Lock()
+
+def get_collector_name(collector_id:str, survey=None, test_mode=False):
+    """Get name of the collector based on the collector ID (e.g. in-person iPad vs. online link)
+
+    Names are cached in memory and in data/collector-names.json, so each collector costs one SM request ever.
+    Returns None if the name can't be retrieved (and, in test mode, for any collector not already cached). Failures
+    are remembered for COLLECTOR_RETRY_S, so a missing collector doesn't cost an SM request per response.
+    """
+    global _collector_names
+    with _collector_names_lock:
+        _load_collector_names()
+        if collector_id in _collector_names:
+            return _collector_names[collector_id]
+        failed_at = _collector_failures.get(collector_id)
+        if failed_at is not None and time.monotonic() - failed_at < COLLECTOR_RETRY_S:
+            return None
+    if test_mode:
+        return None
+
+    SM_DATA = survey if survey is not None else load_config()['sm']
+    api_root = SM_DATA['base_url'].split('/surveys/')[0]
+    response = request(method="GET", url=f"{api_root}/collectors/{collector_id}", headers=SM_DATA['headers'])
+    if response is None or response.status_code != 200:
+        logger.warning(f"GET collector {collector_id} failed -- collector_name = None for the next {COLLECTOR_RETRY_S}s")
+        with _collector_names_lock:
+            _collector_failures[collector_id] = time.monotonic()
+        return None
+
+    name = response.json().get('name')
+    with _collector_names_lock:
+        _collector_names[collector_id] = name
+        with open(COLLECTOR_NAMES_FP, "w") as file:
+            json.dump(_collector_names, file)
+    return name
+
+
+def load_collector_names() -> dict:
+    """Every cached collector name (collector id -> name), e.g. for offline reprocessing without SM requests"""
+    with _collector_names_lock:
+        return dict(_load_collector_names())
+
+def _load_collector_names() -> dict:
+    """The in-memory collector name cache, loaded from COLLECTOR_NAMES_FP on first use (caller holds the lock)"""
+    global _collector_names
+    if _collector_names is None:
+        _collector_names = (load_json(COLLECTOR_NAMES_FP) if os.path.isfile(COLLECTOR_NAMES_FP) else None) or {}
+    return _collector_names
 
 
 def check_unexpected_question_ids(sm_survey_response, combined_map) -> set:
     """Check if a survey monkey survey response has unexpected question ids"""
-    new_resp_question_ids = set(q['id'] for p in sm_survey_response['pages'] for q in p['questions'])
+    new_resp_question_ids = set(as_response(sm_survey_response).question_ids())
     skills_matcher_ids = set(combined_map['skills-matcher'].keys())
     non_skills_matcher_ids = set(combined_map['non-skills-matcher'].keys())
 
@@ -209,7 +268,17 @@ def create_cos_request_body(resp:dict) -> tuple:
     return cos_request_body
 
 
-def post_cos(processed_resp:dict, test_mode=False) -> dict:
+def load_test_cos_responses(fp:str) -> dict:
+    """Stored COS responses for test mode ({response_id: cos_response}), parsed once per version of the file"""
+    mtime = os.path.getmtime(fp) if os.path.isfile(fp) else None
+    return _load_test_cos_responses(fp, mtime)
+
+@lru_cache(maxsize=4)
+def _load_test_cos_responses(fp:str, mtime) -> dict:
+    cos_logger.debug("Loading cached COS responses from %s", fp)
+    return load_json(fp) or {}
+
+def post_cos(processed_resp:dict, test_mode=False, fallback=False) -> dict:
     """POST a COS request from a processed SM survey response
 
     Args:
@@ -217,15 +286,18 @@ def post_cos(processed_resp:dict, test_mode=False) -> dict:
     processed_resp (dict): A survey monkey survey response dict translated by translate_sm_response()
 
     test_mode (bool): If True, forgoes calling the COS API and loads a local file with stored COS Responses
-        - If the current response does not have a stored COS response in this file, returns {}
+        - If the current response does not have a stored COS response in this file, falls back as below
+
+    fallback (bool): If the COS request fails, score the response with the local model (modules/scoring.py) -- opt-in
+        via `cos: local-scoring-fallback: true` in creds/api-key.yaml. The result has 'ScoringEngine': 'local'.
+        - Returns {} if this is False or no local model has been fitted (and main() parks the response for a retry)
 
     """
     cos_response = {} # Setting default value for if there are any errors
 
     if test_mode:
-        logger.debug("Loading cached COS responses.")
         fp = "data/temp_cos_response_objects.json"
-        cos_responses = load_json(fp)
+        cos_responses = load_test_cos_responses(fp)
         if processed_resp['response_id'] not in cos_responses.keys():
             logger.warning(f"{processed_resp['response_id']} not in {fp} -- Setting cos_response = {{}}")
         else:
@@ -233,6 +305,7 @@ def post_cos(processed_resp:dict, test_mode=False) -> dict:
     else:
         try: # Create Request body
             cos_request_body = create_cos_request_body(processed_resp)
+            cos_logger.debug("SM: %s -- COS request with %d skill levels", processed_resp['response_id'], len(cos_request_body['SKAValueList']))
         except Exception as e:
             logger.error(f"{processed_resp['response_id']} -- Failed to create COS request body -- {e} -- Setting cos_response = {{}}")
 
@@ -254,6 +327,16 @@ def post_cos(processed_resp:dict, test_mode=False) -> dict:
         except Exception as e:
             logger.error(f"SM: {processed_resp['response_id']} -- POST {url} (None) -- {e} -- Setting cos_response = {{}}")
 
+    # Degraded mode: rank occupations locally rather than sending no email
+    if cos_response == {} and fallback:
+        try:
+            from .scoring import local_cos_response
+            cos_response = local_cos_response(processed_resp)
+        except Exception as e:
+            logger.error(f"SM: {processed_resp['response_id']} -- Local scoring failed -- {e}")
+        if cos_response:
+            logger.warning(f"SM: {processed_resp['response_id']} -- Using local scoring model for COS results")
+
     return cos_response
 
 
@@ -276,8 +359,14 @@ def create_job_url(job_title:str,onet_code:str ) -> str:
     return url
     # return f'<a href="{url}">{onet_code}</a>'
 
+## Header row of the recommendations table
+EMAIL_TABLE_HEADERS = ('Your Match Rank', 'Job Title', 'Typical Wages (Annual)', 'Typical Education', 'Link')
+EMAIL_TABLE_HEADER_HTML = "<tr>" + "".join(f"<th style='font-weight: bold; font-size: 20px;'>{header}</th>"
+                                           for header in EMAIL_TABLE_HEADERS) + "</tr>"
+
+@lru_cache(maxsize=1)
 def load_email_text():
-    """Load the text of the email message body"""
+    """Load the text of the email message body (read once per process)"""
 
     fp = "modules/email_message.txt"
     if not os.path.isfile(fp):
@@ -304,41 +393,15 @@ def compose_email(cos_response:dict, max_recommendations=10) -> tuple:
 
     """
 
-    ## Get Job recommendations from Response
-    rec_list = []
-    try:
-        n_jobs_to_include = min(len(cos_response['SKARankList']), max_recommendations)
-    except Exception:
-        print(cos_response)
-    for rec in cos_response['SKARankList'][:n_jobs_to_include]:
-        cleaned_rec = {}
-        cleaned_rec['Your Match Rank'] = rec['Rank']
-        cleaned_rec['Job Title'] = rec['OccupationTitle']
-        cleaned_rec['Typical Wages (Annual)'] = f"${rec['AnnualWages']:,.0f}"
-        cleaned_rec['Typical Education'] = rec['TypicalEducation']
-        # Create url (not embedded)
-        cleaned_rec['Link'] = create_job_url(job_title=rec['OccupationTitle'],
-                                        onet_code=rec['OnetCode'])
-        rec_list.append(cleaned_rec)
+    ## Get Job recommendations from Response (occupation details come from the shared dimension table)
+    from .occupations import get_store, compact_jobs
+    store = get_store()
+    store.update(cos_response['SKARankList'][:max_recommendations], refresh=False)
+    jobs = compact_jobs(cos_response)[:max_recommendations]
 
     ## Format/Style HTML Table
-    table_headers = rec_list[0].keys()
-    table_html = "<table>"
-    table_html += "<tr>"
-
-    # Header Style
-    header_style = "font-weight: bold; font-size: 20px;"
-    for header in table_headers:
-        table_html += f"<th style='{header_style}'>{header}</th>"
-    table_html += "</tr>"
-
-    # Cell Style
-    cell_style = "font-weight: normal; font-size: 16px;"
-    for rec in rec_list:
-        table_html += "<tr>"
-        for header in table_headers:
-            table_html += f"<td style='{cell_style}'>{rec[header]}</td>"
-        table_html += "</tr>"
+    table_html = "<table>" + EMAIL_TABLE_HEADER_HTML
+    table_html += "".join(store.table_row(onet_code, rank) for onet_code, rank, _ in jobs)
     table_html += "</table>"
 
     ## Load introductory message
@@ -355,32 +418,53 @@ def compose_email(cos_response:dict, max_recommendations=10) -> tuple:
     return email_subject, email_body, table_html
 
 def send_email(response_id:str, cos_response:dict, sender:str, app_password:str, recipient:str,
-               server='smtp.gmail.com', port=587, test_mode=False) -> bool:
-    """Send the email to a respondent's provided email (after it was validated and the request to COS successful)"""
+               server='smtp.gmail.com', port=587, starttls=True, test_mode=False) -> bool:
+    """Send the email to a respondent's provided email (after it was validated and the request to COS successful)
+
+    Set starttls=False only for local SMTP servers (e.g. benchmarks/fake_servers.py) -- credentials are otherwise sent in the clear.
+    """
 
     if not test_mode:
 
         email_subject, email_body, jobs_table = compose_email(cos_response)
+        email_logger.debug("SM: %s -- composed email (%d bytes) for %s", response_id, len(email_body), recipient)
 
+        import smtplib
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+
+        cassette = get_cassette()
+        if cassette is not None and cassette.replaying:
+            contacted = bool(cassette.replay_email(server, recipient, email_body))
+            logger.info(f"SM: {response_id} -- Replayed send ({recipient}) -- {contacted}")
+            return contacted
+
+        smtp_host = server
         try:
             msg = MIMEMultipart()
             msg["Subject"] = email_subject
             msg.attach(MIMEText(email_body, 'html'))  # Use 'html' for HTML content or 'plain' for plain text.
 
-            server = smtplib.SMTP(server, port)
-            server.starttls()
+            server = smtplib.SMTP(server, port, timeout=SMTP_TIMEOUT_S)
+            if starttls:
+                server.starttls()
             server.login(sender, app_password)
             server.sendmail(sender, recipient, msg.as_string())
             server.quit()
 
             contacted = True  # Email sent successfully
+            EMAILS.inc(result="sent")
             logger.info(f"SM: {response_id} -- Sent ({recipient})")
 
         except Exception as e:
             logger.error(f"SM: {response_id} -- Failed send ({recipient}) -- ({str(e)})")
             contacted = False
+            EMAILS.inc(result="failed")
+
+        if cassette is not None:
+            cassette.record_email(smtp_host, recipient, email_body, contacted)
     else:
-        logger.debug(f"SM: {response_id} -- Test Mode -- Skipping send ({recipient})")
+        email_logger.debug("SM: %s -- Test Mode -- Skipping send (%s)", response_id, recipient)
         contacted = True
 
     return contacted
@@ -0,0 +1,61 @@
+import json
+import os
+import shutil
+from types import SimpleNamespace
+
+import pytest
+
+# No warm-up thread when tests import app.py: it would load models from the repo while a test runs in its sandbox
+os.environ["WARM_UP"] = "0"
+
+from benchmarks.run import make_sandbox, SM_KEY_FP, COS_KEY_FP, COS_RESPONSE_FP
+from benchmarks.synthetic import generate_responses
+from benchmarks.fake_servers import FakeSurveyMonkey, FakeCareerOneStop, FakeSMTP
+from modules import cassettes, categories, deadletter, geography, leases, occupations, scoring, skillmatrix, surveys, utils
+
+#### --- Shared fixtures: a sandboxed working directory against local fake SM, COS and SMTP servers --- ####
+
+N_RESPONSES = 5
+
+# Module-level caches that would otherwise carry state from one test (and working directory) to the next
+SINGLETONS = ((cassettes, '_cassette', None), (categories, '_models', None), (deadletter, '_store', None),
+              (deadletter, '_scheduler', None), (geography, '_index', None), (leases, '_store', None),
+              (occupations, '_store', None), (scoring, '_model', None), (skillmatrix, '_matrix', None),
+              (surveys, '_maps', {}), (utils, '_collector_names', None), (utils, '_collector_failures', {}))
+
+
+def load_json(fp:str):
+    with open(fp, "r") as file:
+        return json.load(file)
+
+
+@pytest.fixture
+def sm_key() -> dict:
+    return load_json(SM_KEY_FP)
+
+
+@pytest.fixture
+def cos_key() -> dict:
+    return load_json(COS_KEY_FP)
+
+
+@pytest.fixture
+def sandbox(monkeypatch, sm_key, cos_key):
+    """
+    Working directory laid out like the repo (see benchmarks.run.make_sandbox), pointing at fake servers that serve
+    N_RESPONSES synthetic responses -- also cached for test mode in data/test_mode_sm_survey_responses.json.
+    """
+    responses = generate_responses(sm_key, N_RESPONSES)
+    with FakeSurveyMonkey(sm_key, responses) as sm, \
+         FakeCareerOneStop(cos_key, load_json(COS_RESPONSE_FP)) as cos, \
+         FakeSMTP() as smtp:
+        directory = make_sandbox(sm, cos, smtp)
+        with open(os.path.join(directory, "data/test_mode_sm_survey_responses.json"), "w") as file:
+            json.dump(responses, file)
+        monkeypatch.chdir(directory)
+        for module, name, value in SINGLETONS:
+            monkeypatch.setattr(module, name, type(value)() if value is not None else None)
+        try:
+            yield SimpleNamespace(directory=directory, responses=responses, sm=sm, cos=cos, smtp=smtp)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,16 @@
+import json
+
+from app import app
+from tests.conftest import N_RESPONSES
+
+
+def test_webhook_returns_main_results(sandbox):
+    response = app.test_client().post('/webhook')
+    assert response.status_code == 200
+    results = json.loads(response.get_data(as_text=True))
+    # test mode: every cached response is processed, and fails at post_cos (no stored COS responses here)
+    assert len(results['successes']) + len(results['failures']) == N_RESPONSES
+
+
+def test_webhook_head(sandbox):
+    assert app.test_client().head('/webhook').status_code == 200
@@ -0,0 +1,32 @@
+import json
+
+import pytest
+
+from modules import backfill, main as main_module
+
+
+def _rows(fp:str) -> dict:
+    with open(fp, "r") as file:
+        return {row['id']: row for row in map(json.loads, file)}
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_backfill_reproduces_main(sandbox, workers):
+    main_module.main(test_mode=False)
+    stored = _rows(main_module.OUTPUT_FP)
+    output_fp = backfill.backfill(main_module.OUTPUT_FP, workers=workers, chunk_size=2)
+    rows = _rows(output_fp)
+    assert rows.keys() == stored.keys()
+    for response_id, row in rows.items():
+        assert row['processed'] == stored[response_id]['processed']
+        assert row['processed']['collector_name'] is not None
+
+
+def test_backfill_keeps_stored_collector_name(sandbox):
+    """Collectors missing from the cached names keep the name main() stored"""
+    main_module.main(test_mode=False)
+    with open(main_module.OUTPUT_FP, "r") as file:
+        line = file.readline()
+    record = json.loads(line)
+    row = backfill.reprocess_line(line, backfill.load_map(), "v", collector_names={})
+    assert row['processed']['collector_name'] == record['processed']['collector_name']
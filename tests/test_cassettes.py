@@ -0,0 +1,84 @@
+import json
+import multiprocessing
+import os
+import threading
+
+from modules import cassettes
+
+
+def _interaction(n:int) -> dict:
+    return {'status_code': 200, 'text': json.dumps({'n': n})}
+
+
+def _record(directory:str, start:int, count:int) -> None:
+    cassette = cassettes.Cassette(directory, mode="record")
+    for n in range(start, start + count):
+        cassette.put(cassettes.request_key("GET", f"http://example.com/{n}"), _interaction(n))
+    cassette.save_index()
+
+
+def _key(n:int) -> str:
+    return cassettes.request_key("GET", f"http://example.com/{n}")
+
+
+def test_replay_after_save(tmp_path):
+    _record(str(tmp_path), 0, 10)
+    cassette = cassettes.Cassette(str(tmp_path))
+    assert len(cassette.index) == 10
+    assert cassette.get(_key(3)) == _interaction(3)
+    assert cassette.replay_request("GET", "http://example.com/4").json() == {'n': 4}
+    assert cassette.get(_key(99)) is None
+
+
+def test_unsaved_lines_survive_a_crash(tmp_path):
+    _record(str(tmp_path), 0, 5)
+    crashed = cassettes.Cassette(str(tmp_path), mode="record")
+    for n in range(5, 8):  # never saved: the process "crashed"
+        crashed.put(_key(n), _interaction(n))
+    cassette = cassettes.Cassette(str(tmp_path))
+    assert all(cassette.get(_key(n)) == _interaction(n) for n in range(8))
+
+
+def test_reader_sees_lines_recorded_after_it_loaded(tmp_path):
+    reader = cassettes.Cassette(str(tmp_path))
+    _record(str(tmp_path), 0, 3)
+    assert reader.get(_key(2)) == _interaction(2)
+
+
+def test_replaced_data_file_is_reindexed(tmp_path):
+    _record(str(tmp_path), 0, 5)
+    os.remove(os.path.join(tmp_path, "interactions.jsonl"))
+    _record(str(tmp_path), 100, 2)
+    cassette = cassettes.Cassette(str(tmp_path))
+    assert sorted(cassette.index) == sorted([_key(100), _key(101)])
+    assert cassette.get(_key(101)) == _interaction(101)
+
+
+def test_concurrent_recorders(tmp_path):
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=_record, args=(str(tmp_path), 100 * n, 50)) for n in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    with open(os.path.join(tmp_path, "index.json"), "r") as file:
+        assert len(json.load(file)['index']) == 200
+    cassette = cassettes.Cassette(str(tmp_path))
+    assert all(cassette.get(_key(100 * n + 49)) == _interaction(100 * n + 49) for n in range(4))
+
+
+def test_get_cassette_is_shared_across_threads(tmp_path, monkeypatch):
+    monkeypatch.setattr(cassettes, 'CASSETTE_MODE', "replay")
+    monkeypatch.setattr(cassettes, 'CASSETTE_DIR', str(tmp_path))
+    monkeypatch.setattr(cassettes, '_cassette', None)
+    barrier = threading.Barrier(8)
+    results = []
+    def get():
+        barrier.wait()
+        results.append(cassettes.get_cassette())
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 8 and all(cassette is results[0] for cassette in results)
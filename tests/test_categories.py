@@ -0,0 +1,21 @@
+from modules import categories, leases, main as main_module
+
+
+def test_main_categorizes_each_claimed_batch_once(sandbox, monkeypatch):
+    batches = []
+    def categorize_answers(responses, combined_map, models=None):
+        batches.append(len(responses))
+        return [{} for _ in responses]
+    monkeypatch.setattr(main_module, 'categorize_answers', categorize_answers)
+    monkeypatch.setattr(leases, 'CLAIM_BATCH', 2)
+    main_module.main(test_mode=False)
+    assert batches == [2, 2, 1]
+
+
+def test_models_are_loaded_once_per_process(sandbox, monkeypatch):
+    loads = []
+    monkeypatch.setattr(categories, '_load_or_fit', lambda labels_dir, model_fp: loads.append(model_fp) or {})
+    main_module.warm_up()
+    main_module.main(test_mode=False)
+    main_module.main(test_mode=False)
+    assert loads == [categories.MODEL_FP]
@@ -0,0 +1,111 @@
+import json
+
+import pytest
+
+from modules import deadletter, main as main_module, utils
+
+
+@pytest.fixture
+def store(tmp_path):
+    return deadletter.DeadLetterStore(str(tmp_path / "dead-letters.json"))
+
+
+def _park(store, *response_ids, stage='post_cos'):
+    for response_id in response_ids or ("r1",):
+        store.add(response_id, "s1", stage, {'raw': {'id': response_id}}, "no COS response")
+    for entry in store.entries.values():  # due now
+        entry['next_attempt'] = 0
+
+
+@pytest.mark.parametrize("attempts, base", [(1, 60), (2, 120), (3, 240), (6, 1920)])
+def test_backoff_doubles_with_jitter(attempts, base):
+    for _ in range(50):
+        assert base * 0.8 <= deadletter.backoff(attempts) <= base * 1.2
+
+
+def test_backoff_is_capped():
+    assert deadletter.backoff(30) <= deadletter.RETRY_MAX_S * 1.2
+
+
+def test_add_persists(store):
+    _park(store)
+    assert deadletter.DeadLetterStore(store.fp).entries['r1']['stage'] == 'post_cos'
+
+
+def test_add_again_keeps_attempts(store):
+    _park(store)
+    store.fail("r1", 'post_cos', "still down")
+    entry = store.add("r1", "s1", 'send_email', {}, "send failed")
+    assert entry['attempts'] == 2 and entry['stage'] == 'send_email' and len(entry['errors']) == 3
+
+
+def test_add_unknown_stage(store):
+    with pytest.raises(ValueError):
+        store.add("r1", "s1", 'unknown', {}, "error")
+
+
+def test_retry_success_resolves(store):
+    _park(store)
+    assert deadletter.RetryScheduler(store, handler=lambda entry: None).run_once() == 1
+    assert store.entries == {} and deadletter.DeadLetterStore(store.fp).entries == {}
+
+
+def test_retry_failure_reschedules(store):
+    _park(store)
+    scheduler = deadletter.RetryScheduler(store, handler=lambda entry: ('send_email', "send failed", {'x': 1}))
+    scheduler.run_once()
+    entry = store.entries['r1']
+    assert entry['attempts'] == 2 and entry['stage'] == 'send_email' and entry['state'] == {'x': 1}
+    assert not entry['exhausted'] and store.due() == []
+
+
+def test_retry_exception_counts_as_failure(store):
+    _park(store)
+    def handler(entry):
+        raise RuntimeError("boom")
+    deadletter.RetryScheduler(store, handler=handler).run_once()
+    assert store.entries['r1']['attempts'] == 2 and store.entries['r1']['errors'][-1]['error'] == "boom"
+
+
+def test_exhausted_after_max_attempts(store):
+    _park(store)
+    scheduler = deadletter.RetryScheduler(store, handler=lambda entry: ('post_cos', "down", None))
+    for attempt in range(2, deadletter.MAX_ATTEMPTS + 1):
+        scheduler.run_once(now=float('inf'))
+        assert store.entries['r1']['attempts'] == attempt
+    assert store.entries['r1']['exhausted']
+    assert scheduler.run_once(now=float('inf')) == 0
+    assert store.next_due() is None
+
+
+def test_skipped_is_left_to_its_owner(store):
+    _park(store)
+    deadletter.RetryScheduler(store, handler=lambda entry: deadletter.SKIPPED).run_once()
+    assert 'r1' not in store.entries
+    # still in the file, unchanged, for the worker that owns the retry
+    assert deadletter.DeadLetterStore(store.fp).entries['r1']['attempts'] == 1
+
+
+def test_drain_stops_thread_and_retries_due(store):
+    handled = []
+    scheduler = deadletter.RetryScheduler(store, handler=lambda entry: handled.append(entry['id']), poll_interval=60)
+    scheduler.start()
+    _park(store, "r1", "r2")
+    scheduler.drain(timeout=5)
+    assert not scheduler._thread.is_alive()
+    assert sorted(handled) == ["r1", "r2"] and store.entries == {}
+
+
+def test_one_off_main_runs_due_retries(sandbox, monkeypatch):
+    monkeypatch.setattr(deadletter, 'RETRY_BASE_S', 0)
+    post_cos = utils.post_cos
+    monkeypatch.setattr(main_module, 'post_cos', lambda *args, **kwargs: {})  # COS down: every send is parked
+    results = json.loads(main_module.main(test_mode=False)[0])
+    assert sandbox.smtp.messages == 0
+    parked = set(deadletter.get_store().entries)
+    assert parked and parked == {failure['id'] for failure in results['failures'] if failure['error_type'] == 'post_cos'}
+
+    monkeypatch.setattr(main_module, 'post_cos', post_cos)  # COS back up
+    main_module.main(test_mode=False, wait_for_retries=True)
+    assert deadletter.get_store().entries == {}
+    assert sandbox.smtp.messages == len(parked)
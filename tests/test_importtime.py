@@ -0,0 +1,11 @@
+import pytest
+
+from benchmarks.importtime import importtime, check, LAZY_MODULES, MAIN_LAZY_MODULES
+
+
+@pytest.mark.parametrize("statement, lazy_modules", [
+    ("import app", LAZY_MODULES),
+    ("import modules.main", MAIN_LAZY_MODULES),
+])
+def test_import_stays_lazy(statement, lazy_modules):
+    assert check(importtime(statement), statement, lazy_modules=lazy_modules) == []
@@ -0,0 +1,90 @@
+import copy
+
+import pytest
+
+from modules.funcs import build_qa_map
+from modules.keydiff import patch_map, diff_sm_keys, diff_cos_keys, is_empty
+
+SKILLS_PAGE = 20  # 'SKILLS MATCHER TOOL QUESTIONS'
+
+
+def change_heading(sm_key, cos_key):
+    sm_key['pages'][0]['questions'][0]['headings'][0]['heading'] = "How did you hear about this survey?"
+
+
+def change_skills_heading(sm_key, cos_key):
+    sm_key['pages'][SKILLS_PAGE]['questions'][3]['headings'][0]['heading'] += " (revised)"
+
+
+def remove_question(sm_key, cos_key):
+    del sm_key['pages'][0]['questions'][2]
+
+
+def add_question(sm_key, cos_key):
+    question = copy.deepcopy(sm_key['pages'][0]['questions'][1])
+    question['id'] = "999000001"
+    question['headings'][0]['heading'] = "A new question?"
+    sm_key['pages'][1]['questions'].insert(0, question)
+
+
+def add_choice(sm_key, cos_key):
+    choices = sm_key['pages'][0]['questions'][0]['answers']['choices']
+    choices.append({**choices[-1], 'id': "999000002", 'text': "A new choice", 'position': len(choices) + 1})
+
+
+def remove_choice(sm_key, cos_key):
+    del sm_key['pages'][0]['questions'][0]['answers']['choices'][1]
+
+
+def swap_cos_skills(sm_key, cos_key):
+    skills = cos_key['Skills']
+    skills[0], skills[1] = skills[1], skills[0]
+
+
+def change_cos_question(sm_key, cos_key):
+    cos_key['Skills'][5]['Question'] += " (revised)"
+
+
+def swap_skills_questions(sm_key, cos_key):
+    questions = sm_key['pages'][SKILLS_PAGE]['questions']
+    questions[0], questions[1] = questions[1], questions[0]
+
+
+CHANGES = [change_heading, change_skills_heading, remove_question, add_question, add_choice, remove_choice,
+           swap_cos_skills, change_cos_question, swap_skills_questions]
+
+
+@pytest.mark.parametrize("change", CHANGES, ids=[change.__name__ for change in CHANGES])
+def test_patch_matches_rebuild(sm_key, cos_key, change):
+    combined_map = build_qa_map(sm_key, cos_key)
+    original = copy.deepcopy(combined_map)
+    new_sm_key, new_cos_key = copy.deepcopy(sm_key), copy.deepcopy(cos_key)
+    change(new_sm_key, new_cos_key)
+
+    patched, changes = patch_map(combined_map, sm_key, new_sm_key, cos_key, new_cos_key)
+    assert not (is_empty(changes['sm']) and is_empty(changes['cos']))
+    assert patched == build_qa_map(new_sm_key, new_cos_key)
+    assert changes['rebuilt'] < sum(len(entries) for entries in patched.values())  # only what changed
+    assert combined_map == original  # not modified
+
+
+def test_no_change_returns_same_map(sm_key, cos_key):
+    combined_map = build_qa_map(sm_key, cos_key)
+    cosmetic_sm_key = copy.deepcopy(sm_key)
+    cosmetic_sm_key['pages'][0]['questions'][0]['href'] += "?v=2"  # not a field the map is built from
+    patched, changes = patch_map(combined_map, sm_key, cosmetic_sm_key, cos_key, copy.deepcopy(cos_key))
+    assert patched is combined_map
+    assert changes['rebuilt'] == 0 and is_empty(changes['cos'])
+    assert patched == build_qa_map(cosmetic_sm_key, cos_key)
+
+
+def test_diffs_name_what_changed(sm_key, cos_key):
+    new_sm_key, new_cos_key = copy.deepcopy(sm_key), copy.deepcopy(cos_key)
+    remove_question(new_sm_key, new_cos_key)
+    add_choice(new_sm_key, new_cos_key)
+    change_cos_question(new_sm_key, new_cos_key)
+
+    sm_diff = diff_sm_keys(sm_key, new_sm_key)
+    assert sm_diff['removed'] == [sm_key['pages'][0]['questions'][2]['id']]
+    assert sm_diff['changed'][sm_key['pages'][0]['questions'][0]['id']]['answers']['added'] == ["999000002"]
+    assert diff_cos_keys(cos_key, new_cos_key)['changed'] == {cos_key['Skills'][5]['ElementId']: ['Question']}
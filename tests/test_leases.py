@@ -0,0 +1,85 @@
+import json
+import time
+
+import pytest
+
+from modules import leases, main as main_module
+
+KEYS = ["r1", "r2", "r3"]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return leases.LeaseStore(str(tmp_path / "leases.sqlite3"), lease_s=0.5)
+
+
+def test_claim_is_exclusive(store):
+    assert store.claim(KEYS, worker="a") == KEYS
+    assert store.claim(KEYS, worker="b") == []
+    # a worker's own leases can be claimed again (renewed)
+    assert store.claim(KEYS, worker="a") == KEYS
+
+
+def test_claim_limit(store):
+    assert store.claim(KEYS, worker="a", limit=2) == ["r1", "r2"]
+    assert store.claim(KEYS, worker="b") == ["r3"]
+
+
+def test_expired_lease_is_reclaimed(store):
+    store.claim(KEYS, worker="a")
+    time.sleep(0.6)
+    assert store.claim(KEYS, worker="b") == KEYS
+
+
+def test_renew_keeps_lease(store):
+    store.claim(KEYS, worker="a")
+    time.sleep(0.3)
+    store.renew(KEYS, worker="a")
+    time.sleep(0.3)
+    assert store.claim(KEYS, worker="b") == []
+
+
+def test_done_is_never_reclaimed(store):
+    store.claim(KEYS, worker="a")
+    store.complete(["r1"], worker="a")
+    time.sleep(0.6)
+    assert store.claim(KEYS, worker="b") == ["r2", "r3"]
+    assert store.claim(["r1"], worker="a") == []
+
+
+def test_release_frees_lease(store):
+    store.claim(KEYS, worker="a")
+    store.release(["r2"], worker="a")
+    assert store.claim(KEYS, worker="b") == ["r2"]
+
+
+def test_heartbeat_outlasts_lease(store):
+    store.claim(KEYS, worker="a")
+    with leases.Heartbeat(store, KEYS, worker="a", interval=0.1):
+        time.sleep(1.0)  # twice the lease
+        assert store.claim(KEYS, worker="b") == []
+    time.sleep(0.6)
+    assert store.claim(KEYS, worker="b") == KEYS
+
+
+def _stored_records() -> list:
+    with open(main_module.OUTPUT_FP, "r") as file:
+        return [json.loads(line) for line in file]
+
+
+def _stored_ids() -> list:
+    return [record['id'] for record in _stored_records()]
+
+
+def test_main_processes_each_response_once(sandbox):
+    main_module.main(test_mode=False)
+    main_module.main(test_mode=False)  # everything is done -- claims nothing
+    assert sorted(_stored_ids()) == sorted(resp['id'] for resp in sandbox.responses)
+    assert sandbox.smtp.messages == sum(record['email']['contacted'] for record in _stored_records())
+
+
+def test_main_skips_responses_leased_elsewhere(sandbox):
+    held = [resp['id'] for resp in sandbox.responses[:2]]
+    assert leases.get_store().claim(held, worker="other") == held
+    main_module.main(test_mode=False)
+    assert sorted(_stored_ids()) == sorted(resp['id'] for resp in sandbox.responses[2:])
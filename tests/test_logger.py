@@ -0,0 +1,55 @@
+import logging
+
+import pytest
+
+from modules.logger import StageSampler, get_logger
+
+
+def _record(name:str, level:int) -> logging.LogRecord:
+    return logging.LogRecord(name, level, __file__, 0, "message", None, None)
+
+
+@pytest.fixture
+def sampler():
+    return StageSampler({'translate': 0.0, 'request': 1.0})
+
+
+def test_sampling_drops_debug(sampler):
+    name = get_logger('translate').name
+    assert not any(sampler.filter(_record(name, logging.DEBUG)) for _ in range(100))
+
+
+@pytest.mark.parametrize("level", [logging.INFO, logging.WARNING, logging.ERROR])
+def test_sampling_never_drops_info_and_above(sampler, level):
+    assert all(sampler.filter(_record(get_logger('translate').name, level)) for _ in range(100))
+
+
+def test_unsampled_stages_keep_debug(sampler):
+    for stage in ('request', 'email'):
+        assert all(sampler.filter(_record(get_logger(stage).name, logging.DEBUG)) for _ in range(100))
+
+
+def test_partial_rate():
+    sampler = StageSampler({'translate': 0.5})
+    kept = sum(sampler.filter(_record(get_logger('translate').name, logging.DEBUG)) for _ in range(2000))
+    assert 800 < kept < 1200
+
+
+@pytest.mark.parametrize("rates, debug_lines", [({}, 20), ({'translate': 0.0}, 0)])
+def test_translate_debug_lines_are_sampled(sm_key, cos_key, monkeypatch, rates, debug_lines):
+    """translate_sm_response's per-response DEBUG line goes through the sampled 'translate' stage logger"""
+    from benchmarks.synthetic import generate_responses
+    from modules.logger import queue_handler
+    from modules.funcs import build_qa_map, translate_sm_response
+
+    enqueued = []
+    monkeypatch.setattr(queue_handler, 'filters', [StageSampler(rates)])
+    monkeypatch.setattr(queue_handler, 'enqueue', enqueued.append)
+    combined_map = build_qa_map(sm_key, cos_key)
+    for resp in generate_responses(sm_key, 20):
+        translate_sm_response(resp, combined_map)
+    get_logger('translate').info("never sampled")
+
+    translate_records = [record for record in enqueued if record.name.endswith('.translate')]
+    assert sum(record.levelno == logging.DEBUG for record in translate_records) == debug_lines
+    assert translate_records[-1].getMessage() == "never sampled"
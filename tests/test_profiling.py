@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+from app import app
+from modules import profiling
+
+TOKEN = "s3cret"
+
+
+@pytest.fixture
+def profile_dir(sandbox, monkeypatch):
+    monkeypatch.setattr(profiling, 'PROFILE', False)
+    monkeypatch.setattr(profiling, 'PROFILE_TOKEN', TOKEN)
+    monkeypatch.setattr(profiling, 'PROFILE_DIR', os.path.join(sandbox.directory, "profiles"))
+    return profiling.PROFILE_DIR
+
+
+def _runs(profile_dir:str) -> list:
+    return sorted(os.listdir(profile_dir)) if os.path.isdir(profile_dir) else []
+
+
+def test_profile_header_with_token(profile_dir):
+    response = app.test_client().post('/webhook', headers={'X-Profile': TOKEN})
+    assert response.status_code == 200
+    runs = _runs(profile_dir)
+    assert len(runs) == 1 and runs[0].endswith("-main")
+    artefacts = set(os.listdir(os.path.join(profile_dir, runs[0])))
+    assert {'cpu.collapsed', 'spans.tsv', 'memory.txt', 'summary.json'} <= artefacts
+
+
+@pytest.mark.parametrize("headers", [{'X-Profile': "wrong"}, {'X-Profile': ""}, {}])
+def test_profile_header_without_token(profile_dir, headers):
+    response = app.test_client().post('/webhook', headers=headers)
+    assert response.status_code == 200
+    assert _runs(profile_dir) == []
+
+
+def test_profile_header_ignored_without_configured_token(profile_dir, monkeypatch):
+    monkeypatch.setattr(profiling, 'PROFILE_TOKEN', "")
+    assert app.test_client().post('/webhook', headers={'X-Profile': ""}).status_code == 200
+    assert _runs(profile_dir) == []
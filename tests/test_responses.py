@@ -0,0 +1,28 @@
+import json
+
+from modules import leases, main as main_module, responses as responses_module
+
+
+def test_raw_items_of_passed_over_responses_are_dropped(sandbox, monkeypatch):
+    fetched = []
+    get_sm_survey_responses = main_module.get_sm_survey_responses
+    monkeypatch.setattr(main_module, 'get_sm_survey_responses',
+                        lambda **kwargs: fetched.extend(get_sm_survey_responses(**kwargs)) or fetched)
+    pending_raw = [] # per categorized batch: which responses still hold their raw item
+    categorize_answers = main_module.categorize_answers
+    def categorize(batch, combined_map, models=None):
+        pending_raw.append([resp.pending_raw is not None for resp in fetched])
+        return categorize_answers(batch, combined_map, models=models)
+    monkeypatch.setattr(main_module, 'categorize_answers', categorize)
+    monkeypatch.setattr(leases, 'CLAIM_BATCH', 2)
+
+    held = [resp['id'] for resp in sandbox.responses[:2]]
+    leases.get_store().claim(held, worker="other")
+    main_module.main(test_mode=False)
+
+    # first batch: responses 0 and 1 were passed over (dropped), 2 and 3 archived, 4 not claimed yet
+    assert pending_raw[0] == [False, False, False, False, True]
+    assert all(resp.pending_raw is None for resp in fetched)
+    with open(responses_module.RAW_ARCHIVE_FP, "r") as file:
+        archived = [json.loads(line)['id'] for line in file]
+    assert sorted(archived) == sorted(resp['id'] for resp in sandbox.responses[2:])